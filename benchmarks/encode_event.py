@@ -0,0 +1,80 @@
+'''
+Compare encode_event against sanitizing and serializing an event with
+isinstance chains and json.dumps, as Client did before.
+
+    python benchmarks/encode_event.py
+'''
+import datetime
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from skygear_event_tracking.serializer import encode_event  # noqa: E402
+
+NUMBER = 20000
+
+ATTRIBUTES = {
+    'screen': 'checkout',
+    'item_count': 3,
+    'total': 12.5,
+    'first_purchase': False,
+    'coupon': 'SPRING',
+}
+
+
+def _legacy_sanitize_value(value):
+    if isinstance(value, str):
+        return value
+    elif isinstance(value, bool):
+        return value
+    elif isinstance(value, int):
+        return float(value)
+    elif isinstance(value, float):
+        return value
+    return None
+
+
+def legacy_encode_event(event_name, user_id, attributes, tracked_at):
+    event = {}
+    for key in attributes:
+        if not isinstance(key, str):
+            continue
+        value = _legacy_sanitize_value(attributes[key])
+        if value is not None:
+            event[key] = value
+    event['_tracked_at'] = tracked_at
+    event['_event_raw'] = event_name
+    if user_id:
+        event['_user_id'] = user_id
+
+    output = {}
+    for key, value in event.items():
+        if isinstance(value, datetime.datetime):
+            output[key] = {
+                '$type': 'date',
+                '$date': value.isoformat() + 'Z',
+            }
+        else:
+            output[key] = _legacy_sanitize_value(value)
+    return json.dumps(output, separators=(',', ':')).encode('utf-8')
+
+
+def bench(func):
+    tracked_at = datetime.datetime.utcnow()
+    seconds = timeit.timeit(
+        lambda: func('Checkout', 'user-1', ATTRIBUTES, tracked_at),
+        number=NUMBER,
+    )
+    return seconds / NUMBER * 1e9
+
+
+def main():
+    print('legacy ns: {:.0f}'.format(bench(legacy_encode_event)))
+    print('encode_event ns: {:.0f}'.format(bench(encode_event)))
+
+
+if __name__ == '__main__':
+    main()
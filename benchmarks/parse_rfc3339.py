@@ -0,0 +1,52 @@
+'''
+Compare parse_rfc3339 against the strptime implementation it replaced.
+
+    python benchmarks/parse_rfc3339.py
+'''
+import datetime
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from skygear_event_tracking.utils import parse_rfc3339  # noqa: E402
+
+NUMBER = 100000
+
+INPUTS = [
+    '2017-01-23T01:23:45.006Z',
+    '2017-01-23T01:23:45.006789Z',
+    '2017-01-23T01:23:45Z',
+    '2017-01-23T09:23:45.006+08:00',
+]
+
+
+def legacy_parse_rfc3339(some_str):
+    dt = datetime.datetime.strptime(some_str, '%Y-%m-%dT%H:%M:%S.%fZ')
+    return dt
+
+
+def bench(func, input_):
+    try:
+        func(input_)
+    except ValueError:
+        return None
+    seconds = timeit.timeit(lambda: func(input_), number=NUMBER)
+    return seconds / NUMBER * 1e9
+
+
+def main():
+    print('{:<32} {:>12} {:>12}'.format('input', 'strptime ns', 'new ns'))
+    for input_ in INPUTS:
+        legacy = bench(legacy_parse_rfc3339, input_)
+        new = bench(parse_rfc3339, input_)
+        print('{:<32} {:>12} {:>12.0f}'.format(
+            input_,
+            'rejected' if legacy is None else '{:.0f}'.format(legacy),
+            new,
+        ))
+
+
+if __name__ == '__main__':
+    main()
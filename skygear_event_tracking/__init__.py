@@ -1,3 +1,5 @@
 # pylama:ignore=W0611
 from .handler import register_handler
 from .client import Client
+from .async_client import AsyncClient
+from .indexes import IndexPolicy
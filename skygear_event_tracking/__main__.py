@@ -0,0 +1,68 @@
+from sqlalchemy import create_engine
+import argparse
+import datetime
+import logging
+import os
+from .indexes import IndexProvisioner
+from .rollup import rebuild_rollups
+
+
+def _rebuild_rollup(engine, db_schema, args):
+    since = None
+    if args.since is not None:
+        since = datetime.datetime.strptime(args.since, '%Y-%m-%d')
+    rebuild_rollups(engine, db_schema, args.db_table_prefix, since=since)
+
+
+def _provision_indexes(engine, db_schema, args):
+    provisioner = IndexProvisioner(engine, db_schema, args.db_table_prefix)
+    provisioner.run()
+
+
+def make_parser():
+    parser = argparse.ArgumentParser(prog='skygear_event_tracking')
+    parser.add_argument(
+        '--db-connection-uri',
+        default=os.environ.get('DATABASE_URL'),
+    )
+    parser.add_argument(
+        '--db-schema',
+        default=None,
+        help='defaults to app_ followed by the environment variable APP_NAME',
+    )
+    parser.add_argument('--db-table-prefix', default='et_')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    rebuild_rollup = subparsers.add_parser(
+        'rebuild-rollup',
+        help='rebuild the hourly rollup from event tables',
+    )
+    rebuild_rollup.add_argument(
+        '--since',
+        default=None,
+        help='only rebuild hours since this UTC date, e.g. 2017-05-08',
+    )
+    rebuild_rollup.set_defaults(func=_rebuild_rollup)
+
+    provision_indexes = subparsers.add_parser(
+        'provision-indexes',
+        help='create the default indexes on existing event tables '
+             'with CREATE INDEX CONCURRENTLY',
+    )
+    provision_indexes.set_defaults(func=_provision_indexes)
+    return parser
+
+
+def main(argv=None):
+    args = make_parser().parse_args(argv)
+    db_schema = args.db_schema
+    if db_schema is None:
+        db_schema = 'app_' + os.environ['APP_NAME']
+    logging.basicConfig(level=logging.INFO)
+    engine = create_engine(args.db_connection_uri)
+    args.func(engine, db_schema, args)
+
+
+if __name__ == '__main__':
+    main()
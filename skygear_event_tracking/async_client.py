@@ -0,0 +1,285 @@
+from urllib.parse import urljoin, urlsplit
+import asyncio
+import logging
+import ssl
+from .client import ClientBase
+from .sampling import Sampler
+
+
+class UploadError(Exception):
+    def __init__(self, status_code):
+        super(UploadError, self).__init__(
+            'upload failed with status {}'.format(status_code)
+        )
+        self.status_code = status_code
+
+
+# The maximum size of a response body, which the client discards
+MAX_RESPONSE_BODY_SIZE = 64 * 1024
+
+
+def _check_body_size(size, max_size):
+    if size > max_size:
+        raise ValueError('response body larger than {} bytes'.format(
+            max_size,
+        ))
+
+
+async def _read_chunked_body(reader, max_size):
+    chunks = []
+    size = 0
+    while True:
+        line = await reader.readline()
+        chunk_size = int(line.split(b';', 1)[0].strip(), 16)
+        if chunk_size == 0:
+            # skip trailers
+            while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                pass
+            return b''.join(chunks)
+        size += chunk_size
+        _check_body_size(size, max_size)
+        chunks.append(await reader.readexactly(chunk_size))
+        await reader.readline()
+
+
+async def _read_until_eof(reader, max_size):
+    chunks = []
+    size = 0
+    while True:
+        chunk = await reader.read(max_size + 1 - size)
+        if not chunk:
+            return b''.join(chunks)
+        size += len(chunk)
+        _check_body_size(size, max_size)
+        chunks.append(chunk)
+
+
+async def _read_head(reader):
+    status_line = await reader.readline()
+    if not status_line:
+        raise ConnectionError('connection closed by the server')
+    status_code = int(status_line.split(None, 2)[1])
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    return status_code, headers
+
+
+def _has_body(status_code):
+    # RFC 7230 section 3.3.3
+    return status_code >= 200 and status_code not in (204, 304)
+
+
+async def read_response(reader, max_body_size=MAX_RESPONSE_BODY_SIZE):
+    '''
+    Read a HTTP/1.1 response, skipping interim 1xx responses.
+    Return the status code, the headers with lowercase names, and the
+    body. Raise ValueError if the body is larger than max_body_size.
+    '''
+    status_code, headers = await _read_head(reader)
+    while status_code < 200:
+        status_code, headers = await _read_head(reader)
+    if not _has_body(status_code):
+        body = b''
+    elif headers.get('transfer-encoding', '').lower() == 'chunked':
+        body = await _read_chunked_body(reader, max_body_size)
+    elif 'content-length' in headers:
+        content_length = int(headers['content-length'])
+        _check_body_size(content_length, max_body_size)
+        body = await reader.readexactly(content_length)
+    else:
+        body = await _read_until_eof(reader, max_body_size)
+        headers['connection'] = 'close'
+    return status_code, headers, body
+
+
+class AsyncClient(ClientBase):
+    '''
+    Client for asyncio applications.
+    track() enqueues an event without blocking, and a background task
+    uploads batches over a keep-alive HTTP/1.1 connection. Use it with
+    ``async with``, or call start() and close().
+    The endpoint is connected to directly; proxies and redirects are
+    not supported.
+    '''
+    def __init__(
+        self,
+        skygear_endpoint,
+        mount_path='/skygear_event_tracking',
+        max_queue_size=1000,
+        upload_size=100,
+        linger_ms=1000,
+        compress=False,
+        compress_min_size=1024,
+        timeout=15,
+        sample_rates=None,
+        rate_limits=None,
+    ):
+        self._log = logging.getLogger('skygear_event_tracking.AsyncClient')
+        endpoint = urlsplit(urljoin(skygear_endpoint, mount_path))
+        self._host = endpoint.hostname
+        self._ssl = endpoint.scheme == 'https'
+        self._port = endpoint.port or (443 if self._ssl else 80)
+        self._host_header = endpoint.netloc
+        self._path = endpoint.path or '/'
+        self._max_queue_size = max_queue_size
+        self._upload_size = upload_size
+        self._linger = linger_ms / 1000
+        self._sampler = Sampler(sample_rates, rate_limits)
+        self._compress = compress
+        self._compress_min_size = compress_min_size
+        self._timeout = timeout
+        self._queue = None
+        self._task = None
+        self._connection = None
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    async def start(self):
+        '''
+        Start the upload task on the running event loop
+        '''
+        self._queue = asyncio.Queue(self._max_queue_size)
+        self._task = asyncio.ensure_future(self._run_indefinitely())
+
+    async def close(self):
+        '''
+        Upload the queued events, then stop the upload task
+        '''
+        if self._task is None:
+            return
+        await self.flush()
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        self._close_connection()
+
+    def track(self, event_name, user_id=None, attributes=None):
+        if not event_name:
+            return
+        if self._task is None:
+            self._log.warning('track() is called before start()')
+            return False
+        event = self._make_event(event_name, user_id, attributes)
+        if event is None:
+            return False
+        try:
+            self._queue.put_nowait(event)
+            return True
+        except asyncio.QueueFull:
+            return False
+
+    async def flush(self):
+        if self._task is None:
+            return
+        await self._queue.join()
+
+    async def _run_indefinitely(self):
+        while True:
+            events = await self._gather_next_batch()
+            try:
+                await self._upload(events)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                self._log.exception('upload error')
+            finally:
+                for _ in events:
+                    self._queue.task_done()
+
+    async def _gather_next_batch(self):
+        '''
+        Wait for an event, then gather events until the batch is full or
+        linger_ms has passed since the first one
+        '''
+        events = [await self._queue.get()]
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + self._linger
+        while len(events) < self._upload_size:
+            try:
+                events.append(self._queue.get_nowait())
+                continue
+            except asyncio.QueueEmpty:
+                pass
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                event = await asyncio.wait_for(self._queue.get(), remaining)
+            except asyncio.TimeoutError:
+                break
+            events.append(event)
+        return events
+
+    async def _upload(self, events):
+        body = self._prepare_request_body(events)
+        data, headers = self._encode_request_body(body)
+        await asyncio.wait_for(self._post(data, headers), self._timeout)
+
+    def _format_request(self, data, headers):
+        lines = [
+            'POST {} HTTP/1.1'.format(self._path),
+            'Host: {}'.format(self._host_header),
+            'Content-Type: application/json',
+            'Content-Length: {}'.format(len(data)),
+        ]
+        for name, value in headers.items():
+            lines.append('{}: {}'.format(name, value))
+        return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + data
+
+    async def _post(self, data, headers):
+        request = self._format_request(data, headers)
+        try:
+            status_code, response_headers = await self._send(request)
+        except BaseException:
+            self._close_connection()
+            raise
+        if response_headers.get('connection', '').lower() == 'close':
+            self._close_connection()
+        if status_code >= 400:
+            raise UploadError(status_code)
+
+    async def _connect(self):
+        '''
+        Return the keep-alive connection, or a new one if there is none
+        or the server has closed it.
+        A request is never sent again once written, as the server may
+        have processed it, so a closed connection is detected before
+        the request is written instead.
+        '''
+        if self._connection is not None:
+            reader, writer = self._connection
+            if reader.at_eof() or writer.transport.is_closing():
+                self._close_connection()
+        if self._connection is None:
+            ssl_context = ssl.create_default_context() if self._ssl else None
+            self._connection = await asyncio.open_connection(
+                self._host,
+                self._port,
+                ssl=ssl_context,
+            )
+        return self._connection
+
+    async def _send(self, request):
+        reader, writer = await self._connect()
+        writer.write(request)
+        await writer.drain()
+        status_code, headers, _ = await read_response(reader)
+        return status_code, headers
+
+    def _close_connection(self):
+        if self._connection is not None:
+            self._connection[1].close()
+            self._connection = None
@@ -0,0 +1,82 @@
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class AdaptiveBatchSize(object):
+    '''
+    Number of events per upload, driven by an exponentially weighted
+    moving average of upload latency.
+    The size grows while full batches upload faster than target_latency,
+    so that a busy client sends fewer, fuller requests, and is halved
+    once uploads get slower than that.
+    The average takes about 1 / alpha uploads to reflect a new size, so
+    the size is halved at most once per that many uploads. It is never
+    halved below minimum, or below initial or maximum if they are
+    smaller, since tiny batches only add per-request overhead to a slow
+    server.
+    '''
+    def __init__(
+        self,
+        initial,
+        maximum,
+        target_latency,
+        minimum=10,
+        alpha=0.2,
+    ):
+        self._maximum = maximum
+        self._minimum = min(minimum, initial, maximum)
+        self._target_latency = target_latency
+        self._alpha = alpha
+        self._size = min(max(initial, self._minimum), self._maximum)
+        self._latency = None
+        self._window = max(1, int(round(1 / alpha)))
+        # uploads recorded since the size was last halved
+        self._since_halved = self._window
+        self._lock = threading.Lock()
+
+    @property
+    def value(self):
+        return self._size
+
+    @property
+    def latency(self):
+        return self._latency
+
+    def record(self, latency, batch_len):
+        '''
+        Record the latency in seconds of an upload of batch_len events
+        '''
+        with self._lock:
+            if self._latency is None:
+                self._latency = latency
+            else:
+                self._latency += self._alpha * (latency - self._latency)
+            self._since_halved += 1
+            if self._latency > self._target_latency:
+                if self._since_halved >= self._window:
+                    floor = min(self._minimum, self._size)
+                    self._size = max(floor, self._size // 2)
+                    self._since_halved = 0
+            elif batch_len >= self._size:
+                self._size = min(
+                    self._maximum,
+                    self._size + max(1, self._size // 4),
+                )
+            logger.debug(
+                'upload latency %.3f, batch size %d',
+                self._latency,
+                self._size,
+            )
+
+    def resize(self, size):
+        '''
+        Shrink the size to the size suggested by an overloaded server.
+        A larger size is ignored, so that the server cannot make a
+        throttled client send more. The minimum does not apply, since it
+        only guards against halving on latency alone.
+        '''
+        with self._lock:
+            self._size = max(1, min(self._size, size))
+            logger.debug('batch size resized to %d', self._size)
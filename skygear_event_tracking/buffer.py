@@ -0,0 +1,116 @@
+from collections import deque
+from threading import Condition, Thread
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class WriteBehindBuffer(object):
+    '''
+    Bounded in-process buffer of events.
+    Flusher threads drain the buffer and pass the events to the writer
+    in batches of up to flush_size events, or whatever has arrived once
+    the oldest buffered event is flush_interval seconds old.
+    '''
+    def __init__(
+        self,
+        writer,
+        max_size=10000,
+        flush_size=500,
+        flush_interval=1.0,
+        num_flushers=2,
+    ):
+        self._writer = writer
+        self._max_size = max_size
+        self._flush_size = flush_size
+        self._flush_interval = flush_interval
+        # (arrived_at, event) pairs, so that the age of the oldest
+        # event is known after a partial batch is taken
+        self._events = deque()
+        self._cond = Condition()
+        self._running = True
+        self._flushers = []
+        for _ in range(num_flushers):
+            flusher = Thread(target=self._run_indefinitely, daemon=True)
+            flusher.start()
+            self._flushers.append(flusher)
+
+    def offer(self, events, timeout=0):
+        '''
+        Append all events to the buffer, waiting at most timeout seconds
+        for room, or indefinitely if timeout is None.
+        Return False without buffering anything if they do not fit.
+        '''
+        with self._cond:
+            if len(events) > self._max_size:
+                return False
+            fits = self._cond.wait_for(
+                lambda: (
+                    not self._running or
+                    len(self._events) + len(events) <= self._max_size
+                ),
+                timeout,
+            )
+            if not fits or not self._running:
+                return False
+            arrived_at = time.monotonic()
+            self._events.extend((arrived_at, event) for event in events)
+            self._cond.notify_all()
+            return True
+
+    def __len__(self):
+        with self._cond:
+            return len(self._events)
+
+    def _is_batch_ready(self):
+        if len(self._events) >= self._flush_size:
+            return True
+        if len(self._events) > 0 and not self._running:
+            return True
+        return False
+
+    def _wait_for_batch(self):
+        while self._running and not self._is_batch_ready():
+            if len(self._events) == 0:
+                self._cond.wait()
+                continue
+            deadline = self._events[0][0] + self._flush_interval
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            self._cond.wait(remaining)
+
+    def _take_batch(self):
+        with self._cond:
+            self._wait_for_batch()
+            batch = []
+            while len(self._events) > 0 and len(batch) < self._flush_size:
+                batch.append(self._events.popleft()[1])
+            if len(batch) > 0:
+                # wake up offers waiting for room
+                self._cond.notify_all()
+            return batch
+
+    def _run_indefinitely(self):
+        while True:
+            batch = self._take_batch()
+            if len(batch) == 0:
+                if not self._running:
+                    return
+                continue
+            try:
+                self._writer.process_events(batch)
+            except Exception:
+                logger.exception('failed to flush %d events', len(batch))
+
+    def close(self):
+        '''
+        Stop accepting events, and wait for the flushers to drain
+        the buffer
+        '''
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+        for flusher in self._flushers:
+            flusher.join()
@@ -0,0 +1,71 @@
+import csv
+import datetime
+import io
+import json
+import logging
+import math
+
+logger = logging.getLogger(__name__)
+
+
+def format_copy_value(value):
+    '''
+    Return the text representation of value understood by COPY
+    '''
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    elif isinstance(value, float):
+        if math.isnan(value):
+            return 'NaN'
+        if math.isinf(value):
+            return 'Infinity' if value > 0 else '-Infinity'
+        return repr(value)
+    elif isinstance(value, datetime.datetime):
+        return value.isoformat()
+    elif isinstance(value, dict):
+        return json.dumps(value, separators=(',', ':'))
+    return str(value)
+
+
+def make_csv_buffer(column_names, rows):
+    '''
+    Return an in-memory CSV buffer of rows suitable for COPY FROM STDIN.
+    Every value is quoted so that empty strings are not read as NULL.
+    '''
+    buf = io.StringIO()
+    writer = csv.writer(buf, quoting=csv.QUOTE_ALL, lineterminator='\n')
+    for row in rows:
+        writer.writerow([
+            format_copy_value(row[column_name])
+            for column_name in column_names
+        ])
+    buf.seek(0)
+    return buf
+
+
+def make_copy_statement(preparer, table, column_names):
+    return 'COPY {} ({}) FROM STDIN WITH (FORMAT csv)'.format(
+        preparer.format_table(table),
+        ', '.join(preparer.quote(c) for c in column_names),
+    )
+
+
+def copy_rows(conn, table, rows):
+    '''
+    Stream rows into table with COPY ... FROM STDIN.
+    All rows must have the same keys.
+    The COPY runs inside the current transaction of conn.
+    '''
+    column_names = sorted(rows[0].keys())
+    stmt = make_copy_statement(
+        conn.dialect.identifier_preparer,
+        table,
+        column_names,
+    )
+    buf = make_csv_buffer(column_names, rows)
+    logger.debug('copy table: %s, rows: %d', table.name, len(rows))
+    cursor = conn.connection.cursor()
+    try:
+        cursor.copy_expert(stmt, buf)
+    finally:
+        cursor.close()
@@ -1,92 +1,428 @@
-from queue import Queue, Full, Empty
-from requests import Session
-from threading import Thread
+from email.utils import parsedate_to_datetime
+from queue import Full, Empty
+from requests import HTTPError, Session
+from requests.adapters import HTTPAdapter
+from threading import Event, Lock, Thread
 from urllib.parse import urljoin
 import atexit
 import datetime
-import json
+import gzip
 import logging
+import os
+import time
+import uuid
+import weakref
+from .batching import AdaptiveBatchSize
+from .event_queue import DROP_NEWEST, ByteBoundedQueue
+from .sampling import Sampler
+from .serializer import (
+    EMPTY_BODY,
+    encode_event,
+    join_events,
+    make_request_body,
+)
+from .spool import Spool, claim_spool_directory, compute_backoff
 
+logger = logging.getLogger(__name__)
 
-class Client(object):
+
+# Clients of this process, for the fork hooks
+_clients = weakref.WeakSet()
+
+
+def _before_fork():
+    for client in list(_clients):
+        try:
+            client._before_fork()
+        except Exception:
+            logger.exception('before fork error')
+
+
+def _after_fork_in_child():
+    for client in list(_clients):
+        client._after_fork_in_child()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(
+        before=_before_fork,
+        after_in_child=_after_fork_in_child,
+    )
+
+
+def _is_retryable(error):
+    '''
+    Whether an upload that failed with error may succeed later.
+    A request rejected by the server, except for throttling, would be
+    rejected again.
+    '''
+    if isinstance(error, HTTPError) and error.response is not None:
+        status_code = error.response.status_code
+        if 400 <= status_code < 500 and status_code not in (408, 429):
+            return False
+    return True
+
+
+# Responses of an overloaded server, which may carry Retry-After and
+# X-Suggested-Batch-Size
+_THROTTLING_STATUS_CODES = (429, 503)
+
+
+def _parse_retry_after(value):
+    '''
+    Return the number of seconds of a Retry-After header, which is
+    either a number of seconds or a HTTP date, or None if it is invalid
+    '''
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at is None or retry_at.tzinfo is None:
+        return None
+    now = datetime.datetime.now(datetime.timezone.utc)
+    return max(0.0, (retry_at - now).total_seconds())
+
+
+def _parse_suggested_batch_size(value):
+    try:
+        size = int(value)
+    except (TypeError, ValueError):
+        return None
+    return size if size > 0 else None
+
+
+def _throttling_response(error):
+    '''
+    Return the response if error is a throttling response, or None
+    '''
+    if not isinstance(error, HTTPError) or error.response is None:
+        return None
+    if error.response.status_code not in _THROTTLING_STATUS_CODES:
+        return None
+    return error.response
+
+
+class ClientBase(object):
+    '''
+    Serialization shared by Client and AsyncClient.
+    Events are encoded when they are tracked, and queued as bytes.
+    Each event is stamped with a random _id, which is sent again when
+    the event is retried, so that the server can drop duplicates.
+    Subclasses set _sampler, _compress and _compress_min_size.
+    '''
+    def _make_event(self, event_name, user_id, attributes):
+        '''
+        Return the encoded event, or None if it is dropped by sampling
+        or rate limiting
+        '''
+        if not self._sampler.accept(event_name, user_id):
+            return None
+        return encode_event(
+            event_name,
+            user_id,
+            attributes,
+            datetime.datetime.utcnow(),
+            sample_rate=self._sampler.sample_rate(event_name),
+            event_id=str(uuid.uuid4()),
+        )
+
+    def _prepare_request_body(self, events):
+        return make_request_body(events)
+
+    def _encode_request_body(self, data):
+        '''
+        Return the bytes to upload and the headers describing them.
+        Bodies of at least compress_min_size bytes are gzipped if
+        compression is enabled.
+        '''
+        headers = {}
+        if self._compress and len(data) >= self._compress_min_size:
+            data = gzip.compress(data)
+            headers['Content-Encoding'] = 'gzip'
+        return data, headers
+
+
+class Client(ClientBase):
     def __init__(
         self,
         skygear_endpoint,
         mount_path='/skygear_event_tracking',
         max_queue_size=1000,
+        max_queue_bytes=8 * 1024 * 1024,
+        overflow=DROP_NEWEST,
+        block_timeout=None,
         upload_size=100,
         upload=True,
+        linger_ms=1000,
+        max_batch_bytes=1024 * 1024,
+        max_upload_size=1000,
+        target_latency_ms=500,
+        compress=False,
+        compress_min_size=1024,
+        spool_dir=None,
+        spool_max_bytes=64 * 1024 * 1024,
+        backoff_base=1.0,
+        backoff_max=300.0,
+        upload_workers=1,
+        pool_maxsize=None,
+        spool_pending_on_fork=False,
+        sample_rates=None,
+        rate_limits=None,
+        upload_timeout=15,
     ):
         self._log = logging.getLogger('skygear_event_tracking.Client')
         self._endpoint = urljoin(skygear_endpoint, mount_path)
-        self._worker = Thread(
-            target=self._run_indefinitely,
-            daemon=True
+        self._max_queue_size = max_queue_size
+        self._max_queue_bytes = max_queue_bytes
+        self._overflow = overflow
+        self._block_timeout = block_timeout
+        self._upload_enabled = upload
+        self._upload_timeout = upload_timeout
+        self._upload_workers = upload_workers
+        self._pool_maxsize = pool_maxsize or upload_workers
+        self._linger = linger_ms / 1000
+        self._max_batch_bytes = max_batch_bytes
+        self._max_upload_size = max_upload_size
+        self._target_latency = target_latency_ms / 1000
+        self._batch_size = AdaptiveBatchSize(
+            initial=upload_size,
+            maximum=self._max_upload_size,
+            target_latency=self._target_latency,
+        )
+        self._sampler = Sampler(sample_rates, rate_limits)
+        self._compress = compress
+        self._compress_min_size = compress_min_size
+        self._spool_dir = spool_dir
+        self._spool_max_bytes = spool_max_bytes
+        self._spool_pending_on_fork = spool_pending_on_fork
+        self._spool = None
+        if spool_dir is not None:
+            self._spool = Spool(spool_dir, max_bytes=spool_max_bytes)
+        self._backoff_base = backoff_base
+        self._backoff_max = backoff_max
+        # held while rebuilding the state in a forked child, so that
+        # threads of the child calling track() rebuild it only once
+        self._fork_lock = Lock()
+        self._setup()
+        if upload:
+            atexit.register(self._cleanup)
+        _clients.add(self)
+
+    def _setup(self):
+        '''
+        Create the per-process state, and start the workers if uploading
+        '''
+        # only one worker gathers a batch at a time, so that batches
+        # are filled one after another instead of split among workers
+        self._gather_lock = Lock()
+        # only one worker replays the spool, so that it is replayed in
+        # order
+        self._replay_lock = Lock()
+        self._backoff_lock = Lock()
+        # set on cleanup to interrupt workers waiting for a backoff
+        self._stopping = Event()
+        # the event that did not fit in the last batch
+        self._carry = None
+        self._failures = 0
+        self._next_attempt_at = 0.0
+        self._queue = ByteBoundedQueue(
+            max_bytes=self._max_queue_bytes,
+            max_items=self._max_queue_size,
+            overflow=self._overflow,
+            block_timeout=self._block_timeout,
         )
-        self._upload_size = upload_size
-        self._queue = Queue(max_queue_size)
         self._session = Session()
         self._session.headers.update({
             'Content-Type': 'application/json',
         })
-        if upload:
-            atexit.register(self._cleanup)
-            self._running = True
-            self._worker.start()
-        else:
-            self._running = False
+        # keep a connection alive per worker
+        adapter = HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=self._pool_maxsize,
+        )
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
+        self._workers = []
+        for _ in range(self._upload_workers):
+            self._workers.append(Thread(
+                target=self._run_indefinitely,
+                daemon=True
+            ))
+        self._running = self._upload_enabled
+        if self._upload_enabled:
+            for worker in self._workers:
+                worker.start()
+        # set last, so that other threads of a forked child do not use
+        # the state before it is rebuilt
+        self._pid = os.getpid()
 
-    def _sanitize_attributes(self, attributes):
-        if attributes is None:
-            return None
-        output = {}
-        for key in attributes:
-            if not isinstance(key, str):
-                continue
-            value = attributes[key]
-            if isinstance(value, str):
-                output[key] = value
-            elif isinstance(value, bool):
-                output[key] = value
-            elif isinstance(value, int):
-                output[key] = float(value)
-            elif isinstance(value, float):
-                output[key] = value
-        return output
-
-    def _serialize_event(self, event):
-        output = {}
-        for key in event:
-            value = event[key]
-            if isinstance(value, str):
-                output[key] = value
-            elif isinstance(value, bool):
-                output[key] = value
-            elif isinstance(value, int):
-                output[key] = float(value)
-            elif isinstance(value, float):
-                output[key] = value
-            elif isinstance(value, datetime.datetime):
-                output[key] = {
-                    '$type': 'date',
-                    '$date': value.isoformat() + 'Z',
-                }
-        return output
+    def _before_fork(self):
+        '''
+        Move the pending events to the spool if spool_pending_on_fork is
+        set, so that they are not lost if the parent stops uploading
+        after forking, as pre-fork servers often do
+        '''
+        if not self._spool_pending_on_fork or self._spool is None:
+            return
+        events = self._drain_queue()
+        if len(events) == 0:
+            return
+        self._log.debug('spool %d pending events before fork', len(events))
+        self._spool_events(events)
+        for _ in events:
+            self._queue.task_done()
 
-    def _prepare_request_body(self, events):
-        body = {
-            'events': [],
-        }
-        for event in events:
-            body['events'].append(self._serialize_event(event))
-        return json.dumps(body, separators=(',', ':'))
+    def _drain_queue(self):
+        events = []
+        while True:
+            try:
+                events.append(self._queue.get(block=False))
+            except Empty:
+                return events
+
+    def _after_fork_in_child(self):
+        '''
+        Rebuild the per-process state in a forked child.
+        Only the forking thread survives a fork, so the workers are gone
+        and locks may be held forever. Events inherited in the queue are
+        the parent's, which the parent uploads, so they are dropped.
+        The spool of the parent cannot be shared, so the child claims a
+        spool of its own in a subdirectory.
+        '''
+        with self._fork_lock:
+            if self._pid == os.getpid():
+                return
+            self._rebuild_in_child()
+
+    def _rebuild_in_child(self):
+        self._batch_size = AdaptiveBatchSize(
+            initial=self._batch_size.value,
+            maximum=self._max_upload_size,
+            target_latency=self._target_latency,
+        )
+        if self._spool is not None:
+            self._spool = Spool(
+                claim_spool_directory(self._spool_dir),
+                max_bytes=self._spool_max_bytes,
+            )
+        self._setup()
+
+    def _check_fork(self):
+        if self._pid != os.getpid():
+            self._after_fork_in_child()
 
     def _enqueue(self, event):
+        '''
+        Queue an encoded event. Events that are rejected or evicted by
+        the overflow policy go to the spool if it is enabled.
+        Spooled events are uploaded before the batches gathered after
+        them, but an event rejected by drop_newest or block may still be
+        uploaded after older events left in the queue, so events that
+        overflow are not guaranteed to arrive in order.
+        '''
         try:
-            self._queue.put(event, block=False)
-            return True
+            evicted = self._queue.put(event)
+            queued = True
         except Full:
-            return False
+            evicted = [event]
+            queued = False
+        if len(evicted) == 0 or self._spool is None:
+            return queued
+        return self._spool_events(evicted) or queued
+
+    def _spool_events(self, events):
+        '''
+        Append events to the spool as a single record, which is
+        the JSON array of the encoded events
+        '''
+        if self._spool.append(join_events(events)):
+            return True
+        self._log.warning('spool is full, dropping %d events', len(events))
+        return False
+
+    def _is_backing_off(self):
+        return time.monotonic() < self._next_attempt_at
+
+    def _on_upload_success(self):
+        with self._backoff_lock:
+            self._failures = 0
+            self._next_attempt_at = 0.0
+
+    def _on_upload_failure(self, error=None):
+        '''
+        Back off after a failed upload. If the server is throttling,
+        wait at least as long as its Retry-After, and shrink the batches
+        to its X-Suggested-Batch-Size.
+        '''
+        retry_after = None
+        response = _throttling_response(error)
+        if response is not None:
+            retry_after = _parse_retry_after(
+                response.headers.get('Retry-After'),
+            )
+            suggested_batch_size = _parse_suggested_batch_size(
+                response.headers.get('X-Suggested-Batch-Size'),
+            )
+            if suggested_batch_size is not None:
+                self._batch_size.resize(suggested_batch_size)
+        with self._backoff_lock:
+            delay = compute_backoff(
+                self._failures,
+                self._backoff_base,
+                self._backoff_max,
+            )
+            if retry_after is not None:
+                delay = max(delay, min(retry_after, self._backoff_max))
+            self._failures += 1
+            self._next_attempt_at = time.monotonic() + delay
+        self._log.info('backing off for %.1f seconds', delay)
+
+    def _wait_for_backoff(self):
+        '''
+        Wait until the backoff expires or the client is stopped
+        '''
+        while self._running:
+            remaining = self._next_attempt_at - time.monotonic()
+            if remaining <= 0:
+                return
+            self._stopping.wait(remaining)
+
+    def _replay_spool(self):
+        '''
+        Upload spooled records in order until the spool is empty or
+        an upload fails. Return immediately if another worker is
+        replaying.
+        '''
+        if not self._replay_lock.acquire(blocking=False):
+            return
+        try:
+            self._replay_spool_locked()
+        finally:
+            self._replay_lock.release()
+
+    def _replay_spool_locked(self):
+        while self._running and not self._is_backing_off():
+            payload = self._spool.peek()
+            if payload is None:
+                return
+            body = b'{"events":' + payload + b'}'
+            try:
+                self._post_body(body)
+            except Exception as e:
+                if _is_retryable(e):
+                    self._log.warning('replay error', exc_info=True)
+                    self._on_upload_failure(e)
+                    return
+                self._log.exception('dropping rejected spooled events')
+            else:
+                self._on_upload_success()
+            self._spool.commit()
 
     def _run_indefinitely(self):
         while self._running:
@@ -95,10 +431,12 @@ class Client(object):
     def _do_work_in_a_single_loop(self):
         self._log.debug('start uploading')
         events = self._gather_next_batch()
+        if self._spool is not None:
+            self._replay_spool()
         if len(events) <= 0:
             return
         try:
-            self._http_post(events)
+            self._upload(events)
         except Exception:
             self._log.exception('upload error')
         finally:
@@ -106,49 +444,166 @@ class Client(object):
                 self._queue.task_done()
         self._log.debug('end uploading')
 
+    def _upload(self, events):
+        '''
+        Upload events, or spool them if the spool is enabled and the
+        upload fails or the endpoint has failed recently.
+        While the spool is not empty, events are spooled behind the
+        events spooled before them, so that they are not uploaded first.
+        '''
+        if self._spool is None:
+            self._upload_holding(events)
+            return
+        if self._is_backing_off() or not self._spool.is_empty():
+            self._spool_events(events)
+            return
+        try:
+            self._http_post(events)
+        except Exception as e:
+            if not _is_retryable(e):
+                raise
+            self._log.warning('upload error, spooling', exc_info=True)
+            self._on_upload_failure(e)
+            self._spool_events(events)
+            return
+        self._on_upload_success()
+
+    def _upload_holding(self, events):
+        '''
+        Upload events without a spool. While the server is throttling,
+        hold them and upload them again once the backoff expires, so
+        that the queued events wait instead of being sent at full rate.
+        '''
+        while True:
+            self._wait_for_backoff()
+            try:
+                self._http_post(events)
+            except Exception as e:
+                if _throttling_response(e) is None or not self._running:
+                    raise
+                self._log.warning('server is throttling, holding events')
+                self._on_upload_failure(e)
+                continue
+            self._on_upload_success()
+            return
+
     def _http_post(self, events):
-        data = self._prepare_request_body(events)
+        start = time.monotonic()
+        self._post_body(self._prepare_request_body(events))
+        self._batch_size.record(time.monotonic() - start, len(events))
+
+    def _post_body(self, body):
+        data, headers = self._encode_request_body(body)
         response = self._session.post(
             self._endpoint,
             data=data,
-            timeout=15,
+            headers=headers,
+            timeout=self._upload_timeout,
         )
         response.raise_for_status()
 
+    def _next_event(self, deadline):
+        '''
+        Return the next event, waiting until deadline, or for a second
+        if deadline is None. Return None if there is none.
+        '''
+        if self._carry is not None:
+            event, self._carry = self._carry, None
+            return event
+        try:
+            if deadline is None:
+                return self._queue.get(block=True, timeout=1)
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                return self._queue.get(block=False)
+            return self._queue.get(block=True, timeout=timeout)
+        except Empty:
+            return None
+
     def _gather_next_batch(self):
+        '''
+        Gather events until the batch has the current batch size, or
+        its serialized size would exceed max_batch_bytes, or linger_ms
+        has passed since its first event and the queue is empty
+        '''
+        with self._gather_lock:
+            return self._gather_next_batch_locked()
+
+    def _gather_next_batch_locked(self):
         events = []
-        while len(events) < self._upload_size:
-            try:
-                event = self._queue.get(block=True, timeout=1)
-                events.append(event)
-            except Empty:
+        size = len(EMPTY_BODY)
+        max_events = self._batch_size.value
+        deadline = None
+        while len(events) < max_events:
+            event = self._next_event(deadline)
+            if event is None:
                 break
+            # with the separating comma
+            event_size = len(event) + 1
+            if len(events) > 0 and size + event_size > self._max_batch_bytes:
+                self._carry = event
+                break
+            if deadline is None:
+                deadline = time.monotonic() + self._linger
+            events.append(event)
+            size += event_size
         return events
 
     def _cleanup(self):
+        self._check_fork()
         self._running = False
-        try:
-            self._worker.join()
-        except RuntimeError:
-            pass
+        self._stopping.set()
+        for worker in self._workers:
+            try:
+                worker.join()
+            except RuntimeError:
+                pass
+        if self._spool is not None:
+            self._spool_pending()
+            self._spool.close()
+
+    def _spool_pending(self):
+        '''
+        Move the events not uploaded at exit to the spool, so that they
+        are replayed by the next process
+        '''
+        events = []
+        if self._carry is not None:
+            events.append(self._carry)
+            self._carry = None
+        events.extend(self._drain_queue())
+        if len(events) == 0:
+            return
+        self._log.debug('spool %d pending events at exit', len(events))
+        self._spool_events(events)
+        for _ in events:
+            self._queue.task_done()
 
     def track(self, event_name, user_id=None, attributes=None):
         if not event_name:
             return
-
-        event = {}
-        user_defined_attributes = self._sanitize_attributes(attributes)
-        if user_defined_attributes is not None:
-            event.update(user_defined_attributes)
-
-        event['_tracked_at'] = datetime.datetime.utcnow()
-        event['_event_raw'] = event_name
-        if user_id:
-            event['_user_id'] = user_id
-
+        # os.register_at_fork is not available before Python 3.7
+        self._check_fork()
+        event = self._make_event(event_name, user_id, attributes)
+        if event is None:
+            return False
         return self._enqueue(event)
 
+    def stats(self):
+        '''
+        Return the counters of the queue: the number of records and
+        bytes queued, and the number of records and bytes dropped by
+        the overflow policy, including those moved to the spool.
+        The numbers of events dropped by sampling and rate limiting are
+        included.
+        '''
+        self._check_fork()
+        stats = self._queue.stats()
+        stats.update(self._sampler.stats())
+        return stats
+
     def flush(self):
+        self._check_fork()
         if not self._running:
             return
         self._queue.join()
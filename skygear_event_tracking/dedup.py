@@ -0,0 +1,64 @@
+from collections import OrderedDict
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+def _key(event):
+    return (event.event_norm, event.attributes['_id'])
+
+
+class RecentEventIds(object):
+    '''
+    Bounded LRU of the _id of events written recently by this process,
+    keyed by (event_norm, _id) since an _id is only unique in the table
+    of its event.
+    Events whose key is in it are dropped before writing, so that a
+    request retried by a client is not written twice, without a round
+    trip to the database. IDs are remembered only once their events
+    are committed. With a maxsize of 0, only duplicates within a batch
+    are dropped.
+    '''
+    def __init__(self, maxsize=100000):
+        self._maxsize = maxsize
+        self._lock = threading.Lock()
+        self._ids = OrderedDict()
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._ids
+
+    def __len__(self):
+        with self._lock:
+            return len(self._ids)
+
+    def filter(self, events):
+        '''
+        Return the events whose _id has not been written recently,
+        dropping duplicates within events as well
+        '''
+        output = []
+        seen = set()
+        with self._lock:
+            for event in events:
+                key = _key(event)
+                if key in seen or key in self._ids:
+                    continue
+                seen.add(key)
+                output.append(event)
+        if len(output) < len(events):
+            logger.info(
+                'drop %d duplicate events',
+                len(events) - len(output),
+            )
+        return output
+
+    def add(self, events):
+        with self._lock:
+            for event in events:
+                key = _key(event)
+                self._ids.pop(key, None)
+                self._ids[key] = None
+            while len(self._ids) > self._maxsize:
+                self._ids.popitem(last=False)
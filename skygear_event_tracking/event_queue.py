@@ -0,0 +1,158 @@
+from collections import deque
+from queue import Empty, Full
+from threading import Condition, Lock
+import time
+
+DROP_NEWEST = 'drop_newest'
+DROP_OLDEST = 'drop_oldest'
+BLOCK = 'block'
+
+OVERFLOW_POLICIES = (DROP_NEWEST, DROP_OLDEST, BLOCK)
+
+
+class ByteBoundedQueue(object):
+    '''
+    FIFO of encoded records bounded by their total size in bytes and,
+    optionally, by their number.
+    When a record does not fit, the overflow policy decides:
+    drop_newest rejects it, drop_oldest evicts the oldest records to make
+    room, and block waits up to block_timeout seconds for room.
+    The interface follows queue.Queue, including task_done and join.
+    '''
+    def __init__(
+        self,
+        max_bytes,
+        max_items=0,
+        overflow=DROP_NEWEST,
+        block_timeout=None,
+    ):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError('unknown overflow policy: {}'.format(overflow))
+        self._max_bytes = max_bytes
+        self._max_items = max_items
+        self._overflow = overflow
+        self._block_timeout = block_timeout
+        self._records = deque()
+        self._lock = Lock()
+        self._not_empty = Condition(self._lock)
+        self._not_full = Condition(self._lock)
+        self._all_tasks_done = Condition(self._lock)
+        self._unfinished_tasks = 0
+        self._queued_bytes = 0
+        self._dropped_records = 0
+        self._dropped_bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'queued_records': len(self._records),
+                'queued_bytes': self._queued_bytes,
+                'dropped_records': self._dropped_records,
+                'dropped_bytes': self._dropped_bytes,
+            }
+
+    def qsize(self):
+        with self._lock:
+            return len(self._records)
+
+    def _fits(self, size):
+        if self._max_items > 0 and len(self._records) >= self._max_items:
+            return False
+        return self._queued_bytes + size <= self._max_bytes
+
+    def _drop(self, size):
+        self._dropped_records += 1
+        self._dropped_bytes += size
+
+    def _evict_oldest(self, size):
+        '''
+        Pop the oldest records until a record of size fits
+        '''
+        evicted = []
+        while len(self._records) > 0 and not self._fits(size):
+            record = self._records.popleft()
+            self._queued_bytes -= len(record)
+            self._drop(len(record))
+            self._task_done_locked()
+            evicted.append(record)
+        return evicted
+
+    def _wait_for_room(self, size):
+        if self._block_timeout is None:
+            while not self._fits(size):
+                self._not_full.wait()
+            return True
+        deadline = time.monotonic() + self._block_timeout
+        while not self._fits(size):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            self._not_full.wait(remaining)
+        return True
+
+    def put(self, record):
+        '''
+        Append a record.
+        Return the records evicted to make room for it, which are counted
+        as dropped. Raise queue.Full if the record is rejected.
+        '''
+        size = len(record)
+        with self._lock:
+            evicted = []
+            if size > self._max_bytes:
+                fits = False
+            elif self._fits(size):
+                fits = True
+            elif self._overflow == DROP_OLDEST:
+                evicted = self._evict_oldest(size)
+                fits = True
+            elif self._overflow == BLOCK:
+                fits = self._wait_for_room(size)
+            else:
+                fits = False
+            if not fits:
+                self._drop(size)
+                raise Full
+            self._records.append(record)
+            self._queued_bytes += size
+            self._unfinished_tasks += 1
+            self._not_empty.notify()
+            return evicted
+
+    def get(self, block=True, timeout=None):
+        with self._not_empty:
+            if not block:
+                if len(self._records) == 0:
+                    raise Empty
+            elif timeout is None:
+                while len(self._records) == 0:
+                    self._not_empty.wait()
+            else:
+                deadline = time.monotonic() + timeout
+                while len(self._records) == 0:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise Empty
+                    self._not_empty.wait(remaining)
+            record = self._records.popleft()
+            self._queued_bytes -= len(record)
+            self._not_full.notify()
+            return record
+
+    def get_nowait(self):
+        return self.get(block=False)
+
+    def _task_done_locked(self):
+        self._unfinished_tasks -= 1
+        if self._unfinished_tasks <= 0:
+            self._unfinished_tasks = 0
+            self._all_tasks_done.notify_all()
+
+    def task_done(self):
+        with self._lock:
+            self._task_done_locked()
+
+    def join(self):
+        with self._all_tasks_done:
+            while self._unfinished_tasks > 0:
+                self._all_tasks_done.wait()
@@ -1,11 +1,25 @@
 from skygear.utils.db import _get_engine
 from sqlalchemy import create_engine
+import atexit
+import math
 import os
 import posixpath
 import skygear
-import json
 import logging
-from .writer import Writer
+import threading
+from .buffer import WriteBehindBuffer
+from .indexes import DEFAULT_INDEX_POLICIES
+from .partition import PartitionScheme
+from .retention import RetentionPolicy, RetentionWorker
+from .stream import (
+    CONTENT_ENCODING_WBITS,
+    DEFAULT_MAX_VALUE_SIZE,
+    BodyTooLargeError,
+    DecompressingReader,
+    MalformedBodyError,
+    iter_json_events,
+)
+from .writer import ColumnBudget, Writer
 from .utils import EventTrackingRequest
 
 
@@ -13,33 +27,144 @@ logger = logging.getLogger(__name__)
 
 
 class Handler(object):
-    def __init__(self, writer):
+    '''
+    Handle requests of events.
+    When overloaded, the handler responds 429 if the write-behind buffer
+    is full, or 503 if max_in_flight requests are being written, with
+    Retry-After and, if suggested_batch_size is set,
+    X-Suggested-Batch-Size for clients to shrink their batches.
+    Events are written chunk by chunk as the body is parsed, so chunks
+    before a malformed or too large event have been written when the
+    handler responds 400 or 413. Clients do not retry these responses,
+    so the written events are not duplicated.
+    '''
+    def __init__(
+        self,
+        writer,
+        buffer=None,
+        retry_after=1,
+        chunk_size=500,
+        max_decompressed_size=64 * 1024 * 1024,
+        max_in_flight=None,
+        suggested_batch_size=None,
+        max_event_size=DEFAULT_MAX_VALUE_SIZE,
+    ):
         self._writer = writer
+        self._max_event_size = max_event_size
+        self._buffer = buffer
+        self._retry_after = retry_after
+        self._chunk_size = chunk_size
+        self._max_decompressed_size = max_decompressed_size
+        self._suggested_batch_size = suggested_batch_size
+        self._in_flight = None
+        if max_in_flight is not None:
+            self._in_flight = threading.BoundedSemaphore(max_in_flight)
+
+    def _overloaded(self, status):
+        headers = {
+            'Retry-After': str(int(math.ceil(self._retry_after))),
+        }
+        if self._suggested_batch_size is not None:
+            headers['X-Suggested-Batch-Size'] = str(
+                self._suggested_batch_size,
+            )
+        return skygear.Response(status=status, headers=headers)
 
     def __call__(self, request):
+        if self._in_flight is None:
+            return self._handle(request)
+        if not self._in_flight.acquire(blocking=False):
+            logger.warning('too many requests in flight')
+            return self._overloaded(503)
+        try:
+            return self._handle(request)
+        finally:
+            self._in_flight.release()
+
+    def _handle(self, request):
         # extract useful http headers
         ips = request.headers.get('x-forwarded-for')
+        content_encoding = request.headers.get('content-encoding', '')
+        content_encoding = content_encoding.strip().lower()
 
-        # parse body
-        bytes = request.get_data()
-        json_str = bytes.decode('utf-8')
-        parsed = json.loads(json_str)
+        stream = request.stream
+        if content_encoding in CONTENT_ENCODING_WBITS:
+            stream = DecompressingReader(
+                stream,
+                content_encoding,
+                self._max_decompressed_size,
+            )
+        elif content_encoding not in ('', 'identity'):
+            logger.warning('unsupported encoding: %s', content_encoding)
+            return skygear.Response(status=415)
 
-        events = parsed['events']
+        # parse body lazily, events are materialized chunk by chunk
         event_tracking_request = EventTrackingRequest(
             http_header_ips=ips,
-            json_events=events,
+            json_events=iter_json_events(
+                stream,
+                max_value_size=self._max_event_size,
+            ),
+            chunk_size=self._chunk_size,
         )
-        logger.debug('event_tracking_request: %s', event_tracking_request)
-        self._writer.process_request(event_tracking_request)
+        try:
+            if self._buffer is None:
+                self._writer.process_request(event_tracking_request)
+            elif not self._offer(event_tracking_request):
+                logger.warning('write-behind buffer is full')
+                return self._overloaded(429)
+        except MalformedBodyError:
+            logger.warning('malformed request body', exc_info=True)
+            return skygear.Response(status=400)
+        except BodyTooLargeError:
+            logger.warning('request body too large', exc_info=True)
+            return skygear.Response(status=413)
         return skygear.Response(status=200)
 
+    def _offer(self, event_tracking_request):
+        '''
+        Offer the request to the buffer chunk by chunk.
+        The request is rejected only if its first chunk does not fit.
+        Once part of it is buffered, wait for room for the rest instead,
+        as the client would resend the buffered part on rejection.
+        '''
+        timeout = 0
+        for events in event_tracking_request.iter_chunks():
+            if not self._buffer.offer(events, timeout=timeout):
+                return False
+            timeout = None
+        return True
+
 
 def register_handler(
     endpoint_mount_path='/skygear_event_tracking',
     db_table_prefix='et_',
     db_schema=None,
     db_connection_uri=None,
+    bulk_load_threshold=None,
+    write_behind=False,
+    write_behind_buffer_size=10000,
+    write_behind_flush_size=500,
+    write_behind_flush_interval=1.0,
+    write_behind_flushers=2,
+    partition_by=None,
+    partition_interval='month',
+    partitions_ahead=2,
+    partitions_behind=2,
+    retention=None,
+    retention_interval=3600,
+    retention_batch_size=10000,
+    hourly_rollup=False,
+    index_policies=DEFAULT_INDEX_POLICIES,
+    max_columns=None,
+    column_allowlist=None,
+    request_chunk_size=500,
+    max_decompressed_body_size=64 * 1024 * 1024,
+    max_event_size=DEFAULT_MAX_VALUE_SIZE,
+    max_requests_in_flight=None,
+    retry_after=None,
+    suggested_batch_size=None,
+    recent_event_ids_size=100000,
 ):
     '''
     Register a skygear handler to receive events
@@ -59,6 +184,121 @@ def register_handler(
         It must be a standard postgresql uri. If the value is None, the uri
         is derived from the environment variable 'DATABASE_URL'
 
+    :param bulk_load_threshold: the minimum number of events in a group
+        that are loaded with COPY instead of INSERT. If the value is None,
+        COPY is never used. COPY cannot skip duplicate events, so it is
+        not used on tables with a primary key on _id.
+
+    :param write_behind: if True, the handler responds as soon as the
+        events are parsed and buffered in memory, and flusher threads
+        write them to the database in batches. Events still in the buffer
+        are lost if the process is killed.
+
+    :param write_behind_buffer_size: the maximum number of events in the
+        write-behind buffer. When the buffer is full, the handler responds
+        429 with Retry-After.
+
+    :param write_behind_flush_size: the maximum number of events
+        written by a flusher at a time.
+
+    :param write_behind_flush_interval: the maximum number of seconds an
+        event waits in the buffer for a full batch.
+
+    :param write_behind_flushers: the number of flusher threads.
+
+    :param partition_by: either '_received_at' or '_tracked_at'. If set,
+        new event tables are created as range-partitioned tables on this
+        column. Existing tables are not converted. Requires PostgreSQL 11
+        or later. If the value is None, tables are not partitioned.
+
+    :param partition_interval: either 'day' or 'month', the range of
+        a single partition.
+
+    :param partitions_ahead: the number of partitions after the current
+        one that the writer creates ahead of time.
+
+    :param partitions_behind: the number of partitions before the
+        current one that the writer creates for late events. Events
+        outside of the partitions created, e.g. from a client with a
+        wrong clock, are written to the default partition.
+
+    :param retention: a dict from event name to the number of days its
+        events are kept, e.g. {'heartbeat': 30, 'page_*': 90, '*': 365}.
+        A name ending with '*' matches events by prefix. Events not
+        matched by any rule are kept forever. If the value is None,
+        retention is disabled.
+
+    :param retention_interval: the number of seconds between two
+        retention runs.
+
+    :param retention_batch_size: the maximum number of rows deleted in
+        a single transaction from an unpartitioned table.
+
+    :param hourly_rollup: if True, the writer maintains the table
+        <db_table_prefix>__rollup_hourly with the number of events and
+        a sketch of distinct users per event and hour. Run
+        `python -m skygear_event_tracking rebuild-rollup` to backfill it.
+
+    :param index_policies: a list of IndexPolicy applied to event tables
+        when they are created. The default is a primary key on _id, a BRIN
+        index on _received_at and a btree index on (_user_id, _tracked_at).
+        On tables partitioned by _tracked_at, which may be NULL, the
+        primary key is not created.
+        Run `python -m skygear_event_tracking provision-indexes` to create
+        them on existing tables. Set this to an empty list to disable.
+
+    :param max_columns: the maximum number of columns per event table for
+        user defined attributes. Attributes beyond the budget are stored
+        in the _extra JSONB column instead of adding a column. If the
+        value is None, the number of columns is unlimited.
+
+    :param column_allowlist: a list of user defined attribute names that
+        may get their own column. Other attributes are stored in the
+        _extra JSONB column. If the value is None, all attributes may
+        get their own column.
+
+    :param request_chunk_size: the number of events of a request that are
+        parsed before they are written, or offered to the write-behind
+        buffer. The request body is parsed incrementally, so the memory
+        used by a request is bounded by this rather than its size.
+        A request is not written atomically: if a malformed event is
+        found, the handler responds 400 after writing the chunks before
+        it. Clients do not retry a 400, so those events are not written
+        twice.
+
+    :param max_decompressed_body_size: the maximum number of bytes a body
+        sent with Content-Encoding gzip or deflate may decompress to.
+        The handler responds 413 when it is exceeded, after writing the
+        events parsed so far.
+
+    :param max_event_size: the maximum number of characters of a single
+        event in the JSON body. The handler responds 413 to an event
+        larger than this, after writing the events parsed so far.
+
+    :param max_requests_in_flight: the maximum number of requests written
+        to the database at the same time when write_behind is False.
+        The handler responds 503 with Retry-After to requests beyond
+        it. If the value is None, the number is unlimited.
+
+    :param retry_after: the number of seconds in Retry-After of 429 and
+        503 responses, rounded up to an integer. If the value is None, it
+        is the flush interval when write_behind is True, and 1 otherwise.
+
+    :param suggested_batch_size: the maximum number of events per
+        request that clients are asked to send, in X-Suggested-Batch-Size
+        of 429 and 503 responses. Clients only shrink their batches to
+        it. If the value is None, the header is not sent.
+
+    :param recent_event_ids_size: the number of _id of written events
+        remembered by the writer, so that events of a request retried by
+        a client are dropped without writing them again. Events whose
+        _id is in the table are skipped as well if the primary key of
+        the table is exactly (_id). The primary key of a partitioned
+        table also has the partition column, so partitioned tables rely
+        on these IDs only, which are neither shared between processes
+        nor kept across restarts. Set this to 0 to rely on the primary
+        key only.
+
     :returns: the callable handler. Normally you do not need care about this
         value.
     '''
@@ -71,13 +311,78 @@ def register_handler(
         app_name = os.environ['APP_NAME']
         db_schema = 'app_' + app_name
 
+    if partition_by is None:
+        partition_scheme = None
+    else:
+        partition_scheme = PartitionScheme(
+            column=partition_by,
+            interval=partition_interval,
+            ahead=partitions_ahead,
+            behind=partitions_behind,
+        )
+
+    column_budget = None
+    if max_columns is not None or column_allowlist is not None:
+        column_budget = ColumnBudget(
+            max_columns=max_columns,
+            allowlist=column_allowlist,
+        )
+
     writer = Writer(
         engine=engine,
         schema=db_schema,
         table_prefix=db_table_prefix,
+        bulk_load_threshold=bulk_load_threshold,
+        partition_scheme=partition_scheme,
+        hourly_rollup=hourly_rollup,
+        index_policies=index_policies,
+        column_budget=column_budget,
+        recent_ids_size=recent_event_ids_size,
     )
 
-    handler = Handler(writer)
+    if retention is not None:
+        retention_worker = RetentionWorker(
+            engine=engine,
+            schema=db_schema,
+            table_prefix=db_table_prefix,
+            policy=RetentionPolicy(retention),
+            partition_scheme=partition_scheme,
+            interval=retention_interval,
+            batch_size=retention_batch_size,
+        )
+        retention_worker.start()
+        atexit.register(retention_worker.stop)
+
+    if write_behind:
+        if retry_after is None:
+            retry_after = max(1, write_behind_flush_interval)
+        buffer = WriteBehindBuffer(
+            writer,
+            max_size=write_behind_buffer_size,
+            flush_size=write_behind_flush_size,
+            flush_interval=write_behind_flush_interval,
+            num_flushers=write_behind_flushers,
+        )
+        atexit.register(buffer.close)
+        handler = Handler(
+            writer,
+            buffer=buffer,
+            retry_after=retry_after,
+            chunk_size=min(request_chunk_size, write_behind_buffer_size),
+            max_decompressed_size=max_decompressed_body_size,
+            suggested_batch_size=suggested_batch_size,
+            max_event_size=max_event_size,
+        )
+    else:
+        handler = Handler(
+            writer,
+            retry_after=1 if retry_after is None else retry_after,
+            chunk_size=request_chunk_size,
+            max_decompressed_size=max_decompressed_body_size,
+            max_in_flight=max_requests_in_flight,
+            suggested_batch_size=suggested_batch_size,
+            max_event_size=max_event_size,
+        )
 
     no_slash = endpoint_mount_path.rstrip('/')
     has_slash = posixpath.join(no_slash, '')
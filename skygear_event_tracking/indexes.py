@@ -0,0 +1,375 @@
+from sqlalchemy import MetaData, Table, text
+import logging
+from .rollup import compute_rollup_table_name
+from .schema_cache import (
+    fetch_table_version,
+    list_partitions,
+    list_tables,
+    reflect_table,
+)
+from .utils import fit_identifier
+
+logger = logging.getLogger(__name__)
+
+
+_HAS_PRIMARY_KEY_SQL = text('''
+SELECT EXISTS (
+    SELECT 1 FROM pg_catalog.pg_index i
+    WHERE i.indrelid = :oid AND i.indisprimary
+)
+''')
+
+
+# Whether an index of the partition is attached to the parent index
+_HAS_ATTACHED_INDEX_SQL = text('''
+SELECT EXISTS (
+    SELECT 1 FROM pg_catalog.pg_inherits h
+    JOIN pg_catalog.pg_class parent ON parent.oid = h.inhparent
+    JOIN pg_catalog.pg_namespace n ON n.oid = parent.relnamespace
+    JOIN pg_catalog.pg_index i ON i.indexrelid = h.inhrelid
+    JOIN pg_catalog.pg_class t ON t.oid = i.indrelid
+    WHERE n.nspname = :schema AND parent.relname = :parent_index_name
+    AND t.relname = :partition_name
+)
+''')
+
+
+class IndexPolicy(object):
+    '''
+    Describe an index that event tables should have.
+    The index is only created on tables that have all of its columns.
+    '''
+    def __init__(self, name, columns, method='btree', primary=False):
+        self.name = name
+        self.columns = list(columns)
+        self.method = method
+        self.primary = primary
+
+    def index_name(self, table_name):
+        # Column names never contain two consecutive underscores
+        return fit_identifier(table_name, '__' + self.name)
+
+    def not_null_check_name(self, table_name):
+        return fit_identifier(table_name, '__' + self.name + '_not_null')
+
+    def is_applicable(self, column_names):
+        for column_name in self.columns:
+            if column_name not in column_names:
+                return False
+        return True
+
+    def key_columns(self, partition_column=None):
+        '''
+        Return the columns of the index. A primary key of a partitioned
+        table must include the partition column.
+        '''
+        columns = list(self.columns)
+        if self.primary and partition_column is not None:
+            if partition_column not in columns:
+                columns.append(partition_column)
+        return columns
+
+
+# Columns the writer sets on every event, which are never NULL
+NOT_NULL_COLUMNS = frozenset(['_id', '_event_norm', '_received_at'])
+
+
+DEFAULT_INDEX_POLICIES = (
+    IndexPolicy('pkey', ['_id'], primary=True),
+    IndexPolicy('received_at', ['_received_at'], method='brin'),
+    IndexPolicy('user_id_tracked_at', ['_user_id', '_tracked_at']),
+)
+
+
+def _format_columns(preparer, columns):
+    return ', '.join(preparer.quote(c) for c in columns)
+
+
+def make_create_index_statement(
+    preparer,
+    table,
+    policy,
+    partition_column=None,
+    concurrently=False,
+    only=False,
+    index_name=None,
+):
+    if index_name is None:
+        index_name = policy.index_name(table.name)
+    return 'CREATE {}INDEX {}IF NOT EXISTS {} ON {}{} USING {} ({})'.format(
+        'UNIQUE ' if policy.primary else '',
+        'CONCURRENTLY ' if concurrently else '',
+        preparer.quote(index_name),
+        'ONLY ' if only else '',
+        preparer.format_table(table),
+        policy.method,
+        _format_columns(preparer, policy.key_columns(partition_column)),
+    )
+
+
+def make_add_primary_key_statement(
+    preparer,
+    table,
+    policy,
+    partition_column=None,
+    using_index=False,
+):
+    index_name = preparer.quote(policy.index_name(table.name))
+    if using_index:
+        constraint = 'PRIMARY KEY USING INDEX {}'.format(index_name)
+    else:
+        constraint = 'PRIMARY KEY ({})'.format(_format_columns(
+            preparer,
+            policy.key_columns(partition_column),
+        ))
+    return 'ALTER TABLE {} ADD CONSTRAINT {} {}'.format(
+        preparer.format_table(table),
+        index_name,
+        constraint,
+    )
+
+
+def make_not_null_check_statements(preparer, table, policy):
+    '''
+    Return statements that prove the key columns of policy NOT NULL
+    with a validated CHECK constraint. VALIDATE CONSTRAINT does not
+    block writes, and with it PRIMARY KEY USING INDEX skips the scan
+    it would otherwise do under an ACCESS EXCLUSIVE lock.
+    '''
+    formatted_table = preparer.format_table(table)
+    check_name = preparer.quote(policy.not_null_check_name(table.name))
+    condition = ' AND '.join(
+        '{} IS NOT NULL'.format(preparer.quote(c)) for c in policy.columns
+    )
+    return [
+        'ALTER TABLE {} DROP CONSTRAINT IF EXISTS {}'.format(
+            formatted_table,
+            check_name,
+        ),
+        'ALTER TABLE {} ADD CONSTRAINT {} CHECK ({}) NOT VALID'.format(
+            formatted_table,
+            check_name,
+            condition,
+        ),
+        'ALTER TABLE {} VALIDATE CONSTRAINT {}'.format(
+            formatted_table,
+            check_name,
+        ),
+    ]
+
+
+def make_drop_not_null_check_statement(preparer, table, policy):
+    return 'ALTER TABLE {} DROP CONSTRAINT IF EXISTS {}'.format(
+        preparer.format_table(table),
+        preparer.quote(policy.not_null_check_name(table.name)),
+    )
+
+
+def can_be_primary_key(policy, partition_column=None):
+    '''
+    Whether policy can be the primary key of a table partitioned on
+    partition_column. A primary key forces its columns NOT NULL, so
+    the partition column is only added to it if the writer always
+    sets it; otherwise events without it could not be inserted.
+    '''
+    if partition_column is None or partition_column in policy.columns:
+        return True
+    return partition_column in NOT_NULL_COLUMNS
+
+
+def create_indexes(conn, table, policies, partition_column=None):
+    '''
+    Create indexes of policies on a newly created table in the current
+    transaction. Indexes on a partitioned parent are created on every
+    partition by PostgreSQL.
+    '''
+    preparer = conn.dialect.identifier_preparer
+    column_names = set(table.columns.keys())
+    for policy in policies:
+        if not policy.is_applicable(column_names):
+            continue
+        if policy.primary and \
+                not can_be_primary_key(policy, partition_column):
+            logger.info(
+                'skip primary key %s of %s, as %s may be NULL',
+                policy.name,
+                table.name,
+                partition_column,
+            )
+            continue
+        if policy.primary:
+            stmt = make_add_primary_key_statement(
+                preparer,
+                table,
+                policy,
+                partition_column=partition_column,
+            )
+        else:
+            stmt = make_create_index_statement(preparer, table, policy)
+        logger.debug('create index: %s', stmt)
+        conn.execute(stmt)
+
+
+class IndexProvisioner(object):
+    '''
+    Retrofit index policies to existing event tables with
+    CREATE INDEX CONCURRENTLY, so that writers are not blocked.
+    For partitioned tables, the index is created concurrently on each
+    partition without one and then attached to an index on the parent.
+    Primary keys of partitioned tables are not retrofitted.
+    '''
+    def __init__(
+        self,
+        engine,
+        schema,
+        table_prefix,
+        policies=DEFAULT_INDEX_POLICIES,
+    ):
+        self._engine = engine
+        self._schema = schema
+        self._table_prefix = table_prefix
+        self._policies = policies
+
+    def run(self):
+        rollup_table_name = compute_rollup_table_name(self._table_prefix)
+        conn = self._engine.connect().execution_options(
+            isolation_level='AUTOCOMMIT',
+        )
+        try:
+            for table_name, _ in list_tables(conn, self._schema):
+                if not table_name.startswith(self._table_prefix):
+                    continue
+                if table_name == rollup_table_name:
+                    continue
+                self._provision_table(conn, table_name)
+        finally:
+            conn.close()
+
+    def _provision_table(self, conn, table_name):
+        version = fetch_table_version(conn, self._schema, table_name)
+        if version is None:
+            return
+        table = reflect_table(conn, self._schema, table_name, version)
+        column_names = set(table.columns.keys())
+        for policy in self._policies:
+            if not policy.is_applicable(column_names):
+                continue
+            logger.info('provision index %s on %s', policy.name, table_name)
+            if table.info['partitioned']:
+                self._provision_partitioned(conn, table, policy)
+                continue
+            try:
+                if policy.primary:
+                    self._provision_primary_key(conn, table, version, policy)
+                else:
+                    self._provision_index(conn, table, policy)
+            except Exception:
+                logger.exception('failed to provision index %s', policy.name)
+                index_name = policy.index_name(table.name)
+                self._drop_invalid_index(conn, table.schema, index_name)
+
+    def _provision_index(self, conn, table, policy):
+        preparer = conn.dialect.identifier_preparer
+        conn.execute(make_create_index_statement(
+            preparer,
+            table,
+            policy,
+            concurrently=True,
+        ))
+
+    def _provision_primary_key(self, conn, table, version, policy):
+        has_primary_key = conn.execute(
+            _HAS_PRIMARY_KEY_SQL,
+            oid=version[0],
+        ).scalar()
+        if has_primary_key:
+            return
+        self._provision_index(conn, table, policy)
+        preparer = conn.dialect.identifier_preparer
+        for stmt in make_not_null_check_statements(preparer, table, policy):
+            conn.execute(stmt)
+        conn.execute(make_add_primary_key_statement(
+            preparer,
+            table,
+            policy,
+            using_index=True,
+        ))
+        conn.execute(make_drop_not_null_check_statement(
+            preparer,
+            table,
+            policy,
+        ))
+
+    def _provision_partitioned(self, conn, table, policy):
+        '''
+        Create the parent index, then index and attach the partitions
+        that have no index attached to it yet. Partitions of a table
+        created by the writer are indexed by PostgreSQL already, under
+        names of its own.
+        '''
+        if policy.primary:
+            logger.warning(
+                'primary key of partitioned table %s is not retrofitted',
+                table.name,
+            )
+            return
+        preparer = conn.dialect.identifier_preparer
+        try:
+            conn.execute(make_create_index_statement(
+                preparer,
+                table,
+                policy,
+                only=True,
+            ))
+        except Exception:
+            logger.exception('failed to provision index %s', policy.name)
+            return
+        for partition_name in list_partitions(conn, table.schema, table.name):
+            has_attached_index = conn.execute(
+                _HAS_ATTACHED_INDEX_SQL,
+                schema=table.schema,
+                parent_index_name=policy.index_name(table.name),
+                partition_name=partition_name,
+            ).scalar()
+            if has_attached_index:
+                continue
+            self._provision_partition(conn, table, policy, partition_name)
+
+    def _provision_partition(self, conn, table, policy, partition_name):
+        preparer = conn.dialect.identifier_preparer
+        partition = Table(partition_name, MetaData(), schema=table.schema)
+        partition_index_name = policy.index_name(partition_name)
+        try:
+            conn.execute(make_create_index_statement(
+                preparer,
+                partition,
+                policy,
+                concurrently=True,
+            ))
+            conn.execute('ALTER INDEX {}.{} ATTACH PARTITION {}.{}'.format(
+                preparer.quote_schema(table.schema),
+                preparer.quote(policy.index_name(table.name)),
+                preparer.quote_schema(table.schema),
+                preparer.quote(partition_index_name),
+            ))
+        except Exception:
+            logger.exception(
+                'failed to provision index %s on %s',
+                policy.name,
+                partition_name,
+            )
+            self._drop_invalid_index(conn, table.schema, partition_index_name)
+
+    def _drop_invalid_index(self, conn, schema, index_name):
+        '''
+        A failed CREATE INDEX CONCURRENTLY leaves an invalid index
+        behind, which IF NOT EXISTS would skip on the next run
+        '''
+        preparer = conn.dialect.identifier_preparer
+        try:
+            conn.execute('DROP INDEX CONCURRENTLY IF EXISTS {}.{}'.format(
+                preparer.quote_schema(schema),
+                preparer.quote(index_name),
+            ))
+        except Exception:
+            logger.exception('failed to drop index %s', index_name)
@@ -0,0 +1,171 @@
+import datetime
+from sqlalchemy.schema import CreateTable
+from .utils import fit_identifier
+
+
+PARTITION_COLUMNS = ('_received_at', '_tracked_at')
+PARTITION_INTERVALS = ('day', 'month')
+
+# Event norms never contain two consecutive underscores, so partition
+# names cannot collide with tables of other events.
+PARTITION_SEPARATOR = '__p'
+DEFAULT_PARTITION_SUFFIX = '__default'
+
+
+class PartitionScheme(object):
+    '''
+    Declarative range partitioning of event tables on a timestamp column,
+    with one partition per day or per month.
+    Partitions are created ahead of time by the writer. Partitions are
+    only created from behind partitions before the current one to ahead
+    partitions after it, so that a client with a wrong clock cannot
+    create partitions without bound; other rows go to the default
+    partition.
+    '''
+    def __init__(
+        self,
+        column='_received_at',
+        interval='month',
+        ahead=2,
+        behind=2,
+    ):
+        if column not in PARTITION_COLUMNS:
+            raise ValueError('cannot partition by: ' + str(column))
+        if interval not in PARTITION_INTERVALS:
+            raise ValueError('unknown partition interval: ' + str(interval))
+        self.column = column
+        self.interval = interval
+        self.ahead = ahead
+        self.behind = behind
+
+    def floor(self, dt):
+        '''
+        Return the start of the partition that contains dt
+        '''
+        if self.interval == 'day':
+            return datetime.datetime(dt.year, dt.month, dt.day)
+        return datetime.datetime(dt.year, dt.month, 1)
+
+    def previous_start(self, start):
+        '''
+        Return the start of the partition before the one starting at start
+        '''
+        return self.floor(start - datetime.timedelta(days=1))
+
+    def next_start(self, start):
+        '''
+        Return the start of the partition after the one starting at start
+        '''
+        if self.interval == 'day':
+            return start + datetime.timedelta(days=1)
+        if start.month == 12:
+            return datetime.datetime(start.year + 1, 1, 1)
+        return datetime.datetime(start.year, start.month + 1, 1)
+
+    def _date_format(self):
+        return '%Y%m%d' if self.interval == 'day' else '%Y%m'
+
+    def partition_name(self, table_name, start):
+        '''
+        Return the name of a partition, which keeps the date suffix even
+        if table_name has to be shortened to fit an identifier
+        '''
+        suffix = PARTITION_SEPARATOR + start.strftime(self._date_format())
+        return fit_identifier(table_name, suffix)
+
+    def parse_partition_start(self, table_name, partition_name):
+        '''
+        Return the start of a partition from its name, or None if it is
+        not a range partition of table_name
+        '''
+        # the dates of a format have the same length
+        example = self.partition_name(
+            table_name,
+            datetime.datetime(2000, 1, 1),
+        )
+        prefix = example[:example.rindex(PARTITION_SEPARATOR)]
+        prefix += PARTITION_SEPARATOR
+        if not partition_name.startswith(prefix):
+            return None
+        suffix = partition_name[len(prefix):]
+        try:
+            return datetime.datetime.strptime(suffix, self._date_format())
+        except ValueError:
+            return None
+
+    def compute_starts(self, values, now):
+        '''
+        Return the set of partition starts needed for values within the
+        window around now, together with the partitions ahead of now
+        '''
+        current = self.floor(now)
+        first = current
+        for _ in range(self.behind):
+            first = self.previous_start(first)
+        starts = set()
+        start = current
+        for _ in range(self.ahead + 1):
+            starts.add(start)
+            start = self.next_start(start)
+        for value in values:
+            if not isinstance(value, datetime.datetime):
+                continue
+            start = self.floor(value)
+            if first <= start < self.next_start(max(starts)):
+                starts.add(start)
+        return starts
+
+
+def default_partition_name(table_name):
+    return fit_identifier(table_name, DEFAULT_PARTITION_SUFFIX)
+
+
+def make_create_partitioned_table_statement(dialect, table, column_name):
+    '''
+    Return a CREATE TABLE statement of a range-partitioned parent table
+    '''
+    ddl = str(CreateTable(table).compile(dialect=dialect)).rstrip()
+    return '{} PARTITION BY RANGE ({})'.format(
+        ddl,
+        dialect.identifier_preparer.quote(column_name),
+    )
+
+
+def _format_partition_name(dialect, table, partition_name):
+    preparer = dialect.identifier_preparer
+    return '{}.{}'.format(
+        preparer.quote_schema(table.schema),
+        preparer.quote(partition_name),
+    )
+
+
+def make_create_partition_statement(dialect, table, scheme, start):
+    '''
+    Return an idempotent statement that creates the partition of table
+    starting at start
+    '''
+    preparer = dialect.identifier_preparer
+    partition_name = scheme.partition_name(table.name, start)
+    end = scheme.next_start(start)
+    return (
+        'CREATE TABLE IF NOT EXISTS {} PARTITION OF {} '
+        'FOR VALUES FROM (\'{}\') TO (\'{}\')'
+    ).format(
+        _format_partition_name(dialect, table, partition_name),
+        preparer.format_table(table),
+        start.isoformat(' '),
+        end.isoformat(' '),
+    )
+
+
+def make_create_default_partition_statement(dialect, table):
+    '''
+    Return an idempotent statement that creates the default partition of
+    table, which holds rows without a value in the partition column, or
+    with a value outside of the partitions created
+    '''
+    partition_name = default_partition_name(table.name)
+    return 'CREATE TABLE IF NOT EXISTS {} PARTITION OF {} DEFAULT'.format(
+        _format_partition_name(dialect, table, partition_name),
+        dialect.identifier_preparer.format_table(table),
+    )
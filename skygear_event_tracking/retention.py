@@ -0,0 +1,237 @@
+from sqlalchemy import text
+from threading import Event, Thread
+import datetime
+import logging
+from .partition import default_partition_name
+from .rollup import compute_rollup_table_name
+from .schema_cache import list_partitions, list_tables
+from .utils import sanitize_for_db
+from .writer import compute_advisory_lock_key
+
+logger = logging.getLogger(__name__)
+
+
+_TRY_LOCK_SQL = text('SELECT pg_try_advisory_lock(:key)')
+_UNLOCK_SQL = text('SELECT pg_advisory_unlock(:key)')
+
+
+class RetentionPolicy(object):
+    '''
+    Map event names to the number of days their events are kept.
+    A rule ending with '*' matches every event whose name starts with
+    the rest of the rule. An exact rule wins over a prefix rule, and
+    a longer prefix wins over a shorter one.
+    '''
+    def __init__(self, rules):
+        self._exact = {}
+        self._prefixes = []
+        for name, days in rules.items():
+            if name.endswith('*'):
+                prefix = name[:-1]
+                if prefix:
+                    prefix = sanitize_for_db(prefix)
+                self._prefixes.append((prefix, days))
+            else:
+                self._exact[sanitize_for_db(name)] = days
+        self._prefixes.sort(key=lambda rule: len(rule[0]), reverse=True)
+
+    def days_for(self, event_norm):
+        '''
+        Return the number of days to keep, or None to keep forever
+        '''
+        if event_norm in self._exact:
+            return self._exact[event_norm]
+        for prefix, days in self._prefixes:
+            if event_norm.startswith(prefix):
+                return days
+        return None
+
+
+def find_expired_partitions(scheme, table_name, partition_names, cutoff):
+    '''
+    Return names of partitions of table_name whose whole range is
+    older than cutoff
+    '''
+    output = []
+    for partition_name in sorted(partition_names):
+        start = scheme.parse_partition_start(table_name, partition_name)
+        if start is None:
+            continue
+        if scheme.next_start(start) <= cutoff:
+            output.append(partition_name)
+    return output
+
+
+def make_drop_partition_statements(preparer, schema, table_name, name):
+    parent = '{}.{}'.format(
+        preparer.quote_schema(schema),
+        preparer.quote(table_name),
+    )
+    child = '{}.{}'.format(
+        preparer.quote_schema(schema),
+        preparer.quote(name),
+    )
+    return [
+        'ALTER TABLE {} DETACH PARTITION {}'.format(parent, child),
+        'DROP TABLE {}'.format(child),
+    ]
+
+
+def make_batch_delete_statement(
+    preparer,
+    schema,
+    table_name,
+    partitioned=False,
+):
+    '''
+    Return a DELETE statement that removes about :batch_size rows
+    received before :cutoff, so that no lock is held for long.
+    A ctid is only unique within a partition, so rows of a partitioned
+    table are selected by _id instead, and the cutoff is checked again
+    so that only expired rows are deleted even if an _id is repeated.
+    '''
+    table = '{}.{}'.format(
+        preparer.quote_schema(schema),
+        preparer.quote(table_name),
+    )
+    if partitioned:
+        return text(
+            'DELETE FROM {0} WHERE _received_at < :cutoff AND _id IN ('
+            'SELECT _id FROM {0} WHERE _received_at < :cutoff '
+            'LIMIT :batch_size)'.format(table)
+        )
+    return text(
+        'DELETE FROM {0} WHERE ctid = ANY(ARRAY('
+        'SELECT ctid FROM {0} WHERE _received_at < :cutoff '
+        'LIMIT :batch_size))'.format(table)
+    )
+
+
+class RetentionWorker(object):
+    '''
+    Periodically remove events older than the retention policy.
+    Expired partitions are detached and dropped as a whole; rows of
+    unpartitioned tables and of default partitions are deleted in bounded
+    batches, each in its own transaction.
+    Only one plugin process runs retention at a time.
+    '''
+    def __init__(
+        self,
+        engine,
+        schema,
+        table_prefix,
+        policy,
+        partition_scheme=None,
+        interval=3600,
+        batch_size=10000,
+    ):
+        self._engine = engine
+        self._schema = schema
+        self._table_prefix = table_prefix
+        self._policy = policy
+        self._partition_scheme = partition_scheme
+        self._interval = interval
+        self._batch_size = batch_size
+        self._stopped = Event()
+        self._thread = Thread(target=self._run_indefinitely, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def _run_indefinitely(self):
+        while not self._stopped.wait(self._interval):
+            try:
+                self.run_once()
+            except Exception:
+                logger.exception('retention error')
+
+    def run_once(self, now=None):
+        if now is None:
+            now = datetime.datetime.utcnow()
+        key = compute_advisory_lock_key(
+            self._schema + '.' + self._table_prefix + ':retention'
+        )
+        with self._engine.connect() as lock_conn:
+            if not lock_conn.execute(_TRY_LOCK_SQL, key=key).scalar():
+                logger.debug('retention is running in another process')
+                return
+            try:
+                self._expire_tables(lock_conn, now)
+            finally:
+                lock_conn.execute(_UNLOCK_SQL, key=key)
+
+    def _expire_tables(self, conn, now):
+        rollup_table_name = compute_rollup_table_name(self._table_prefix)
+        for table_name, relkind in list_tables(conn, self._schema):
+            if not table_name.startswith(self._table_prefix):
+                continue
+            if table_name == rollup_table_name:
+                continue
+            event_norm = table_name[len(self._table_prefix):]
+            days = self._policy.days_for(event_norm)
+            if days is None:
+                continue
+            cutoff = now - datetime.timedelta(days=days)
+            if relkind != 'p':
+                self._delete_expired_rows(table_name, cutoff)
+            elif self._partition_scheme is not None:
+                self._drop_expired_partitions(conn, table_name, cutoff)
+            else:
+                logger.warning(
+                    'no partition scheme for partitioned table %s, '
+                    'deleting expired rows instead',
+                    table_name,
+                )
+                self._delete_expired_rows(
+                    table_name,
+                    cutoff,
+                    partitioned=True,
+                )
+
+    def _drop_expired_partitions(self, conn, table_name, cutoff):
+        partition_names = list_partitions(conn, self._schema, table_name)
+        expired = find_expired_partitions(
+            self._partition_scheme,
+            table_name,
+            partition_names,
+            cutoff,
+        )
+        preparer = self._engine.dialect.identifier_preparer
+        for partition_name in expired:
+            logger.info('drop expired partition: %s', partition_name)
+            stmts = make_drop_partition_statements(
+                preparer,
+                self._schema,
+                table_name,
+                partition_name,
+            )
+            with self._engine.begin() as txn_conn:
+                for stmt in stmts:
+                    txn_conn.execute(stmt)
+        # the default partition holds rows outside of the partitions
+        # created, which are never dropped with a range partition
+        default_name = default_partition_name(table_name)
+        if default_name in partition_names:
+            self._delete_expired_rows(default_name, cutoff)
+
+    def _delete_expired_rows(self, table_name, cutoff, partitioned=False):
+        stmt = make_batch_delete_statement(
+            self._engine.dialect.identifier_preparer,
+            self._schema,
+            table_name,
+            partitioned=partitioned,
+        )
+        while not self._stopped.is_set():
+            with self._engine.begin() as conn:
+                result = conn.execute(
+                    stmt,
+                    cutoff=cutoff,
+                    batch_size=self._batch_size,
+                )
+                deleted = result.rowcount
+            logger.debug('deleted %d rows from %s', deleted, table_name)
+            if deleted < self._batch_size:
+                return
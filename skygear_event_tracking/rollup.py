@@ -0,0 +1,248 @@
+'''
+Hourly rollup of event counts.
+
+The rollup table holds one row per event and hour, with the number of
+events and a linear counting sketch of distinct users. The sketch is
+a bit string where the bit of each user is set; merging two sketches
+is a bitwise OR, and estimate_distinct_users turns a sketch into an
+estimated number of distinct users.
+
+Run ``python -m skygear_event_tracking rebuild-rollup`` to rebuild the
+rollup from the event tables.
+
+The rollup table is named with a double underscore after the table
+prefix, which sanitize_for_db never produces, so that it cannot be the
+table of an event.
+'''
+from collections import OrderedDict
+from sqlalchemy import text
+import datetime
+import hashlib
+import logging
+import math
+from .schema_cache import fetch_table_version, list_tables, reflect_table
+
+logger = logging.getLogger(__name__)
+
+
+ROLLUP_TABLE_SUFFIX = '__rollup_hourly'
+SKETCH_BITS = 2048
+
+_ZERO_SKETCH_SQL = "CAST(repeat('0', {0}) AS BIT({0}))".format(SKETCH_BITS)
+
+# Must agree with compute_sketch_position
+_SKETCH_POSITION_SQL = (
+    "CAST(CAST(CAST('x' || substr(md5(_user_id), 1, 8) AS BIT(32)) "
+    "AS BIGINT) % {} AS INTEGER)"
+).format(SKETCH_BITS)
+
+
+def compute_rollup_table_name(table_prefix):
+    return table_prefix + ROLLUP_TABLE_SUFFIX
+
+
+def compute_sketch_position(user_id):
+    '''
+    Return the bit of user_id in the sketch
+    '''
+    digest = hashlib.md5(user_id.encode('utf-8')).hexdigest()
+    return int(digest[:8], 16) % SKETCH_BITS
+
+
+def format_sketch(positions):
+    '''
+    Return the bit string literal with the bits in positions set
+    '''
+    bits = ['0'] * SKETCH_BITS
+    for position in positions:
+        bits[position] = '1'
+    return ''.join(bits)
+
+
+def estimate_distinct_users(sketch):
+    '''
+    Return the estimated number of distinct users of a sketch
+    '''
+    zeros = sketch.count('0')
+    if zeros == 0:
+        zeros = 1
+    return SKETCH_BITS * math.log(SKETCH_BITS / zeros)
+
+
+def compute_rollup_hour(attributes):
+    tracked_at = attributes.get('_tracked_at')
+    if isinstance(tracked_at, datetime.datetime):
+        dt = tracked_at
+    else:
+        dt = attributes['_received_at']
+    return dt.replace(minute=0, second=0, microsecond=0)
+
+
+def aggregate_events(events):
+    '''
+    Return a list of rollup rows, one per event and hour, sorted by key
+    so that concurrent writers lock rollup rows in the same order
+    '''
+    buckets = {}
+    for event in events:
+        hour = compute_rollup_hour(event.attributes)
+        key = (event.event_norm, hour)
+        bucket = buckets.get(key)
+        if bucket is None:
+            bucket = buckets[key] = [0, set()]
+        bucket[0] += 1
+        user_id = event.attributes.get('_user_id')
+        if isinstance(user_id, str):
+            bucket[1].add(compute_sketch_position(user_id))
+
+    output = []
+    for key in sorted(buckets):
+        count, positions = buckets[key]
+        output.append(OrderedDict([
+            ('event_norm', key[0]),
+            ('hour', key[1]),
+            ('count', count),
+            ('user_sketch', format_sketch(positions)),
+        ]))
+    return output
+
+
+def _format_table(preparer, schema, table_name):
+    return '{}.{}'.format(
+        preparer.quote_schema(schema),
+        preparer.quote(table_name),
+    )
+
+
+def make_create_rollup_table_statement(preparer, schema, table_name):
+    return (
+        'CREATE TABLE IF NOT EXISTS {} ('
+        'event_norm TEXT NOT NULL, '
+        'hour TIMESTAMP WITHOUT TIME ZONE NOT NULL, '
+        'count BIGINT NOT NULL, '
+        'user_sketch BIT({}) NOT NULL, '
+        'PRIMARY KEY (event_norm, hour))'
+    ).format(_format_table(preparer, schema, table_name), SKETCH_BITS)
+
+
+def make_upsert_statement(preparer, schema, table_name):
+    '''
+    Return a statement that adds a rollup row to the existing one
+    '''
+    return text((
+        'INSERT INTO {0} AS r (event_norm, hour, count, user_sketch) '
+        'VALUES (:event_norm, :hour, :count, CAST(:user_sketch AS BIT({1}))) '
+        'ON CONFLICT (event_norm, hour) DO UPDATE SET '
+        'count = r.count + EXCLUDED.count, '
+        'user_sketch = r.user_sketch | EXCLUDED.user_sketch'
+    ).format(_format_table(preparer, schema, table_name), SKETCH_BITS))
+
+
+def make_rebuild_statements(
+    preparer,
+    schema,
+    table_name,
+    event_table,
+    since=None,
+):
+    '''
+    Return statements that recompute the rollup rows of an event table
+    from scratch. Rows written concurrently by the writer are replaced,
+    so the statements should run in a single transaction.
+    '''
+    column_names = set(event_table.columns.keys())
+    if '_tracked_at' in column_names:
+        ts = 'COALESCE(_tracked_at, _received_at)'
+    else:
+        ts = '_received_at'
+    if '_user_id' in column_names:
+        sketch = 'COALESCE(bit_or(set_bit({0}, {1}, 1)), {0})'.format(
+            _ZERO_SKETCH_SQL,
+            _SKETCH_POSITION_SQL,
+        )
+    else:
+        sketch = _ZERO_SKETCH_SQL
+    rollup = _format_table(preparer, schema, table_name)
+
+    delete = 'DELETE FROM {} WHERE event_norm = :event_norm'.format(rollup)
+    where = ''
+    if since is not None:
+        delete += ' AND hour >= date_trunc(\'hour\', :since)'
+        where = ' WHERE {} >= date_trunc(\'hour\', :since)'.format(ts)
+    insert = (
+        'INSERT INTO {0} (event_norm, hour, count, user_sketch) '
+        'SELECT :event_norm, date_trunc(\'hour\', {1}), count(*), {2} '
+        'FROM {3}{4} GROUP BY 2 '
+        'ON CONFLICT (event_norm, hour) DO UPDATE SET '
+        'count = EXCLUDED.count, user_sketch = EXCLUDED.user_sketch'
+    ).format(
+        rollup,
+        ts,
+        sketch,
+        preparer.format_table(event_table),
+        where,
+    )
+    return [text(delete), text(insert)]
+
+
+class HourlyRollup(object):
+    '''
+    Maintain the rollup table incrementally, with one upsert per event
+    and hour for each batch written
+    '''
+    def __init__(self, schema, table_prefix):
+        self._schema = schema
+        self.table_name = compute_rollup_table_name(table_prefix)
+
+    def ensure_table(self, conn):
+        preparer = conn.dialect.identifier_preparer
+        conn.execute(make_create_rollup_table_statement(
+            preparer,
+            self._schema,
+            self.table_name,
+        ))
+
+    def update(self, conn, events):
+        rows = aggregate_events(events)
+        if len(rows) == 0:
+            return
+        logger.debug('update rollup: %d rows', len(rows))
+        stmt = make_upsert_statement(
+            conn.dialect.identifier_preparer,
+            self._schema,
+            self.table_name,
+        )
+        conn.execute(stmt, rows)
+
+
+def rebuild_rollups(engine, schema, table_prefix, since=None):
+    '''
+    Recompute the rollup of every event table, or only hours since
+    since if it is given. Each event table is rebuilt in its own
+    transaction.
+    '''
+    rollup = HourlyRollup(schema, table_prefix)
+    with engine.begin() as conn:
+        rollup.ensure_table(conn)
+        tables = list_tables(conn, schema)
+    for table_name, _ in tables:
+        if not table_name.startswith(table_prefix):
+            continue
+        if table_name == rollup.table_name:
+            continue
+        event_norm = table_name[len(table_prefix):]
+        logger.info('rebuild rollup: %s', event_norm)
+        with engine.begin() as conn:
+            version = fetch_table_version(conn, schema, table_name)
+            if version is None:
+                continue
+            event_table = reflect_table(conn, schema, table_name, version)
+            stmts = make_rebuild_statements(
+                conn.dialect.identifier_preparer,
+                schema,
+                rollup.table_name,
+                event_table,
+                since=since,
+            )
+            for stmt in stmts:
+                conn.execute(stmt, event_norm=event_norm, since=since)
@@ -0,0 +1,121 @@
+'''
+Client side thinning of high-frequency events.
+
+An event name can be sampled at a fixed rate, and rate limited with a
+token bucket. Sampling is decided by a hash of the event name and the
+user ID, so that a user is consistently in or out of the sample of an
+event. The sample rate is recorded in the reserved attribute
+_sample_rate, so that counts can be re-weighted by 1 / _sample_rate.
+Rate limiting is not recorded in _sample_rate, so the counts of a
+rate limited event name are lower bounds.
+'''
+from hashlib import md5
+from threading import Lock
+import random
+import time
+
+_HASH_SPACE = float(2 ** 64)
+
+
+def sample_point(event_name, user_id):
+    '''
+    Return a number in [0, 1) that is the same for the same event name
+    and user ID, or a random one if user_id is empty
+    '''
+    if not user_id:
+        return random.random()
+    key = '{}\0{}'.format(event_name, user_id).encode('utf-8')
+    return int.from_bytes(md5(key).digest()[:8], 'big') / _HASH_SPACE
+
+
+class TokenBucket(object):
+    '''
+    Allow rate events per second on average, and bursts of up to burst
+    events
+    '''
+    def __init__(self, rate, burst=None, clock=time.monotonic):
+        self._rate = rate
+        self._burst = burst if burst is not None else max(1, rate)
+        self._clock = clock
+        self._tokens = self._burst
+        self._updated_at = clock()
+        self._lock = Lock()
+
+    def try_acquire(self):
+        with self._lock:
+            now = self._clock()
+            self._tokens = min(
+                self._burst,
+                self._tokens + (now - self._updated_at) * self._rate,
+            )
+            self._updated_at = now
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
+
+
+def _make_bucket(limit):
+    if isinstance(limit, (tuple, list)):
+        return TokenBucket(*limit)
+    return TokenBucket(limit)
+
+
+class Sampler(object):
+    '''
+    Decide whether an event is tracked.
+    sample_rates maps an event name to the fraction of users whose
+    events of that name are tracked. rate_limits maps an event name to
+    the events per second tracked, or to a (rate, burst) tuple.
+    The fraction of events dropped by a rate limit depends on the load,
+    so it is not in _sample_rate and re-weighting by 1 / _sample_rate
+    undercounts these events; the rate_limited_records of stats() tells
+    how many were dropped. Events of other names are always tracked.
+    '''
+    def __init__(self, sample_rates=None, rate_limits=None):
+        self._sample_rates = dict(sample_rates or {})
+        for event_name, rate in self._sample_rates.items():
+            if not 0 <= rate <= 1:
+                raise ValueError(
+                    'sample rate of {} is not in [0, 1]'.format(event_name)
+                )
+        self._buckets = {
+            event_name: _make_bucket(limit)
+            for event_name, limit in (rate_limits or {}).items()
+        }
+        self._lock = Lock()
+        self._sampled_out = 0
+        self._rate_limited = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'sampled_out_records': self._sampled_out,
+                'rate_limited_records': self._rate_limited,
+            }
+
+    def sample_rate(self, event_name):
+        '''
+        Return the sample rate of an event name, or None if it is not
+        sampled
+        '''
+        rate = self._sample_rates.get(event_name)
+        if rate is None or rate >= 1:
+            return None
+        return rate
+
+    def accept(self, event_name, user_id):
+        '''
+        Return whether an event is tracked
+        '''
+        rate = self.sample_rate(event_name)
+        if rate is not None and sample_point(event_name, user_id) >= rate:
+            with self._lock:
+                self._sampled_out += 1
+            return False
+        bucket = self._buckets.get(event_name)
+        if bucket is not None and not bucket.try_acquire():
+            with self._lock:
+                self._rate_limited += 1
+            return False
+        return True
@@ -0,0 +1,154 @@
+from collections import namedtuple
+from sqlalchemy import (
+    Column,
+    MetaData,
+    Table,
+    text,
+)
+from sqlalchemy.types import NullType
+import threading
+
+
+_TABLE_VERSION_SQL = text('''
+SELECT c.oid, c.relnatts
+FROM pg_catalog.pg_class c
+JOIN pg_catalog.pg_namespace n ON n.oid = c.relnamespace
+WHERE n.nspname = :schema AND c.relname = :table_name
+''')
+
+
+_TABLE_COLUMNS_SQL = text('''
+SELECT a.attname, format_type(a.atttypid, NULL), c.relkind,
+EXISTS (
+    SELECT 1 FROM pg_catalog.pg_index i
+    JOIN pg_catalog.pg_attribute k
+    ON k.attrelid = i.indrelid AND k.attnum = i.indkey[0]
+    WHERE i.indrelid = c.oid AND i.indisprimary
+    AND i.indnatts = 1 AND k.attname = '_id'
+)
+FROM pg_catalog.pg_attribute a
+JOIN pg_catalog.pg_class c ON c.oid = a.attrelid
+WHERE a.attrelid = :oid AND a.attnum > 0 AND NOT a.attisdropped
+ORDER BY a.attnum
+''')
+
+
+_LIST_TABLES_SQL = text('''
+SELECT c.relname, c.relkind
+FROM pg_catalog.pg_class c
+JOIN pg_catalog.pg_namespace n ON n.oid = c.relnamespace
+WHERE n.nspname = :schema
+AND c.relkind IN ('r', 'p')
+AND NOT EXISTS (
+    SELECT 1 FROM pg_catalog.pg_inherits i WHERE i.inhrelid = c.oid
+)
+''')
+
+
+_LIST_PARTITIONS_SQL = text('''
+SELECT c.relname
+FROM pg_catalog.pg_inherits i
+JOIN pg_catalog.pg_class c ON c.oid = i.inhrelid
+JOIN pg_catalog.pg_class p ON p.oid = i.inhparent
+JOIN pg_catalog.pg_namespace n ON n.oid = p.relnamespace
+WHERE n.nspname = :schema AND p.relname = :table_name
+''')
+
+
+CacheEntry = namedtuple('CacheEntry', ['table', 'version'])
+
+
+def fetch_table_version(conn, schema, table_name):
+    '''
+    Return the version stamp of a table from pg_catalog.
+    The stamp changes whenever the table is re-created or a column is
+    added, so it is cheap to compare against a cached reflection.
+    Return None if the table does not exist.
+    '''
+    row = conn.execute(
+        _TABLE_VERSION_SQL,
+        schema=schema,
+        table_name=table_name,
+    ).first()
+    if row is None:
+        return None
+    return (row[0], row[1])
+
+
+def list_tables(conn, schema):
+    '''
+    Return a list of (table_name, relkind) of the tables in schema,
+    excluding partitions
+    '''
+    rows = conn.execute(_LIST_TABLES_SQL, schema=schema).fetchall()
+    return [(row[0], row[1]) for row in rows]
+
+
+def list_partitions(conn, schema, table_name):
+    '''
+    Return a list of names of the partitions of a table
+    '''
+    rows = conn.execute(
+        _LIST_PARTITIONS_SQL,
+        schema=schema,
+        table_name=table_name,
+    ).fetchall()
+    return [row[0] for row in rows]
+
+
+def reflect_table(conn, schema, table_name, version):
+    '''
+    Return a Table with the columns of the table identified by version.
+    The columns are read from pg_catalog directly so that partitioned
+    parent tables are reflected the same way as ordinary tables.
+    table.info['partitioned'] tells whether the table is a partitioned
+    parent, and table.info['primary_key_on_id'] whether its primary key
+    is exactly (_id). A primary key of a partitioned table also has the
+    partition column, so it does not make _id unique.
+    '''
+    oid = version[0]
+    rows = conn.execute(_TABLE_COLUMNS_SQL, oid=oid).fetchall()
+    columns = []
+    partitioned = False
+    primary_key_on_id = False
+    for col_name, type_name, relkind, has_id_key in rows:
+        col_type = conn.dialect.ischema_names.get(type_name, NullType)
+        columns.append(Column(col_name, col_type))
+        partitioned = relkind == 'p'
+        primary_key_on_id = has_id_key
+    table = Table(table_name, MetaData(), *columns, schema=schema)
+    table.info['partitioned'] = partitioned
+    table.info['primary_key_on_id'] = primary_key_on_id
+    return table
+
+
+class SchemaCache(object):
+    '''
+    Process-wide cache of reflected tables keyed by quantified table name.
+    Each table is reflected into its own MetaData so that a table can be
+    invalidated without affecting the others.
+    '''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = {}
+
+    def get(self, key):
+        '''
+        Return the CacheEntry of key, or None on cache miss
+        '''
+        with self._lock:
+            return self._entries.get(key)
+
+    def put(self, key, table, version):
+        entry = CacheEntry(table=table, version=version)
+        with self._lock:
+            self._entries[key] = entry
+        return entry
+
+    def evict(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
@@ -0,0 +1,138 @@
+'''
+Encoding of tracked events into the JSON of a request body.
+
+An event is validated and encoded once, when it is tracked, into a
+compact JSON object. A request body is made by joining the encoded
+events, so that no intermediate structure is built at upload time.
+'''
+from json.encoder import encode_basestring_ascii
+
+EMPTY_BODY = b'{"events":[]}'
+
+
+def _encode_float(value):
+    # the same as json.dumps
+    if value != value:
+        return 'NaN'
+    if value == float('inf'):
+        return 'Infinity'
+    if value == float('-inf'):
+        return '-Infinity'
+    return float.__repr__(value)
+
+
+def _encode_bool(value):
+    return 'true' if value else 'false'
+
+
+def _encode_int(value):
+    # numbers are sent as float
+    return _encode_float(float(value))
+
+
+# The second and the encoding of the last datetime encoded
+_last_second = (None, None)
+
+
+def _encode_datetime(value):
+    '''
+    Encode a naive UTC datetime as a date object. The ISO format up to
+    the second is cached, as events tracked together share it.
+    '''
+    global _last_second
+    second = value.replace(microsecond=0)
+    cached_second, prefix = _last_second
+    if cached_second != second:
+        prefix = '{"$type":"date","$date":"' + second.isoformat()
+        _last_second = (second, prefix)
+    if value.microsecond:
+        return '{}.{:06d}Z"}}'.format(prefix, value.microsecond)
+    return prefix + 'Z"}'
+
+
+# Dispatch on the exact type of a value of a user defined attribute
+_ATTRIBUTE_ENCODERS = {
+    str: encode_basestring_ascii,
+    bool: _encode_bool,
+    int: _encode_int,
+    float: _encode_float,
+}
+
+
+def _encode_attribute_slow(value):
+    '''
+    Encode a value whose exact type is not in _ATTRIBUTE_ENCODERS,
+    e.g. a subclass of str. Return None if the value is dropped.
+    '''
+    if isinstance(value, str):
+        return encode_basestring_ascii(value)
+    elif isinstance(value, bool):
+        return _encode_bool(value)
+    elif isinstance(value, int):
+        return _encode_int(value)
+    elif isinstance(value, float):
+        return _encode_float(value)
+    return None
+
+
+def encode_attribute(value):
+    '''
+    Return the JSON of a value of a user defined attribute, or None if
+    the value is not of a supported type
+    '''
+    encoder = _ATTRIBUTE_ENCODERS.get(type(value))
+    if encoder is None:
+        return _encode_attribute_slow(value)
+    return encoder(value)
+
+
+def encode_event(
+    event_name,
+    user_id,
+    attributes,
+    tracked_at,
+    sample_rate=None,
+    event_id=None,
+):
+    '''
+    Return the compact JSON of an event as bytes.
+    The sample rate, if any, is recorded as _sample_rate, and the event
+    ID, if any, as _id.
+    Attributes whose key is not a str or whose value is not a str, bool,
+    int or float are dropped. Reserved attributes set by the client
+    take precedence over user defined attributes of the same name.
+    '''
+    reserved = [
+        ('_id', encode_attribute(event_id)),
+        ('_tracked_at', _encode_datetime(tracked_at)),
+        ('_event_raw', encode_attribute(event_name)),
+    ]
+    if user_id:
+        reserved.append(('_user_id', encode_attribute(user_id)))
+    if sample_rate is not None:
+        reserved.append(('_sample_rate', _encode_float(float(sample_rate))))
+    reserved_keys = {key for key, _ in reserved}
+
+    fragments = []
+    if attributes is not None:
+        for key, value in attributes.items():
+            if not isinstance(key, str) or key in reserved_keys:
+                continue
+            encoded = encode_attribute(value)
+            if encoded is not None:
+                fragments.append(encode_basestring_ascii(key) + ':' + encoded)
+    for key, encoded in reserved:
+        if encoded is not None:
+            fragments.append('"' + key + '":' + encoded)
+    return ('{' + ','.join(fragments) + '}').encode('ascii')
+
+
+def join_events(encoded_events):
+    '''
+    Return the JSON array of encoded events
+    '''
+    return b'[' + b','.join(encoded_events) + b']'
+
+
+def make_request_body(encoded_events):
+    return b'{"events":' + join_events(encoded_events) + b'}'
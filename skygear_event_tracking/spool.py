@@ -0,0 +1,275 @@
+'''
+Disk-backed FIFO of opaque records.
+
+Records are appended to segment files named by an increasing sequence
+number. Each record is a 4-byte big-endian length followed by the
+payload. Once every record of a segment has been consumed the segment
+is deleted. The position of the next record to read is kept in a cursor
+file, so that records consumed before a restart are not read again.
+'''
+import logging
+import os
+import random
+import struct
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+
+_HEADER = struct.Struct('>I')
+_SEGMENT_SUFFIX = '.seg'
+_CURSOR_NAME = 'cursor'
+_LOCK_NAME = 'lock'
+_FORK_PREFIX = 'fork-'
+
+# Locks of claimed spool directories, held until the process exits
+_claimed = []
+
+
+def compute_backoff(failures, base, maximum, rand=random.random):
+    '''
+    Return the delay in seconds before the next attempt after failures
+    consecutive failures, with full jitter
+    '''
+    return rand() * min(maximum, base * (2 ** min(failures, 32)))
+
+
+def _try_lock(directory):
+    fd = os.open(os.path.join(directory, _LOCK_NAME), os.O_CREAT | os.O_RDWR)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        os.close(fd)
+        return False
+    _claimed.append(fd)
+    return True
+
+
+def claim_spool_directory(parent):
+    '''
+    Return a subdirectory of parent for the spool of a forked process.
+    A subdirectory left by a process that has exited is reused, so that
+    its events are replayed; otherwise a new one is created.
+    Subdirectories are claimed with an exclusive lock on their lock file.
+    Without fcntl a subdirectory in use cannot be told from one left
+    behind, so a new one is always created.
+    '''
+    os.makedirs(parent, exist_ok=True)
+    if fcntl is None:
+        logger.warning('fcntl is unavailable, not reusing spool directories')
+        return _make_spool_directory(parent)
+    for name in sorted(os.listdir(parent)):
+        path = os.path.join(parent, name)
+        if name.startswith(_FORK_PREFIX) and os.path.isdir(path):
+            if _try_lock(path):
+                return path
+    while True:
+        path = _make_spool_directory(parent)
+        if _try_lock(path):
+            return path
+
+
+def _make_spool_directory(parent):
+    while True:
+        path = os.path.join(parent, '{}{}-{}'.format(
+            _FORK_PREFIX,
+            os.getpid(),
+            random.getrandbits(32),
+        ))
+        try:
+            os.makedirs(path)
+        except FileExistsError:
+            continue
+        return path
+
+
+def _segment_name(seq):
+    return '{:020d}{}'.format(seq, _SEGMENT_SUFFIX)
+
+
+class Spool(object):
+    '''
+    Append-only, segment-based file queue bounded to max_bytes on disk.
+    Records are read back in the order they were appended with peek,
+    and removed with commit once they have been handled.
+    '''
+    def __init__(
+        self,
+        directory,
+        max_bytes=64 * 1024 * 1024,
+        segment_bytes=4 * 1024 * 1024,
+        fsync=False,
+    ):
+        self._directory = directory
+        self._max_bytes = max_bytes
+        self._segment_bytes = segment_bytes
+        self._fsync = fsync
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+        self._segments = self._list_segments()
+        self._size = sum(
+            os.path.getsize(self._path(seq)) for seq in self._segments
+        )
+        self._read_seq, self._read_offset = self._load_cursor()
+        self._pending = None
+        self._writer = None
+        self._write_seq = self._segments[-1] + 1 if self._segments else 0
+
+    def _path(self, seq):
+        return os.path.join(self._directory, _segment_name(seq))
+
+    def _list_segments(self):
+        output = []
+        for name in os.listdir(self._directory):
+            if not name.endswith(_SEGMENT_SUFFIX):
+                continue
+            try:
+                output.append(int(name[:-len(_SEGMENT_SUFFIX)]))
+            except ValueError:
+                continue
+        return sorted(output)
+
+    def _load_cursor(self):
+        first = self._segments[0] if self._segments else 0
+        try:
+            with open(os.path.join(self._directory, _CURSOR_NAME)) as f:
+                seq, offset = (int(x) for x in f.read().split())
+        except (OSError, ValueError):
+            return first, 0
+        if seq < first:
+            return first, 0
+        return seq, offset
+
+    def _save_cursor(self):
+        path = os.path.join(self._directory, _CURSOR_NAME)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write('{} {}'.format(self._read_seq, self._read_offset))
+        os.replace(tmp_path, path)
+
+    def __len__(self):
+        '''
+        Return the number of bytes on disk
+        '''
+        with self._lock:
+            return self._size
+
+    def is_empty(self):
+        with self._lock:
+            return self._peek_locked() is None
+
+    def append(self, payload):
+        '''
+        Append a record.
+        Return False without appending if the spool would exceed
+        max_bytes.
+        '''
+        record = _HEADER.pack(len(payload)) + payload
+        with self._lock:
+            if self._size + len(record) > self._max_bytes:
+                return False
+            writer = self._get_writer(len(record))
+            writer.write(record)
+            writer.flush()
+            if self._fsync:
+                os.fsync(writer.fileno())
+            self._size += len(record)
+            return True
+
+    def _get_writer(self, record_size):
+        if self._writer is not None:
+            if self._writer.tell() + record_size <= self._segment_bytes:
+                return self._writer
+            self._writer.close()
+            self._writer = None
+        seq = self._write_seq
+        self._write_seq += 1
+        self._writer = open(self._path(seq), 'ab')
+        self._segments.append(seq)
+        return self._writer
+
+    def peek(self):
+        '''
+        Return the payload of the oldest record, or None if the spool
+        is empty. The record stays in the spool until commit is called.
+        '''
+        with self._lock:
+            return self._peek_locked()
+
+    def _peek_locked(self):
+        if self._pending is not None:
+            return self._pending[0]
+        while self._segments:
+            seq = self._segments[0]
+            if self._read_seq < seq:
+                self._read_seq, self._read_offset = seq, 0
+            record = None
+            if self._read_seq == seq:
+                record = self._read_record(seq, self._read_offset)
+            if record is not None:
+                self._pending = record
+                return record[0]
+            self._remove_segment(seq)
+        return None
+
+    def _read_record(self, seq, offset):
+        '''
+        Return the payload at offset of segment seq and the offset of
+        the next record, or None at the end of the segment.
+        A truncated record left by a crash is treated as the end.
+        '''
+        with open(self._path(seq), 'rb') as f:
+            f.seek(offset)
+            header = f.read(_HEADER.size)
+            if len(header) < _HEADER.size:
+                return None
+            (length,) = _HEADER.unpack(header)
+            payload = f.read(length)
+            if len(payload) < length:
+                logger.warning('truncated record in spool segment %d', seq)
+                return None
+        return payload, offset + _HEADER.size + length
+
+    def _remove_segment(self, seq):
+        if self._writer is not None and seq == self._write_seq - 1:
+            # the next append starts a new segment
+            self._writer.close()
+            self._writer = None
+        path = self._path(seq)
+        try:
+            self._size -= os.path.getsize(path)
+            os.remove(path)
+        except OSError:
+            logger.exception('failed to remove spool segment %d', seq)
+        self._segments.pop(0)
+        if self._read_seq <= seq:
+            self._read_seq, self._read_offset = seq + 1, 0
+        self._save_cursor()
+
+    def commit(self):
+        '''
+        Remove the record returned by the last peek
+        '''
+        with self._lock:
+            if self._pending is None:
+                return
+            self._read_offset = self._pending[1]
+            self._pending = None
+            path = self._path(self._read_seq)
+            if self._read_offset >= os.path.getsize(path):
+                # free the disk space of a consumed segment right away
+                self._remove_segment(self._read_seq)
+            else:
+                self._save_cursor()
+
+    def close(self):
+        with self._lock:
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
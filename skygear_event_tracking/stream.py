@@ -0,0 +1,232 @@
+'''
+Incremental parsing of request bodies.
+
+A body is a JSON object whose "events" member is an array of event
+objects. iter_json_events reads the body from a file-like object in
+chunks and yields the events one by one, so that only the event being
+parsed and one chunk of input are held in memory. A compressed body is
+decompressed on the fly by wrapping the stream in DecompressingReader.
+'''
+import codecs
+import json
+import logging
+import zlib
+
+logger = logging.getLogger(__name__)
+
+
+DEFAULT_READ_SIZE = 64 * 1024
+
+# An incomplete value larger than this is rejected, rather than waiting
+# for the rest of an event that does not fit in the buffer yet
+DEFAULT_MAX_VALUE_SIZE = 1024 * 1024
+
+_WHITESPACE = ' \t\n\r'
+
+# Characters that may continue a number
+_NUMBER_CHARS = '0123456789.eE+-'
+
+
+# zlib wbits of supported Content-Encoding
+CONTENT_ENCODING_WBITS = {
+    'gzip': 16 + zlib.MAX_WBITS,
+    'x-gzip': 16 + zlib.MAX_WBITS,
+    'deflate': zlib.MAX_WBITS,
+}
+
+
+class MalformedBodyError(ValueError):
+    pass
+
+
+class BodyTooLargeError(ValueError):
+    pass
+
+
+class DecompressingReader(object):
+    '''
+    File-like object that decompresses a gzip or deflate stream as it is
+    read. Each read inflates at most the requested number of bytes, and
+    BodyTooLargeError is raised once more than max_size bytes have been
+    inflated, so that a small body cannot expand without bound.
+    '''
+    def __init__(
+        self,
+        stream,
+        content_encoding,
+        max_size,
+        read_size=DEFAULT_READ_SIZE,
+    ):
+        self._stream = stream
+        self._wbits = CONTENT_ENCODING_WBITS[content_encoding]
+        self._decompressor = zlib.decompressobj(self._wbits)
+        self._max_size = max_size
+        self._read_size = read_size
+        self._size = 0
+
+    def _next_input(self):
+        decompressor = self._decompressor
+        if decompressor.unconsumed_tail:
+            return decompressor.unconsumed_tail
+        if decompressor.eof and decompressor.unused_data:
+            # the next member of a multi-member gzip stream
+            self._decompressor = zlib.decompressobj(self._wbits)
+            return decompressor.unused_data
+        return self._stream.read(self._read_size)
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self._read_size
+        while True:
+            data = self._next_input()
+            if not data:
+                if not self._decompressor.eof:
+                    raise MalformedBodyError('truncated compressed body')
+                return b''
+            try:
+                output = self._decompressor.decompress(data, size)
+            except zlib.error as e:
+                raise MalformedBodyError(str(e))
+            self._size += len(output)
+            if self._size > self._max_size:
+                raise BodyTooLargeError(
+                    'decompressed body exceeds {} bytes'.format(self._max_size)
+                )
+            if output:
+                return output
+
+
+class _Reader(object):
+    '''
+    Buffer of text decoded from a byte stream, consumed from the front
+    '''
+    def __init__(self, stream, read_size, max_value_size):
+        self._stream = stream
+        self._read_size = read_size
+        self._max_value_size = max_value_size
+        self._decoder = codecs.getincrementaldecoder('utf-8')()
+        self._json = json.JSONDecoder()
+        self._buf = ''
+        self._pos = 0
+        self._eof = False
+
+    def _fill(self):
+        '''
+        Read more input. Return False at the end of the stream.
+        '''
+        if self._eof:
+            return False
+        data = self._stream.read(self._read_size)
+        try:
+            if not data:
+                self._eof = True
+                text = self._decoder.decode(b'', final=True)
+            else:
+                text = self._decoder.decode(data)
+        except UnicodeDecodeError as e:
+            raise MalformedBodyError(str(e))
+        # drop consumed input so that the buffer stays O(chunk)
+        self._buf = self._buf[self._pos:] + text
+        self._pos = 0
+        return True
+
+    def peek(self):
+        '''
+        Return the next non-whitespace character without consuming it,
+        or '' at the end of the input
+        '''
+        while True:
+            buf = self._buf
+            while self._pos < len(buf) and buf[self._pos] in _WHITESPACE:
+                self._pos += 1
+            if self._pos < len(buf):
+                return buf[self._pos]
+            if not self._fill():
+                return ''
+
+    def expect(self, chars):
+        '''
+        Consume and return the next non-whitespace character, which
+        must be one of chars
+        '''
+        char = self.peek()
+        if char == '' or char not in chars:
+            raise MalformedBodyError('expected one of {!r}, got {!r}'.format(
+                chars,
+                char,
+            ))
+        self._pos += 1
+        return char
+
+    def _may_continue(self, end):
+        return end == len(self._buf) or self._buf[end] in _NUMBER_CHARS
+
+    def decode_value(self):
+        '''
+        Consume and return the next JSON value.
+        The value is decoded again with more input if it is incomplete,
+        or if it is followed by the end of the buffer or a character
+        that may continue a number, e.g. "1" of "1.5" split across reads.
+        '''
+        self.peek()
+        while True:
+            try:
+                value, end = self._json.raw_decode(self._buf, self._pos)
+            except ValueError as e:
+                self._check_size(len(self._buf))
+                if self._fill():
+                    continue
+                raise MalformedBodyError(str(e))
+            if self._may_continue(end) and self._fill():
+                continue
+            self._check_size(end)
+            self._pos = end
+            return value
+
+    def _check_size(self, end):
+        if end - self._pos > self._max_value_size:
+            raise BodyTooLargeError('value larger than {} characters'.format(
+                self._max_value_size,
+            ))
+
+
+def _iter_array(reader):
+    reader.expect('[')
+    if reader.peek() == ']':
+        reader.expect(']')
+        return
+    while True:
+        yield reader.decode_value()
+        if reader.expect(',]') == ']':
+            return
+
+
+def iter_json_events(
+    stream,
+    read_size=DEFAULT_READ_SIZE,
+    max_value_size=DEFAULT_MAX_VALUE_SIZE,
+):
+    '''
+    Yield the elements of the "events" array of the JSON object read
+    from stream. Other members of the object are parsed and discarded.
+    Raise MalformedBodyError if the body is malformed, or
+    BodyTooLargeError if a single event is longer than max_value_size
+    characters; events before the error have been yielded by then.
+    '''
+    reader = _Reader(stream, read_size, max_value_size)
+    reader.expect('{')
+    if reader.peek() == '}':
+        reader.expect('}')
+        return
+    while True:
+        key = reader.decode_value()
+        reader.expect(':')
+        if key == 'events':
+            for json_event in _iter_array(reader):
+                yield json_event
+        else:
+            reader.decode_value()
+        if reader.expect(',}') == '}':
+            break
+    if reader.peek() != '':
+        raise MalformedBodyError('extra data after the body')
@@ -0,0 +1,242 @@
+import asyncio
+import gzip
+import json
+import unittest
+
+from ..async_client import AsyncClient, UploadError, read_response
+
+
+class StandInServer(object):
+    '''
+    Minimal HTTP/1.1 server that records the bodies posted to it
+    '''
+    def __init__(self, status_code=200, keep_alive=True, respond=True):
+        self.status_code = status_code
+        self.keep_alive = keep_alive
+        self.respond = respond
+        self.requests = []
+        self.connections = 0
+        self._server = None
+        self._writers = []
+
+    async def start(self):
+        self._server = await asyncio.start_server(
+            self._handle,
+            '127.0.0.1',
+            0,
+        )
+        return self._server.sockets[0].getsockname()[1]
+
+    async def close(self):
+        self._server.close()
+        for writer in self._writers:
+            writer.close()
+        await self._server.wait_closed()
+        # let the connection handlers return
+        await asyncio.sleep(0.01)
+
+    async def _handle(self, reader, writer):
+        self.connections += 1
+        self._writers.append(writer)
+        try:
+            while await self._handle_request(reader, writer):
+                pass
+        finally:
+            writer.close()
+
+    async def _handle_request(self, reader, writer):
+        request_line = await reader.readline()
+        if not request_line:
+            return False
+        headers = {}
+        while True:
+            line = (await reader.readline()).decode('latin-1')
+            if line == '\r\n':
+                break
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+        body = await reader.readexactly(int(headers['content-length']))
+        if headers.get('content-encoding') == 'gzip':
+            body = gzip.decompress(body)
+        self.requests.append((request_line, headers, json.loads(body)))
+        if not self.respond:
+            return False
+        if self.status_code == 204:
+            response = 'HTTP/1.1 204 No Content\r\n\r\n'
+        else:
+            response = (
+                'HTTP/1.1 {} OK\r\n'
+                'Transfer-Encoding: chunked\r\n\r\n'
+                '2\r\nok\r\n0\r\n\r\n'
+            ).format(self.status_code)
+        writer.write(response.encode('latin-1'))
+        await writer.drain()
+        return self.keep_alive
+
+
+class AsyncClientTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+
+    def _run(self, server, coro_func):
+        async def main():
+            port = await server.start()
+            try:
+                await coro_func('http://127.0.0.1:{}/'.format(port))
+            finally:
+                await server.close()
+        self.loop.run_until_complete(main())
+
+    def test_track_and_flush(self):
+        server = StandInServer()
+
+        async def main(endpoint):
+            async with AsyncClient(
+                endpoint,
+                upload_size=2,
+                linger_ms=10,
+            ) as client:
+                self.assertTrue(client.track('Event A', user_id='u1'))
+                self.assertTrue(client.track('Event B', attributes={'a': 1}))
+                self.assertTrue(client.track('Event C'))
+                await client.flush()
+                self.assertEqual(2, len(server.requests))
+        self._run(server, main)
+
+        request_line, headers, body = server.requests[0]
+        self.assertEqual(
+            b'POST /skygear_event_tracking HTTP/1.1\r\n',
+            request_line,
+        )
+        self.assertEqual(
+            ['Event A', 'Event B'],
+            [e['_event_raw'] for e in body['events']],
+        )
+        self.assertEqual('u1', body['events'][0]['_user_id'])
+        self.assertEqual(1.0, body['events'][1]['a'])
+        self.assertEqual('date', body['events'][0]['_tracked_at']['$type'])
+        # should reuse the connection
+        self.assertEqual(1, server.connections)
+
+    def test_compress(self):
+        server = StandInServer()
+
+        async def main(endpoint):
+            async with AsyncClient(
+                endpoint,
+                linger_ms=10,
+                compress=True,
+                compress_min_size=0,
+            ) as client:
+                client.track('Event A')
+        self._run(server, main)
+
+        _, headers, body = server.requests[0]
+        self.assertEqual('gzip', headers['content-encoding'])
+        self.assertEqual('Event A', body['events'][0]['_event_raw'])
+
+    def test_upload_error(self):
+        server = StandInServer(status_code=500)
+
+        async def main(endpoint):
+            client = AsyncClient(endpoint, linger_ms=10)
+            with self.assertRaises(UploadError):
+                await client._upload([client._make_event('A', None, None)])
+            # should not hold the queue on failure
+            async with client:
+                client.track('Event A')
+                await client.flush()
+        self._run(server, main)
+        self.assertEqual(2, len(server.requests))
+
+    def test_reconnect_after_server_closes(self):
+        server = StandInServer(keep_alive=False)
+
+        async def main(endpoint):
+            client = AsyncClient(endpoint)
+            for name in ['A', 'B']:
+                await client._upload([client._make_event(name, None, None)])
+                # let the client see the connection closed
+                await asyncio.sleep(0.01)
+            client._close_connection()
+        self._run(server, main)
+        self.assertEqual(2, server.connections)
+        self.assertEqual(2, len(server.requests))
+
+    def test_no_resend_after_request_is_written(self):
+        server = StandInServer(respond=False)
+
+        async def main(endpoint):
+            client = AsyncClient(endpoint)
+            with self.assertRaises(ConnectionError):
+                await client._upload([client._make_event('A', None, None)])
+        self._run(server, main)
+        # the server may have processed the request
+        self.assertEqual(1, len(server.requests))
+
+    def test_read_response_max_body_size(self):
+        async def main():
+            reader = asyncio.StreamReader()
+            reader.feed_data(b'HTTP/1.1 200 OK\r\n\r\n' + b'x' * 100)
+            reader.feed_eof()
+            with self.assertRaises(ValueError):
+                await read_response(reader, max_body_size=50)
+
+            reader = asyncio.StreamReader()
+            reader.feed_data(b'HTTP/1.1 200 OK\r\nContent-Length: 100\r\n\r\n')
+            with self.assertRaises(ValueError):
+                await read_response(reader, max_body_size=50)
+
+            reader = asyncio.StreamReader()
+            reader.feed_data(b'HTTP/1.1 200 OK\r\n\r\nok')
+            reader.feed_eof()
+            actual = await read_response(reader, max_body_size=50)
+            self.assertEqual((200, {'connection': 'close'}, b'ok'), actual)
+        self.loop.run_until_complete(main())
+
+    def test_read_response_without_body(self):
+        async def main():
+            for status_line in [b'204 No Content', b'304 Not Modified']:
+                reader = asyncio.StreamReader()
+                # the connection is kept open
+                reader.feed_data(b'HTTP/1.1 ' + status_line + b'\r\n\r\n')
+                actual = await asyncio.wait_for(read_response(reader), 1)
+                self.assertEqual(b'', actual[2])
+
+            reader = asyncio.StreamReader()
+            reader.feed_data(
+                b'HTTP/1.1 100 Continue\r\n\r\n'
+                b'HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nok'
+            )
+            actual = await asyncio.wait_for(read_response(reader), 1)
+            self.assertEqual((200, {'content-length': '2'}, b'ok'), actual)
+        self.loop.run_until_complete(main())
+
+    def test_upload_no_content(self):
+        server = StandInServer(status_code=204)
+
+        async def main(endpoint):
+            client = AsyncClient(endpoint)
+            await asyncio.wait_for(
+                client._upload([client._make_event('A', None, None)]),
+                1,
+            )
+        self._run(server, main)
+        self.assertEqual(1, len(server.requests))
+
+    def test_track_before_start(self):
+        client = AsyncClient('http://127.0.0.1:1/')
+        self.assertFalse(client.track('Event A'))
+
+    def test_track_rate_limited(self):
+        server = StandInServer()
+
+        async def main(endpoint):
+            async with AsyncClient(
+                endpoint,
+                rate_limits={'heartbeat': (0.001, 1)},
+            ) as client:
+                self.assertTrue(client.track('heartbeat'))
+                self.assertEqual(False, client.track('heartbeat'))
+        self._run(server, main)
@@ -0,0 +1,82 @@
+import unittest
+
+from ..batching import AdaptiveBatchSize
+
+
+class AdaptiveBatchSizeTest(unittest.TestCase):
+    def test_grow_on_fast_full_batches(self):
+        batch_size = AdaptiveBatchSize(
+            initial=100,
+            maximum=150,
+            target_latency=0.5,
+        )
+        batch_size.record(0.1, 100)
+        self.assertEqual(125, batch_size.value)
+        # should not grow on batches that are not full
+        batch_size.record(0.1, 10)
+        self.assertEqual(125, batch_size.value)
+        batch_size.record(0.1, 125)
+        batch_size.record(0.1, 150)
+        self.assertEqual(150, batch_size.value)
+
+    def test_shrink_on_slow_uploads(self):
+        batch_size = AdaptiveBatchSize(
+            initial=100,
+            maximum=1000,
+            target_latency=0.5,
+            minimum=30,
+            alpha=0.5,
+        )
+        batch_size.record(0.1, 100)
+        self.assertEqual(125, batch_size.value)
+        # 0.1 + 0.5 * (1.5 - 0.1) = 0.8
+        batch_size.record(1.5, 125)
+        self.assertAlmostEqual(0.8, batch_size.latency)
+        self.assertEqual(62, batch_size.value)
+        # should halve at most once per 1 / alpha uploads
+        batch_size.record(1.5, 62)
+        self.assertEqual(62, batch_size.value)
+        batch_size.record(1.5, 62)
+        self.assertEqual(31, batch_size.value)
+        batch_size.record(1.5, 31)
+        batch_size.record(1.5, 31)
+        self.assertEqual(30, batch_size.value)
+
+    def test_default_minimum(self):
+        batch_size = AdaptiveBatchSize(
+            initial=100,
+            maximum=1000,
+            target_latency=0.5,
+            alpha=1,
+        )
+        for _ in range(10):
+            batch_size.record(1.5, batch_size.value)
+        self.assertEqual(10, batch_size.value)
+        # should not raise the size of a small client to the minimum
+        batch_size = AdaptiveBatchSize(
+            initial=5,
+            maximum=1000,
+            target_latency=0.5,
+        )
+        self.assertEqual(5, batch_size.value)
+
+    def test_resize(self):
+        batch_size = AdaptiveBatchSize(
+            initial=100,
+            maximum=200,
+            target_latency=0.5,
+            minimum=10,
+        )
+        batch_size.resize(50)
+        self.assertEqual(50, batch_size.value)
+        # should never grow the batches
+        batch_size.resize(500)
+        self.assertEqual(50, batch_size.value)
+        # the server may ask for less than the minimum
+        batch_size.resize(5)
+        self.assertEqual(5, batch_size.value)
+        # should not raise the size to the minimum when slow
+        batch_size.record(1.5, 5)
+        self.assertEqual(5, batch_size.value)
+        batch_size.resize(0)
+        self.assertEqual(1, batch_size.value)
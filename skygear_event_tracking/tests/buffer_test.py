@@ -0,0 +1,103 @@
+import threading
+import unittest
+from unittest import mock
+
+from ..buffer import WriteBehindBuffer
+
+
+class FakeWriter(object):
+    def __init__(self):
+        self.batches = []
+        self.flushed = threading.Event()
+
+    def process_events(self, events):
+        self.batches.append(list(events))
+        self.flushed.set()
+
+
+class WriteBehindBufferTest(unittest.TestCase):
+    def test_offer_rejects_when_full(self):
+        writer = FakeWriter()
+        buffer = WriteBehindBuffer(
+            writer,
+            max_size=3,
+            flush_size=10,
+            flush_interval=60,
+            num_flushers=0,
+        )
+        self.assertTrue(buffer.offer([1, 2]))
+        self.assertFalse(buffer.offer([3, 4]))
+        self.assertEqual(2, len(buffer))
+        self.assertTrue(buffer.offer([3]))
+        self.assertEqual(3, len(buffer))
+
+    def test_offer_waits_for_room(self):
+        writer = FakeWriter()
+        buffer = WriteBehindBuffer(
+            writer,
+            max_size=2,
+            flush_size=2,
+            flush_interval=60,
+            num_flushers=0,
+        )
+        self.assertTrue(buffer.offer([1, 2]))
+        self.assertFalse(buffer.offer([3], timeout=0.01))
+        self.assertFalse(buffer.offer([3, 4, 5], timeout=None))
+
+        def drain():
+            buffer._take_batch()
+        threading.Timer(0.01, drain).start()
+        self.assertTrue(buffer.offer([3], timeout=5))
+        self.assertEqual(1, len(buffer))
+
+    def test_flush_on_size(self):
+        writer = FakeWriter()
+        buffer = WriteBehindBuffer(
+            writer,
+            flush_size=2,
+            flush_interval=60,
+            num_flushers=1,
+        )
+        buffer.offer([1, 2, 3])
+        self.assertTrue(writer.flushed.wait(5))
+        self.assertEqual([1, 2], writer.batches[0])
+        buffer.close()
+        self.assertEqual([[1, 2], [3]], writer.batches)
+
+    def test_flush_on_interval(self):
+        writer = FakeWriter()
+        buffer = WriteBehindBuffer(
+            writer,
+            flush_size=100,
+            flush_interval=0.01,
+            num_flushers=1,
+        )
+        buffer.offer([1])
+        self.assertTrue(writer.flushed.wait(5))
+        self.assertEqual([[1]], writer.batches)
+        buffer.close()
+
+    def test_partial_batch_keeps_arrival_time(self):
+        writer = FakeWriter()
+        buffer = WriteBehindBuffer(
+            writer,
+            flush_size=2,
+            flush_interval=1,
+            num_flushers=0,
+        )
+        path = 'skygear_event_tracking.buffer.time.monotonic'
+        with mock.patch(path, return_value=100):
+            buffer.offer([1, 2, 3])
+        with mock.patch(path, return_value=100.5):
+            self.assertEqual([1, 2], buffer._take_batch())
+        # 3 is due one flush interval after it arrived, not after the
+        # batch before it was taken
+        with mock.patch(path, side_effect=[101, 200]) as monotonic:
+            self.assertEqual([3], buffer._take_batch())
+            self.assertEqual(1, monotonic.call_count)
+
+    def test_close_rejects_new_events(self):
+        writer = FakeWriter()
+        buffer = WriteBehindBuffer(writer, num_flushers=1)
+        buffer.close()
+        self.assertFalse(buffer.offer([1]))
@@ -0,0 +1,51 @@
+import datetime
+import unittest
+from sqlalchemy import (
+    Column,
+    MetaData,
+    Table,
+)
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.dialects.postgresql import TEXT
+from ..bulk import (
+    format_copy_value,
+    make_copy_statement,
+    make_csv_buffer,
+)
+
+
+class BulkTest(unittest.TestCase):
+    def test_format_copy_value(self):
+        cases = [
+            ('some_str', 'some_str'),
+            (True, 'true'),
+            (False, 'false'),
+            (1.5, '1.5'),
+            (float('inf'), 'Infinity'),
+            (float('-inf'), '-Infinity'),
+            (float('nan'), 'NaN'),
+            (
+                datetime.datetime(2017, 5, 8, 0, 1, 2, 3),
+                '2017-05-08T00:01:02.000003',
+            ),
+        ]
+        for input_, expected in cases:
+            actual = format_copy_value(input_)
+            self.assertEqual(actual, expected)
+
+    def test_make_csv_buffer(self):
+        rows = [
+            {'a': 'x,"y"', 'b': 1.5},
+            {'a': '', 'b': True},
+        ]
+        actual = make_csv_buffer(['a', 'b'], rows).read()
+        self.assertEqual(actual, '"x,""y""","1.5"\n"","true"\n')
+
+    def test_make_copy_statement(self):
+        table = Table('et_some', MetaData(), Column('a', TEXT), schema='s')
+        preparer = postgresql.dialect().identifier_preparer
+        actual = make_copy_statement(preparer, table, ['a', 'user'])
+        self.assertEqual(
+            actual,
+            'COPY s.et_some (a, "user") FROM STDIN WITH (FORMAT csv)',
+        )
@@ -1,91 +1,402 @@
 import unittest
-import datetime
+import gzip
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+from requests import ConnectionError, HTTPError, Response
 
-from ..client import Client
+from ..client import Client, _parse_retry_after
+from ..spool import Spool
+
+
+class FakePost(object):
+    def __init__(self):
+        self.bodies = []
+        self.error = None
+
+    def __call__(self, body):
+        if self.error is not None:
+            raise self.error
+        self.bodies.append(json.loads(body))
+
+
+def _make_http_error(status_code, headers=None):
+    response = Response()
+    response.status_code = status_code
+    response.headers.update(headers or {})
+    return HTTPError(response=response)
 
 
 class ClientTest(unittest.TestCase):
     def _make_dummy_client(self):
         return Client('http://localhost:3000/', upload=False)
 
-    def test_sanitize_attributes(self):
-        input_ = None
+    def test_prepare_request_body(self):
+        input_ = []
+        expected = b'{"events":[]}'
         client = self._make_dummy_client()
-        actual = client._sanitize_attributes(None)
-        self.assertEqual(actual, None)
-
-        input_ = {
-            'some_string': 'some_string',
-            'some_bool': True,
-            'some_int': 1,
-            'some_float': 1.5,
-            1: 2,
-            'something_else': {},
-        }
-        actual = client._sanitize_attributes(input_)
-        self.assertEqual(
-            input_['some_string'],
-            actual['some_string'],
+        actual = client._prepare_request_body(input_)
+        self.assertEqual(actual, expected)
+
+        input_ = [b'{"_event_raw":"a"}', b'{"_event_raw":"b"}']
+        expected = b'{"events":[{"_event_raw":"a"},{"_event_raw":"b"}]}'
+        actual = client._prepare_request_body(input_)
+        self.assertEqual(actual, expected)
+
+    def test_encode_request_body(self):
+        body = b'{"events":[]}'
+        client = self._make_dummy_client()
+        self.assertEqual((body, {}), client._encode_request_body(body))
+
+        client = Client(
+            'http://localhost:3000/',
+            upload=False,
+            compress=True,
+            compress_min_size=20,
         )
-        self.assertEqual(
-            input_['some_bool'],
-            actual['some_bool'],
+        # should not compress small bodies
+        self.assertEqual((body, {}), client._encode_request_body(body))
+
+        body = client._prepare_request_body([b'{"_event_raw":"a"}'] * 10)
+        data, headers = client._encode_request_body(body)
+        self.assertEqual({'Content-Encoding': 'gzip'}, headers)
+        self.assertEqual(body, gzip.decompress(data))
+
+    def _make_spooling_client(self, **kwargs):
+        spool_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, spool_dir)
+        client = Client(
+            'http://localhost:3000/',
+            upload=False,
+            spool_dir=spool_dir,
+            **kwargs
         )
+        client._running = True
+        client._post_body = FakePost()
+        return client
+
+    def _event_raws(self, body):
+        if isinstance(body, dict):
+            body = body['events']
+        else:
+            body = [json.loads(event.decode('utf-8')) for event in body]
+        return [event['_event_raw'] for event in body]
+
+    def test_spool_failed_uploads(self):
+        client = self._make_spooling_client()
+        client._post_body.error = ConnectionError()
+        client._upload([
+            client._make_event('a', None, None),
+            client._make_event('b', None, None),
+        ])
+        self.assertTrue(client._is_backing_off())
+
+        # should spool without uploading while backing off
+        client._post_body.error = None
+        client._upload([client._make_event('c', None, None)])
+        self.assertEqual([], client._post_body.bodies)
+
+        # should replay in order once the backoff expires
+        client._next_attempt_at = 0.0
+        client._replay_spool()
         self.assertEqual(
-            input_['some_int'],
-            actual['some_int'],
+            [['a', 'b'], ['c']],
+            [self._event_raws(b) for b in client._post_body.bodies],
         )
+        self.assertTrue(client._spool.is_empty())
+
+    def test_spool_behind_spooled_events(self):
+        client = self._make_spooling_client()
+        client._spool_events([client._make_event('a', None, None)])
+        # another worker is replaying the spool
+        client._replay_lock.acquire()
+        client._upload([client._make_event('b', None, None)])
+        self.assertEqual([], client._post_body.bodies)
+        client._replay_lock.release()
+
+        client._replay_spool()
         self.assertEqual(
-            input_['some_float'],
-            actual['some_float'],
+            [['a'], ['b']],
+            [self._event_raws(b) for b in client._post_body.bodies],
         )
-        self.assertTrue(1 in input_)
-        self.assertTrue(1 not in actual)
-        self.assertTrue('something_else' in input_)
-        self.assertTrue('something_else' not in actual)
 
-    def test_serialize_event(self):
-        client = self._make_dummy_client()
-        sample_date = datetime.datetime(
-            2017, 5, 8,
-            hour=0, minute=1, second=2, microsecond=3
-        )
-        input_ = {
-            'some_string': 'some_string',
-            'some_bool': True,
-            'some_int': 1,
-            'some_float': 1.5,
-            'some_date': sample_date,
-        }
-        actual = client._serialize_event(input_)
+    def test_spool_pending_at_exit(self):
+        client = self._make_spooling_client()
+        client._carry = client._make_event('a', None, None)
+        client.track('b')
+        client.track('c')
+        client._cleanup()
+        self.assertEqual(0, client._queue.qsize())
+
+        spool = Spool(client._spool._directory)
+        payload = spool.peek()
+        spool.close()
         self.assertEqual(
-            input_['some_string'],
-            actual['some_string'],
+            ['a', 'b', 'c'],
+            [e['_event_raw'] for e in json.loads(payload.decode('utf-8'))],
         )
+
+    def test_spool_replay_failure(self):
+        client = self._make_spooling_client()
+        client._spool_events([client._make_event('a', None, None)])
+        client._post_body.error = ConnectionError()
+        client._replay_spool()
+        self.assertTrue(client._is_backing_off())
+        self.assertFalse(client._spool.is_empty())
+
+        # should drop records rejected by the server
+        response = Response()
+        response.status_code = 400
+        client._post_body.error = HTTPError(response=response)
+        client._next_attempt_at = 0.0
+        client._replay_spool()
+        self.assertTrue(client._spool.is_empty())
+
+    def test_spool_queue_overflow(self):
+        client = self._make_spooling_client(max_queue_size=1)
+        self.assertTrue(client.track('a'))
+        self.assertTrue(client.track('b'))
+        self.assertEqual(1, client._queue.qsize())
+        client._replay_spool()
         self.assertEqual(
-            input_['some_bool'],
-            actual['some_bool'],
+            [['b']],
+            [self._event_raws(b) for b in client._post_body.bodies],
         )
-        self.assertEqual(
-            input_['some_int'],
-            actual['some_int'],
+
+    def test_gather_next_batch(self):
+        client = Client(
+            'http://localhost:3000/',
+            upload=False,
+            upload_size=3,
+            linger_ms=0,
         )
-        self.assertEqual(
-            input_['some_float'],
-            actual['some_float'],
+        for i in range(4):
+            client.track(str(i))
+        events = client._gather_next_batch()
+        self.assertEqual(['0', '1', '2'], self._event_raws(events))
+        events = client._gather_next_batch()
+        self.assertEqual(['3'], self._event_raws(events))
+
+    def test_gather_next_batch_max_bytes(self):
+        client = Client(
+            'http://localhost:3000/',
+            upload=False,
+            linger_ms=0,
+            max_batch_bytes=500,
         )
-        self.assertEqual(
-            actual['some_date']['$type'],
-            'date',
+        for i in range(4):
+            client.track(str(i), attributes={'some_str': 'x' * 50})
+        for _ in range(2):
+            events = client._gather_next_batch()
+            self.assertEqual(2, len(events))
+            body = client._prepare_request_body(events)
+            self.assertTrue(len(body) <= 500)
+
+        # should send an event larger than max_batch_bytes alone
+        client.track('big', attributes={'some_str': 'x' * 500})
+        client.track('small')
+        self.assertEqual(1, len(client._gather_next_batch()))
+        self.assertEqual(1, len(client._gather_next_batch()))
+
+    def test_upload_workers(self):
+        client = Client(
+            'http://localhost:3000/',
+            upload_size=1,
+            max_upload_size=1,
+            linger_ms=0,
+            upload_workers=3,
         )
+        self.addCleanup(client._cleanup)
+        adapter = client._session.get_adapter('http://localhost:3000/')
+        self.assertEqual(3, adapter._pool_maxsize)
+
+        # should have 3 uploads in flight at the same time
+        barrier = threading.Barrier(3, timeout=5)
+        bodies = []
+
+        def post_body(body):
+            barrier.wait()
+            bodies.append(json.loads(body))
+        client._post_body = post_body
+        for i in range(6):
+            client.track(str(i))
+        client.flush()
+        self.assertEqual(6, len(bodies))
+        self.assertFalse(barrier.broken)
+
+        client._cleanup()
+        for worker in client._workers:
+            self.assertFalse(worker.is_alive())
+
+    def test_rebuild_after_fork(self):
+        client = self._make_spooling_client(spool_pending_on_fork=True)
+        client.track('a')
+        client.track('b')
+        client._before_fork()
+        self.assertEqual(0, client._queue.qsize())
+        self.assertFalse(client._spool.is_empty())
+
+        queue = client._queue
+        session = client._session
+        spool = client._spool
+        # pretend to be a forked child
+        client._pid = -1
+        client.flush()
+        self.assertEqual(os.getpid(), client._pid)
+        self.assertFalse(queue is client._queue)
+        self.assertFalse(session is client._session)
+        self.assertFalse(spool is client._spool)
+        self.assertTrue(client._spool.is_empty())
+        self.assertTrue(os.path.basename(
+            client._spool._directory
+        ).startswith('fork-'))
+
+    def test_rebuild_after_fork_once(self):
+        client = Client('http://localhost:3000/', upload=False)
+        rebuilds = []
+        rebuild = client._rebuild_in_child
+
+        def slow_rebuild():
+            rebuilds.append(1)
+            time.sleep(0.05)
+            rebuild()
+        client._rebuild_in_child = slow_rebuild
+        # pretend to be a forked child
+        client._pid = -1
+        threads = [
+            threading.Thread(target=client.track, args=('a',))
+            for _ in range(4)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(1, len(rebuilds))
+        self.assertEqual(4, client._queue.qsize())
+
+    @unittest.skipUnless(hasattr(os, 'register_at_fork'), 'requires fork')
+    def test_fork(self):
+        client = Client('http://localhost:3000/', linger_ms=0)
+        self.addCleanup(client._cleanup)
+        bodies = []
+        client._post_body = lambda body: bodies.append(body)
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            try:
+                client.track('a')
+                client.flush()
+                alive = all(w.is_alive() for w in client._workers)
+                os.write(write_fd, b'1' if alive and bodies else b'0')
+            finally:
+                os._exit(0)
+        os.close(write_fd)
+        with os.fdopen(read_fd, 'rb') as f:
+            self.assertEqual(b'1', f.read())
+        os.waitpid(pid, 0)
+
+    def test_overflow_to_spool(self):
+        client = self._make_spooling_client(
+            max_queue_bytes=300,
+            overflow='drop_oldest',
+        )
+        for i in range(3):
+            self.assertTrue(client.track(str(i)))
+        stats = client.stats()
+        self.assertEqual(1, stats['dropped_records'])
+        self.assertTrue(stats['queued_bytes'] <= 300)
+        client._replay_spool()
         self.assertEqual(
-            actual['some_date']['$date'],
-            '2017-05-08T00:01:02.000003Z',
+            [['0']],
+            [self._event_raws(b) for b in client._post_body.bodies],
         )
 
-    def test_prepare_request_body(self):
-        input_ = []
-        expected = '{"events":[]}'
+    def test_sampling(self):
+        client = self._make_spooling_client(
+            sample_rates={'scroll': 0.5},
+            rate_limits={'heartbeat': (0.001, 1)},
+        )
+        for i in range(100):
+            client.track('scroll', user_id='user-{}'.format(i))
+        self.assertTrue(client.track('heartbeat'))
+        self.assertEqual(False, client.track('heartbeat'))
+        stats = client.stats()
+        self.assertEqual(1, stats['rate_limited_records'])
+        sampled_out = stats['sampled_out_records']
+        self.assertTrue(0 < sampled_out < 100)
+        self.assertEqual(101 - sampled_out, stats['queued_records'])
+
+        event = json.loads(client._queue.get().decode('ascii'))
+        self.assertEqual(0.5, event['_sample_rate'])
+
+    def test_parse_retry_after(self):
+        self.assertEqual(3.0, _parse_retry_after('3'))
+        self.assertEqual(0.0, _parse_retry_after('-1'))
+        self.assertEqual(0.0, _parse_retry_after(
+            'Wed, 21 Oct 2015 07:28:00 GMT',
+        ))
+        self.assertEqual(None, _parse_retry_after('soon'))
+        self.assertEqual(None, _parse_retry_after(None))
+
+    def test_throttled_upload_is_held(self):
+        client = Client('http://localhost:3000/', upload=False)
+        client._running = True
+        errors = [
+            _make_http_error(503, {
+                'Retry-After': '0',
+                'X-Suggested-Batch-Size': '20',
+            }),
+            _make_http_error(429),
+        ]
+        bodies = []
+
+        def post_body(body):
+            if errors:
+                raise errors.pop(0)
+            bodies.append(json.loads(body))
+
+        client._post_body = post_body
+        client._backoff_base = 0.001
+        client._upload([client._make_event('a', None, None)])
+        self.assertEqual([['a']], [self._event_raws(b) for b in bodies])
+        self.assertEqual(20, client._batch_size.value)
+        self.assertEqual(0, client._failures)
+
+        # should not hold events rejected for other reasons
+        errors.append(_make_http_error(500))
+        with self.assertRaises(HTTPError):
+            client._upload([client._make_event('b', None, None)])
+
+    def test_throttled_upload_is_spooled(self):
+        client = self._make_spooling_client()
+        client._post_body.error = _make_http_error(429, {
+            'Retry-After': '60',
+            'X-Suggested-Batch-Size': '5',
+        })
+        client._upload([client._make_event('a', None, None)])
+        self.assertEqual(5, client._batch_size.value)
+        self.assertTrue(client._next_attempt_at - time.monotonic() > 50)
+        self.assertFalse(client._spool.is_empty())
+
+    def test_cleanup_interrupts_backoff(self):
+        client = Client('http://localhost:3000/', upload=False)
+        client._running = True
+        client._next_attempt_at = time.monotonic() + 60
+        threading.Timer(0.01, client._cleanup).start()
+        start = time.monotonic()
+        client._wait_for_backoff()
+        self.assertTrue(time.monotonic() - start < 5)
+
+    def test_track_stamps_event_id(self):
         client = self._make_dummy_client()
-        actual = client._prepare_request_body(input_)
-        self.assertEqual(actual, expected)
+        client.track('a')
+        client.track('a')
+        events = [
+            json.loads(client._queue.get().decode('ascii'))
+            for _ in range(2)
+        ]
+        self.assertEqual(36, len(events[0]['_id']))
+        self.assertNotEqual(events[0]['_id'], events[1]['_id'])
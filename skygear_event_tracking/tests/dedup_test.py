@@ -0,0 +1,52 @@
+import datetime
+import unittest
+
+from ..dedup import RecentEventIds
+from ..utils import SingleEvent
+
+
+class RecentEventIdsTest(unittest.TestCase):
+    def _make_events(self, *event_ids, event_raw='Event A'):
+        return [
+            SingleEvent(
+                event_id=event_id,
+                received_at=datetime.datetime.utcnow(),
+                json_dict={'_event_raw': event_raw},
+            )
+            for event_id in event_ids
+        ]
+
+    def _ids(self, events):
+        return [e.attributes['_id'] for e in events]
+
+    def test_filter(self):
+        recent_ids = RecentEventIds(maxsize=2)
+        events = self._make_events('a', 'b', 'a')
+        # should drop duplicates within a batch
+        self.assertEqual(['a', 'b'], self._ids(recent_ids.filter(events)))
+        # should not drop events that are not written yet
+        self.assertEqual(['a', 'b'], self._ids(recent_ids.filter(events)))
+
+        recent_ids.add(self._make_events('a', 'b'))
+        events = self._make_events('a', 'c')
+        self.assertEqual(['c'], self._ids(recent_ids.filter(events)))
+
+        # should forget the least recently written
+        recent_ids.add(self._make_events('a', 'c'))
+        self.assertEqual(2, len(recent_ids))
+        self.assertTrue(('event_a', 'a') in recent_ids)
+        self.assertFalse(('event_a', 'b') in recent_ids)
+
+    def test_same_id_of_other_event(self):
+        recent_ids = RecentEventIds()
+        recent_ids.add(self._make_events('a'))
+        # an _id is only unique within the table of its event
+        events = self._make_events('a', event_raw='Event B')
+        self.assertEqual(['a'], self._ids(recent_ids.filter(events)))
+
+    def test_zero_maxsize(self):
+        recent_ids = RecentEventIds(maxsize=0)
+        events = self._make_events('a', 'a')
+        self.assertEqual(['a'], self._ids(recent_ids.filter(events)))
+        recent_ids.add(events)
+        self.assertEqual(0, len(recent_ids))
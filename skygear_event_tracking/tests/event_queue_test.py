@@ -0,0 +1,76 @@
+import threading
+import unittest
+from queue import Empty, Full
+
+from ..event_queue import ByteBoundedQueue
+
+
+class ByteBoundedQueueTest(unittest.TestCase):
+    def test_drop_newest(self):
+        queue = ByteBoundedQueue(max_bytes=10)
+        self.assertEqual([], queue.put(b'12345'))
+        self.assertEqual([], queue.put(b'1234'))
+        with self.assertRaises(Full):
+            queue.put(b'12')
+        # should reject a record larger than max_bytes
+        with self.assertRaises(Full):
+            queue.put(b'x' * 11)
+        self.assertEqual({
+            'queued_records': 2,
+            'queued_bytes': 9,
+            'dropped_records': 2,
+            'dropped_bytes': 13,
+        }, queue.stats())
+        self.assertEqual(b'12345', queue.get())
+        self.assertEqual([], queue.put(b'12'))
+
+    def test_max_items(self):
+        queue = ByteBoundedQueue(max_bytes=100, max_items=1)
+        queue.put(b'a')
+        with self.assertRaises(Full):
+            queue.put(b'b')
+
+    def test_drop_oldest(self):
+        queue = ByteBoundedQueue(max_bytes=10, overflow='drop_oldest')
+        queue.put(b'111')
+        queue.put(b'222')
+        queue.put(b'333')
+        self.assertEqual([b'111', b'222'], queue.put(b'4444444'))
+        self.assertEqual(2, queue.qsize())
+        self.assertEqual(2, queue.stats()['dropped_records'])
+        self.assertEqual(b'333', queue.get())
+        queue.task_done()
+        self.assertEqual(b'4444444', queue.get())
+        queue.task_done()
+        # evicted records should not hold join
+        queue.join()
+
+    def test_block(self):
+        queue = ByteBoundedQueue(
+            max_bytes=4,
+            overflow='block',
+            block_timeout=0.01,
+        )
+        queue.put(b'1234')
+        with self.assertRaises(Full):
+            queue.put(b'5')
+
+        queue = ByteBoundedQueue(max_bytes=4, overflow='block')
+        queue.put(b'1234')
+        threading.Timer(0.01, queue.get).start()
+        self.assertEqual([], queue.put(b'5'))
+        self.assertEqual(1, queue.qsize())
+
+    def test_get(self):
+        queue = ByteBoundedQueue(max_bytes=10)
+        with self.assertRaises(Empty):
+            queue.get(block=False)
+        with self.assertRaises(Empty):
+            queue.get(timeout=0.01)
+        threading.Timer(0.01, queue.put, args=(b'a',)).start()
+        self.assertEqual(b'a', queue.get(timeout=5))
+        self.assertEqual(0, queue.stats()['queued_bytes'])
+
+    def test_unknown_overflow(self):
+        with self.assertRaises(ValueError):
+            ByteBoundedQueue(max_bytes=10, overflow='drop_random')
@@ -0,0 +1,197 @@
+import gzip
+import io
+import json
+import threading
+import unittest
+import zlib
+
+from ..handler import Handler
+
+
+class FakeRequest(object):
+    def __init__(self, body, headers=None):
+        self.headers = headers or {}
+        self.stream = io.BytesIO(body)
+
+
+class FakeWriter(object):
+    def __init__(self):
+        self.requests = []
+
+    def process_request(self, event_tracking_request):
+        chunks = []
+        self.requests.append(chunks)
+        for chunk in event_tracking_request.iter_chunks():
+            chunks.append(chunk)
+
+
+class FakeBuffer(object):
+    def __init__(self, accept):
+        self.accept = accept
+        self.offers = []
+
+    def offer(self, events, timeout=0):
+        self.offers.append((len(events), timeout))
+        return self.accept
+
+
+class HandlerTest(unittest.TestCase):
+    def _make_request(self, n=2):
+        body = json.dumps({
+            'events': [
+                {'_event_raw': 'Event {}'.format(i)} for i in range(n)
+            ],
+        })
+        return FakeRequest(body.encode('utf-8'))
+
+    def test_write_synchronously(self):
+        writer = FakeWriter()
+        handler = Handler(writer)
+        response = handler(self._make_request())
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(1, len(writer.requests[0]))
+        self.assertEqual(2, len(writer.requests[0][0]))
+
+    def test_write_synchronously_in_chunks(self):
+        writer = FakeWriter()
+        handler = Handler(writer, chunk_size=2)
+        response = handler(self._make_request(n=5))
+        self.assertEqual(200, response.status_code)
+        self.assertEqual([2, 2, 1], [len(c) for c in writer.requests[0]])
+
+    def test_malformed_body(self):
+        writer = FakeWriter()
+        handler = Handler(writer)
+        response = handler(FakeRequest(b'{"events": [{"_event_raw": 1'))
+        self.assertEqual(400, response.status_code)
+
+    def test_malformed_event_after_first_chunk(self):
+        writer = FakeWriter()
+        handler = Handler(writer, chunk_size=2)
+        body = json.dumps({
+            'events': [
+                {'_event_raw': 'Event A'},
+                {'_event_raw': 'Event B'},
+                {'no_event_raw': 1},
+            ],
+        })
+        response = handler(FakeRequest(body.encode('utf-8')))
+        # should be rejected without a retry, after the first chunk
+        self.assertEqual(400, response.status_code)
+        self.assertEqual([2], [len(c) for c in writer.requests[0]])
+
+    def test_event_too_large(self):
+        writer = FakeWriter()
+        handler = Handler(writer, max_event_size=100)
+        body = json.dumps({
+            'events': [{'_event_raw': 'Event A', 'some': 'x' * 200}],
+        })
+        response = handler(FakeRequest(body.encode('utf-8')))
+        self.assertEqual(413, response.status_code)
+
+    def test_compressed_body(self):
+        body = self._make_request(n=3).stream.getvalue()
+        for content_encoding, data in [
+            ('gzip', gzip.compress(body)),
+            ('deflate', zlib.compress(body)),
+        ]:
+            writer = FakeWriter()
+            handler = Handler(writer)
+            response = handler(FakeRequest(
+                data,
+                headers={'content-encoding': content_encoding},
+            ))
+            self.assertEqual(200, response.status_code)
+            self.assertEqual(3, len(writer.requests[0][0]))
+
+    def test_compressed_body_too_large(self):
+        body = self._make_request(n=100).stream.getvalue()
+        writer = FakeWriter()
+        handler = Handler(writer, max_decompressed_size=100)
+        response = handler(FakeRequest(
+            gzip.compress(body),
+            headers={'content-encoding': 'gzip'},
+        ))
+        self.assertEqual(413, response.status_code)
+
+    def test_unsupported_encoding(self):
+        writer = FakeWriter()
+        handler = Handler(writer)
+        response = handler(FakeRequest(
+            b'',
+            headers={'content-encoding': 'br'},
+        ))
+        self.assertEqual(415, response.status_code)
+        self.assertEqual(0, len(writer.requests))
+
+    def test_write_behind(self):
+        writer = FakeWriter()
+        buffer = FakeBuffer(accept=True)
+        handler = Handler(writer, buffer=buffer)
+        response = handler(self._make_request())
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(0, len(writer.requests))
+        self.assertEqual([(2, 0)], buffer.offers)
+
+    def test_write_behind_in_chunks(self):
+        writer = FakeWriter()
+        buffer = FakeBuffer(accept=True)
+        handler = Handler(writer, buffer=buffer, chunk_size=2)
+        response = handler(self._make_request(n=5))
+        self.assertEqual(200, response.status_code)
+        # only the first chunk may be rejected
+        self.assertEqual([(2, 0), (2, None), (1, None)], buffer.offers)
+
+    def test_write_behind_buffer_full(self):
+        writer = FakeWriter()
+        buffer = FakeBuffer(accept=False)
+        handler = Handler(writer, buffer=buffer, retry_after=2.5)
+        response = handler(self._make_request())
+        self.assertEqual(429, response.status_code)
+        self.assertEqual('3', response.headers['Retry-After'])
+        self.assertTrue('X-Suggested-Batch-Size' not in response.headers)
+
+        handler = Handler(
+            writer,
+            buffer=buffer,
+            retry_after=3,
+            suggested_batch_size=50,
+        )
+        response = handler(self._make_request())
+        self.assertEqual('50', response.headers['X-Suggested-Batch-Size'])
+
+    def test_max_in_flight(self):
+        entered = threading.Event()
+        release = threading.Event()
+
+        class BlockingWriter(FakeWriter):
+            def process_request(self, event_tracking_request):
+                entered.set()
+                release.wait(5)
+                super(BlockingWriter, self).process_request(
+                    event_tracking_request,
+                )
+
+        writer = BlockingWriter()
+        handler = Handler(
+            writer,
+            retry_after=2,
+            max_in_flight=1,
+            suggested_batch_size=10,
+        )
+        responses = []
+        thread = threading.Thread(
+            target=lambda: responses.append(handler(self._make_request())),
+        )
+        thread.start()
+        self.assertTrue(entered.wait(5))
+        response = handler(self._make_request())
+        self.assertEqual(503, response.status_code)
+        self.assertEqual('2', response.headers['Retry-After'])
+        self.assertEqual('10', response.headers['X-Suggested-Batch-Size'])
+
+        release.set()
+        thread.join()
+        self.assertEqual(200, responses[0].status_code)
+        # should admit requests once the first is done
+        self.assertEqual(200, handler(self._make_request()).status_code)
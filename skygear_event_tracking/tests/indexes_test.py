@@ -0,0 +1,178 @@
+import unittest
+from unittest import mock
+from sqlalchemy import MetaData, Table
+from sqlalchemy.dialects import postgresql
+
+from ..indexes import (
+    DEFAULT_INDEX_POLICIES,
+    IndexPolicy,
+    IndexProvisioner,
+    can_be_primary_key,
+    make_add_primary_key_statement,
+    make_create_index_statement,
+    make_not_null_check_statements,
+)
+
+
+class IndexPolicyTest(unittest.TestCase):
+    def test_is_applicable(self):
+        policy = IndexPolicy('some', ['_user_id', '_tracked_at'])
+        self.assertTrue(policy.is_applicable({'_user_id', '_tracked_at'}))
+        self.assertFalse(policy.is_applicable({'_user_id'}))
+
+    def test_key_columns(self):
+        policy = IndexPolicy('pkey', ['_id'], primary=True)
+        self.assertEqual(['_id'], policy.key_columns())
+        self.assertEqual(
+            ['_id', '_received_at'],
+            policy.key_columns('_received_at'),
+        )
+
+        policy = IndexPolicy('some', ['_id'])
+        self.assertEqual(['_id'], policy.key_columns('_received_at'))
+
+    def test_index_name(self):
+        policy = DEFAULT_INDEX_POLICIES[0]
+        self.assertEqual('et_some__pkey', policy.index_name('et_some'))
+
+        # should not collide after truncation by PostgreSQL
+        prefix = 'et_' + 'x' * 60
+        lhs = policy.index_name(prefix + '_a')
+        rhs = policy.index_name(prefix + '_b')
+        self.assertNotEqual(lhs, rhs)
+        self.assertEqual(63, len(lhs))
+        self.assertTrue(lhs.startswith(prefix[:40]))
+        self.assertTrue(lhs.endswith('__pkey'))
+
+    def test_can_be_primary_key(self):
+        policy = DEFAULT_INDEX_POLICIES[0]
+        self.assertTrue(can_be_primary_key(policy))
+        self.assertTrue(can_be_primary_key(policy, '_received_at'))
+        # _tracked_at is NULL for events that do not send it
+        self.assertFalse(can_be_primary_key(policy, '_tracked_at'))
+
+
+class IndexStatementTest(unittest.TestCase):
+    def setUp(self):
+        self.preparer = postgresql.dialect().identifier_preparer
+        self.table = Table('et_some', MetaData(), schema='s')
+
+    def test_make_create_index_statement(self):
+        policy = IndexPolicy('received_at', ['_received_at'], method='brin')
+        actual = make_create_index_statement(
+            self.preparer,
+            self.table,
+            policy,
+            concurrently=True,
+        )
+        self.assertEqual(
+            actual,
+            'CREATE INDEX CONCURRENTLY IF NOT EXISTS et_some__received_at '
+            'ON s.et_some USING brin (_received_at)',
+        )
+
+        actual = make_create_index_statement(
+            self.preparer,
+            self.table,
+            policy,
+            only=True,
+        )
+        self.assertEqual(
+            actual,
+            'CREATE INDEX IF NOT EXISTS et_some__received_at '
+            'ON ONLY s.et_some USING brin (_received_at)',
+        )
+
+    def test_make_add_primary_key_statement(self):
+        policy = IndexPolicy('pkey', ['_id'], primary=True)
+        actual = make_add_primary_key_statement(
+            self.preparer,
+            self.table,
+            policy,
+            partition_column='_received_at',
+        )
+        self.assertEqual(
+            actual,
+            'ALTER TABLE s.et_some ADD CONSTRAINT et_some__pkey '
+            'PRIMARY KEY (_id, _received_at)',
+        )
+
+        actual = make_add_primary_key_statement(
+            self.preparer,
+            self.table,
+            policy,
+            using_index=True,
+        )
+        self.assertEqual(
+            actual,
+            'ALTER TABLE s.et_some ADD CONSTRAINT et_some__pkey '
+            'PRIMARY KEY USING INDEX et_some__pkey',
+        )
+
+    def test_make_not_null_check_statements(self):
+        policy = IndexPolicy('pkey', ['_id'], primary=True)
+        actual = make_not_null_check_statements(
+            self.preparer,
+            self.table,
+            policy,
+        )
+        self.assertEqual([
+            'ALTER TABLE s.et_some DROP CONSTRAINT IF EXISTS '
+            'et_some__pkey_not_null',
+            'ALTER TABLE s.et_some ADD CONSTRAINT et_some__pkey_not_null '
+            'CHECK (_id IS NOT NULL) NOT VALID',
+            'ALTER TABLE s.et_some VALIDATE CONSTRAINT '
+            'et_some__pkey_not_null',
+        ], actual)
+
+
+class IndexProvisionerTest(unittest.TestCase):
+    def _make_conn(self, attached, fail_on=None):
+        class FakeConn(object):
+            dialect = postgresql.dialect()
+
+            def __init__(self):
+                self.statements = []
+
+            def execute(self, stmt, **kwargs):
+                if kwargs:
+                    result = mock.Mock()
+                    result.scalar.return_value = \
+                        kwargs['partition_name'] in attached
+                    return result
+                self.statements.append(stmt)
+                if fail_on is not None and fail_on in stmt:
+                    raise RuntimeError(stmt)
+
+        return FakeConn()
+
+    def _provision(self, conn, partitions):
+        provisioner = IndexProvisioner(None, 's', 'et_')
+        table = Table('et_some', MetaData(), schema='s')
+        policy = IndexPolicy('received_at', ['_received_at'], method='brin')
+        path = 'skygear_event_tracking.indexes.list_partitions'
+        with mock.patch(path, return_value=partitions):
+            provisioner._provision_partitioned(conn, table, policy)
+
+    def test_skip_partitions_with_attached_index(self):
+        conn = self._make_conn(attached=['et_some__p201712'])
+        self._provision(conn, ['et_some__p201712', 'et_some__p201801'])
+        self.assertEqual([
+            'CREATE INDEX IF NOT EXISTS et_some__received_at '
+            'ON ONLY s.et_some USING brin (_received_at)',
+            'CREATE INDEX CONCURRENTLY IF NOT EXISTS '
+            'et_some__p201801__received_at '
+            'ON s.et_some__p201801 USING brin (_received_at)',
+            'ALTER INDEX s.et_some__received_at '
+            'ATTACH PARTITION s.et_some__p201801__received_at',
+        ], conn.statements)
+
+    def test_drop_partition_index_on_failure(self):
+        conn = self._make_conn(attached=[], fail_on='ATTACH')
+        self._provision(conn, ['et_some__p201801'])
+        # should never drop the parent index
+        self.assertEqual(
+            'DROP INDEX CONCURRENTLY IF EXISTS '
+            's.et_some__p201801__received_at',
+            conn.statements[-1],
+        )
@@ -0,0 +1,155 @@
+import datetime
+import unittest
+from sqlalchemy import (
+    Column,
+    MetaData,
+    Table,
+)
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.dialects.postgresql import (
+    TEXT,
+    TIMESTAMP,
+)
+from ..partition import (
+    PartitionScheme,
+    make_create_default_partition_statement,
+    make_create_partition_statement,
+    make_create_partitioned_table_statement,
+)
+
+
+class PartitionSchemeTest(unittest.TestCase):
+    def test_invalid_arguments(self):
+        with self.assertRaises(ValueError):
+            PartitionScheme(column='some_column')
+        with self.assertRaises(ValueError):
+            PartitionScheme(interval='year')
+
+    def test_monthly(self):
+        scheme = PartitionScheme(interval='month', ahead=1)
+        dt = datetime.datetime(2017, 12, 31, 23, 59)
+        start = scheme.floor(dt)
+        self.assertEqual(datetime.datetime(2017, 12, 1), start)
+        self.assertEqual(
+            datetime.datetime(2018, 1, 1),
+            scheme.next_start(start),
+        )
+        name = scheme.partition_name('et_some', start)
+        self.assertEqual('et_some__p201712', name)
+        self.assertEqual(start, scheme.parse_partition_start('et_some', name))
+        self.assertEqual(
+            None,
+            scheme.parse_partition_start('et_some', 'et_some__default'),
+        )
+
+    def test_daily(self):
+        scheme = PartitionScheme(interval='day', ahead=1)
+        dt = datetime.datetime(2017, 2, 28, 12)
+        start = scheme.floor(dt)
+        self.assertEqual(datetime.datetime(2017, 2, 28), start)
+        self.assertEqual(
+            datetime.datetime(2017, 3, 1),
+            scheme.next_start(start),
+        )
+        self.assertEqual(
+            'et_some__p20170228',
+            scheme.partition_name('et_some', start),
+        )
+
+    def test_compute_starts(self):
+        scheme = PartitionScheme(interval='month', ahead=1)
+        values = [datetime.datetime(2017, 1, 5), None, 'not a date']
+        now = datetime.datetime(2017, 3, 10)
+        actual = scheme.compute_starts(values, now)
+        self.assertEqual({
+            datetime.datetime(2017, 1, 1),
+            datetime.datetime(2017, 3, 1),
+            datetime.datetime(2017, 4, 1),
+        }, actual)
+
+    def test_compute_starts_outside_window(self):
+        scheme = PartitionScheme(interval='month', ahead=1, behind=1)
+        values = [
+            datetime.datetime(1970, 1, 1),
+            datetime.datetime(2017, 2, 5),
+            datetime.datetime(2017, 5, 1),
+            datetime.datetime(2099, 1, 1),
+        ]
+        now = datetime.datetime(2017, 3, 10)
+        actual = scheme.compute_starts(values, now)
+        self.assertEqual({
+            datetime.datetime(2017, 2, 1),
+            datetime.datetime(2017, 3, 1),
+            datetime.datetime(2017, 4, 1),
+        }, actual)
+
+    def test_long_table_name(self):
+        scheme = PartitionScheme(interval='month')
+        first = 'et_' + 'a' * 70 + '_first'
+        second = 'et_' + 'a' * 70 + '_second'
+        start = datetime.datetime(2017, 12, 1)
+        first_name = scheme.partition_name(first, start)
+        second_name = scheme.partition_name(second, start)
+        self.assertNotEqual(first_name, second_name)
+        self.assertEqual(63, len(first_name))
+        self.assertTrue(first_name.endswith('__p201712'))
+        self.assertNotEqual(
+            first_name,
+            scheme.partition_name(first, datetime.datetime(2018, 1, 1)),
+        )
+        self.assertEqual(
+            start,
+            scheme.parse_partition_start(first, first_name),
+        )
+        self.assertEqual(
+            None,
+            scheme.parse_partition_start(second, first_name),
+        )
+
+
+class PartitionStatementTest(unittest.TestCase):
+    def setUp(self):
+        self.dialect = postgresql.dialect()
+        self.table = Table(
+            'et_some',
+            MetaData(),
+            Column('_received_at', TIMESTAMP),
+            Column('some_str', TEXT),
+            schema='s',
+        )
+
+    def test_make_create_partitioned_table_statement(self):
+        actual = make_create_partitioned_table_statement(
+            self.dialect,
+            self.table,
+            '_received_at',
+        )
+        self.assertTrue(actual.startswith('\nCREATE TABLE s.et_some ('))
+        self.assertTrue(actual.endswith(') PARTITION BY RANGE (_received_at)'))
+
+    def test_make_create_partition_statement(self):
+        scheme = PartitionScheme(interval='month')
+        actual = make_create_partition_statement(
+            self.dialect,
+            self.table,
+            scheme,
+            datetime.datetime(2017, 12, 1),
+        )
+        self.assertEqual(
+            actual,
+            'CREATE TABLE IF NOT EXISTS s.et_some__p201712 '
+            'PARTITION OF s.et_some '
+            'FOR VALUES FROM (\'2017-12-01 00:00:00\') '
+            'TO (\'2018-01-01 00:00:00\')',
+        )
+
+    def test_make_create_default_partition_statement(self):
+        actual = make_create_default_partition_statement(
+            self.dialect,
+            self.table,
+        )
+        self.assertEqual(
+            actual,
+            'CREATE TABLE IF NOT EXISTS s.et_some__default '
+            'PARTITION OF s.et_some DEFAULT',
+        )
@@ -0,0 +1,150 @@
+import datetime
+import unittest
+from unittest import mock
+from sqlalchemy.dialects import postgresql
+
+from ..partition import PartitionScheme
+from ..retention import (
+    RetentionPolicy,
+    RetentionWorker,
+    find_expired_partitions,
+    make_batch_delete_statement,
+    make_drop_partition_statements,
+)
+
+
+class RetentionPolicyTest(unittest.TestCase):
+    def test_days_for(self):
+        policy = RetentionPolicy({
+            'Heartbeat': 7,
+            'page_*': 30,
+            'page_view_*': 60,
+            '*': 365,
+        })
+        cases = [
+            ('heartbeat', 7),
+            ('page_scroll', 30),
+            ('page_view_home', 60),
+            ('purchase', 365),
+        ]
+        for event_norm, expected in cases:
+            self.assertEqual(expected, policy.days_for(event_norm))
+
+    def test_days_for_unmatched(self):
+        policy = RetentionPolicy({'heartbeat': 7})
+        self.assertEqual(None, policy.days_for('purchase'))
+
+
+class RetentionTest(unittest.TestCase):
+    def test_find_expired_partitions(self):
+        scheme = PartitionScheme(interval='month')
+        partition_names = [
+            'et_some__p201701',
+            'et_some__p201702',
+            'et_some__p201703',
+            'et_some__default',
+        ]
+        cutoff = datetime.datetime(2017, 3, 1)
+        actual = find_expired_partitions(
+            scheme,
+            'et_some',
+            partition_names,
+            cutoff,
+        )
+        self.assertEqual(['et_some__p201701', 'et_some__p201702'], actual)
+
+    def test_make_drop_partition_statements(self):
+        preparer = postgresql.dialect().identifier_preparer
+        actual = make_drop_partition_statements(
+            preparer,
+            's',
+            'et_some',
+            'et_some__p201701',
+        )
+        self.assertEqual([
+            'ALTER TABLE s.et_some DETACH PARTITION s.et_some__p201701',
+            'DROP TABLE s.et_some__p201701',
+        ], actual)
+
+    def test_make_batch_delete_statement(self):
+        preparer = postgresql.dialect().identifier_preparer
+        actual = make_batch_delete_statement(preparer, 's', 'et_some')
+        self.assertEqual(
+            str(actual),
+            'DELETE FROM s.et_some WHERE ctid = ANY(ARRAY('
+            'SELECT ctid FROM s.et_some WHERE _received_at < :cutoff '
+            'LIMIT :batch_size))',
+        )
+
+        actual = make_batch_delete_statement(
+            preparer,
+            's',
+            'et_some',
+            partitioned=True,
+        )
+        self.assertTrue('ctid' not in str(actual))
+        self.assertEqual(
+            str(actual),
+            'DELETE FROM s.et_some WHERE _received_at < :cutoff AND _id IN ('
+            'SELECT _id FROM s.et_some WHERE _received_at < :cutoff '
+            'LIMIT :batch_size)',
+        )
+
+    def test_expire_partitioned_table_without_scheme(self):
+        class RecordingWorker(RetentionWorker):
+            def _delete_expired_rows(self, table_name, cutoff, **kwargs):
+                self.deleted = (table_name, cutoff, kwargs)
+
+            def _drop_expired_partitions(self, conn, table_name, cutoff):
+                raise AssertionError('no partition scheme')
+
+        worker = RecordingWorker(
+            engine=None,
+            schema='s',
+            table_prefix='et_',
+            policy=RetentionPolicy({'*': 30}),
+        )
+        now = datetime.datetime(2017, 5, 8)
+        path = 'skygear_event_tracking.retention.list_tables'
+        with mock.patch(path, return_value=[('et_some', 'p')]):
+            worker._expire_tables(None, now)
+        self.assertEqual(
+            ('et_some', datetime.datetime(2017, 4, 8), {'partitioned': True}),
+            worker.deleted,
+        )
+
+    def test_expire_default_partition(self):
+        class RecordingWorker(RetentionWorker):
+            def _delete_expired_rows(self, table_name, cutoff, **kwargs):
+                self.deleted = (table_name, cutoff, kwargs)
+
+        engine = mock.MagicMock()
+        engine.dialect = postgresql.dialect()
+        worker = RecordingWorker(
+            engine=engine,
+            schema='s',
+            table_prefix='et_',
+            policy=RetentionPolicy({'*': 30}),
+            partition_scheme=PartitionScheme(interval='month'),
+        )
+        now = datetime.datetime(2017, 5, 8)
+        partitions = ['et_some__p201703', 'et_some__default']
+        with mock.patch(
+            'skygear_event_tracking.retention.list_tables',
+            return_value=[('et_some', 'p')],
+        ), mock.patch(
+            'skygear_event_tracking.retention.list_partitions',
+            return_value=partitions,
+        ):
+            worker._expire_tables(None, now)
+        # should drop the expired range partition
+        txn_conn = engine.begin.return_value.__enter__.return_value
+        self.assertEqual(
+            'DROP TABLE s.et_some__p201703',
+            txn_conn.execute.call_args_list[-1][0][0],
+        )
+        # should delete expired rows of the default partition by ctid
+        self.assertEqual(
+            ('et_some__default', datetime.datetime(2017, 4, 8), {}),
+            worker.deleted,
+        )
@@ -0,0 +1,134 @@
+import datetime
+import unittest
+from sqlalchemy import (
+    Column,
+    MetaData,
+    Table,
+)
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.dialects.postgresql import (
+    TEXT,
+    TIMESTAMP,
+)
+
+from ..rollup import (
+    SKETCH_BITS,
+    aggregate_events,
+    compute_rollup_table_name,
+    compute_sketch_position,
+    estimate_distinct_users,
+    format_sketch,
+    make_rebuild_statements,
+    make_upsert_statement,
+)
+from ..utils import SingleEvent, sanitize_for_db
+
+
+class RollupTest(unittest.TestCase):
+    def test_compute_rollup_table_name(self):
+        actual = compute_rollup_table_name('et_')
+        self.assertEqual('et___rollup_hourly', actual)
+        # should not be the table of any event
+        self.assertNotEqual(
+            actual,
+            'et_' + sanitize_for_db('__rollup_hourly'),
+        )
+
+    def test_compute_sketch_position(self):
+        # md5('user') starts with ee11cbb1
+        self.assertEqual(
+            0xee11cbb1 % SKETCH_BITS,
+            compute_sketch_position('user'),
+        )
+
+    def test_estimate_distinct_users(self):
+        self.assertEqual(0, estimate_distinct_users(format_sketch([])))
+        positions = [compute_sketch_position(str(i)) for i in range(100)]
+        actual = estimate_distinct_users(format_sketch(positions))
+        self.assertTrue(90 < actual < 110)
+
+    def test_aggregate_events(self):
+        received_at = datetime.datetime(2017, 5, 8, 10, 30)
+        early = '2017-05-08T09:10:00.000Z'
+        late = '2017-05-08T09:50:00.000Z'
+        events = [
+            self._make_event(received_at, 'B', 'u1', early),
+            self._make_event(received_at, 'A', 'u1', early),
+            self._make_event(received_at, 'A', 'u2', late),
+            self._make_event(received_at, 'A', None, None),
+        ]
+        actual = aggregate_events(events)
+        self.assertEqual(3, len(actual))
+
+        self.assertEqual('a', actual[0]['event_norm'])
+        self.assertEqual(datetime.datetime(2017, 5, 8, 9), actual[0]['hour'])
+        self.assertEqual(2, actual[0]['count'])
+        self.assertEqual(2, actual[0]['user_sketch'].count('1'))
+
+        # falls back to _received_at without _tracked_at
+        self.assertEqual('a', actual[1]['event_norm'])
+        self.assertEqual(datetime.datetime(2017, 5, 8, 10), actual[1]['hour'])
+        self.assertEqual(1, actual[1]['count'])
+        self.assertEqual(0, actual[1]['user_sketch'].count('1'))
+
+        self.assertEqual('b', actual[2]['event_norm'])
+
+    def test_make_upsert_statement(self):
+        preparer = postgresql.dialect().identifier_preparer
+        stmt = make_upsert_statement(preparer, 's', 'et___rollup_hourly')
+        actual = str(stmt)
+        self.assertTrue(actual.startswith('INSERT INTO s.et___rollup_hourly'))
+        self.assertTrue('count = r.count + EXCLUDED.count' in actual)
+
+    def test_make_rebuild_statements(self):
+        preparer = postgresql.dialect().identifier_preparer
+        event_table = Table(
+            'et_a',
+            MetaData(),
+            Column('_received_at', TIMESTAMP),
+            schema='s',
+        )
+        delete, insert = make_rebuild_statements(
+            preparer,
+            's',
+            'et___rollup_hourly',
+            event_table,
+        )
+        self.assertTrue('FROM s.et_a GROUP BY 2' in str(insert))
+        self.assertTrue('_user_id' not in str(insert))
+
+        event_table = Table(
+            'et_a',
+            MetaData(),
+            Column('_user_id', TEXT),
+            Column('_tracked_at', TIMESTAMP),
+            Column('_received_at', TIMESTAMP),
+            schema='s',
+        )
+        delete, insert = make_rebuild_statements(
+            preparer,
+            's',
+            'et___rollup_hourly',
+            event_table,
+            since=datetime.datetime(2017, 5, 8),
+        )
+        self.assertTrue('AND hour >=' in str(delete))
+        self.assertTrue('md5(_user_id)' in str(insert))
+        self.assertTrue(
+            'WHERE COALESCE(_tracked_at, _received_at) >=' in str(insert),
+        )
+
+    def _make_event(self, received_at, event_raw, user_id, tracked_at):
+        json_dict = {'_event_raw': event_raw}
+        if user_id is not None:
+            json_dict['_user_id'] = user_id
+        if tracked_at is not None:
+            json_dict['_tracked_at'] = {
+                '$type': 'date',
+                '$date': tracked_at,
+            }
+        return SingleEvent(
+            event_id='abc',
+            received_at=received_at,
+            json_dict=json_dict,
+        )
@@ -0,0 +1,69 @@
+import unittest
+
+from ..sampling import Sampler, TokenBucket, sample_point
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class SamplingTest(unittest.TestCase):
+    def test_sample_point(self):
+        point = sample_point('scroll', 'u1')
+        self.assertTrue(0 <= point < 1)
+        self.assertEqual(point, sample_point('scroll', 'u1'))
+        self.assertNotEqual(point, sample_point('heartbeat', 'u1'))
+        self.assertNotEqual(point, sample_point('scroll', 'u2'))
+
+    def test_token_bucket(self):
+        clock = FakeClock()
+        bucket = TokenBucket(2, burst=3, clock=clock)
+        self.assertEqual(
+            [True, True, True, False],
+            [bucket.try_acquire() for _ in range(4)],
+        )
+        clock.now = 0.5
+        self.assertTrue(bucket.try_acquire())
+        self.assertFalse(bucket.try_acquire())
+        # should not accumulate more than burst
+        clock.now = 100
+        self.assertEqual(
+            [True, True, True, False],
+            [bucket.try_acquire() for _ in range(4)],
+        )
+
+    def test_sample_rates(self):
+        sampler = Sampler(sample_rates={'scroll': 0.25, 'click': 1})
+        self.assertEqual(0.25, sampler.sample_rate('scroll'))
+        self.assertEqual(None, sampler.sample_rate('click'))
+        self.assertEqual(None, sampler.sample_rate('other'))
+
+        users = ['user-{}'.format(i) for i in range(1000)]
+        accepted = [u for u in users if sampler.accept('scroll', u)]
+        self.assertTrue(150 < len(accepted) < 350)
+        # a user is consistently in or out
+        self.assertEqual(
+            accepted,
+            [u for u in users if sampler.accept('scroll', u)],
+        )
+        self.assertTrue(all(sampler.accept('click', u) for u in users))
+        self.assertEqual(
+            2 * (1000 - len(accepted)),
+            sampler.stats()['sampled_out_records'],
+        )
+
+        with self.assertRaises(ValueError):
+            Sampler(sample_rates={'scroll': 1.5})
+
+    def test_rate_limits(self):
+        sampler = Sampler(rate_limits={'heartbeat': (0.001, 2)})
+        self.assertEqual(
+            [True, True, False],
+            [sampler.accept('heartbeat', None) for _ in range(3)],
+        )
+        self.assertTrue(sampler.accept('other', None))
+        self.assertEqual(1, sampler.stats()['rate_limited_records'])
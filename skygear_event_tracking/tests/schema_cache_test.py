@@ -0,0 +1,30 @@
+import unittest
+
+from ..schema_cache import SchemaCache
+
+
+class SchemaCacheTest(unittest.TestCase):
+    def test_get_put_evict(self):
+        cache = SchemaCache()
+        self.assertEqual(None, cache.get('s.et_a'))
+
+        cache.put('s.et_a', 'table_a', (1, 2))
+        cache.put('s.et_b', 'table_b', (3, 4))
+        entry = cache.get('s.et_a')
+        self.assertEqual('table_a', entry.table)
+        self.assertEqual((1, 2), entry.version)
+
+        # eviction is per table
+        cache.evict('s.et_a')
+        self.assertEqual(None, cache.get('s.et_a'))
+        self.assertEqual('table_b', cache.get('s.et_b').table)
+
+        cache.clear()
+        self.assertEqual(None, cache.get('s.et_b'))
+
+    def test_cache_missing_table(self):
+        cache = SchemaCache()
+        cache.put('s.et_a', None, None)
+        entry = cache.get('s.et_a')
+        self.assertNotEqual(None, entry)
+        self.assertEqual(None, entry.table)
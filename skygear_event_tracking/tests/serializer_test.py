@@ -0,0 +1,104 @@
+import datetime
+import json
+import unittest
+
+from ..serializer import encode_attribute, encode_event
+
+
+class SerializerTest(unittest.TestCase):
+    def _encode_event(self, attributes, user_id=None, tracked_at=None):
+        if tracked_at is None:
+            tracked_at = datetime.datetime(2017, 5, 8)
+        encoded = encode_event('Event A', user_id, attributes, tracked_at)
+        return json.loads(encoded.decode('ascii'))
+
+    def test_encode_attribute(self):
+        class SubStr(str):
+            pass
+
+        cases = [
+            ('some_string', '"some_string"'),
+            (SubStr('sub'), '"sub"'),
+            ('事件', '"\\u4e8b\\u4ef6"'),
+            (True, 'true'),
+            (1, '1.0'),
+            (1.5, '1.5'),
+            (float('nan'), 'NaN'),
+            (float('-inf'), '-Infinity'),
+            (None, None),
+            ({}, None),
+            (datetime.datetime(2017, 5, 8), None),
+        ]
+        for value, expected in cases:
+            self.assertEqual(expected, encode_attribute(value))
+
+    def test_encode_event(self):
+        actual = self._encode_event(None)
+        self.assertEqual({'_event_raw', '_tracked_at'}, set(actual))
+
+        input_ = {
+            'some_string': 'some_string',
+            'some_bool': True,
+            'some_int': 1,
+            'some_float': 1.5,
+            1: 2,
+            'something_else': {},
+        }
+        actual = self._encode_event(input_)
+        self.assertEqual(input_['some_string'], actual['some_string'])
+        self.assertEqual(input_['some_bool'], actual['some_bool'])
+        self.assertEqual(input_['some_int'], actual['some_int'])
+        self.assertTrue(isinstance(actual['some_int'], float))
+        self.assertEqual(input_['some_float'], actual['some_float'])
+        self.assertTrue('1' not in actual)
+        self.assertTrue('something_else' not in actual)
+        self.assertEqual('Event A', actual['_event_raw'])
+        self.assertTrue('_user_id' not in actual)
+
+    def test_encode_event_sample_rate(self):
+        encoded = encode_event(
+            'Event A',
+            None,
+            {'_sample_rate': 'x'},
+            datetime.datetime(2017, 5, 8),
+            sample_rate=0.25,
+        )
+        actual = json.loads(encoded.decode('ascii'))
+        self.assertEqual(0.25, actual['_sample_rate'])
+
+    def test_encode_event_id(self):
+        encoded = encode_event(
+            'Event A',
+            None,
+            {'_id': 'x'},
+            datetime.datetime(2017, 5, 8),
+            event_id='some-id',
+        )
+        actual = json.loads(encoded.decode('ascii'))
+        self.assertEqual('some-id', actual['_id'])
+
+    def test_encode_event_reserved_attributes(self):
+        input_ = {'_event_raw': 'x', '_user_id': 'x', '_tracked_at': 'x'}
+        actual = self._encode_event(input_, user_id='u1')
+        self.assertEqual('Event A', actual['_event_raw'])
+        self.assertEqual('u1', actual['_user_id'])
+        self.assertEqual('date', actual['_tracked_at']['$type'])
+
+        # should keep _user_id if user_id is not given
+        actual = self._encode_event({'_user_id': 'u2'})
+        self.assertEqual('u2', actual['_user_id'])
+
+    def test_encode_event_tracked_at(self):
+        sample_date = datetime.datetime(
+            2017, 5, 8,
+            hour=0, minute=1, second=2, microsecond=3
+        )
+        for tracked_at, expected in [
+            (sample_date, '2017-05-08T00:01:02.000003Z'),
+            # should not reuse the cached second
+            (sample_date.replace(second=3), '2017-05-08T00:01:03.000003Z'),
+            (sample_date.replace(microsecond=0), '2017-05-08T00:01:02Z'),
+        ]:
+            actual = self._encode_event(None, tracked_at=tracked_at)
+            self.assertEqual('date', actual['_tracked_at']['$type'])
+            self.assertEqual(expected, actual['_tracked_at']['$date'])
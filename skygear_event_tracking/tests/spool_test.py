@@ -0,0 +1,116 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from ..spool import Spool, claim_spool_directory, compute_backoff
+
+
+class SpoolTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _drain(self, spool):
+        output = []
+        while True:
+            payload = spool.peek()
+            if payload is None:
+                return output
+            output.append(payload)
+            spool.commit()
+
+    def _segments(self):
+        return sorted(
+            name for name in os.listdir(self.directory)
+            if name.endswith('.seg')
+        )
+
+    def test_fifo(self):
+        spool = Spool(self.directory, segment_bytes=20)
+        payloads = [str(i).encode('utf-8') * 5 for i in range(10)]
+        for payload in payloads:
+            self.assertTrue(spool.append(payload))
+        # 9 bytes per record, 2 records per segment
+        self.assertEqual(5, len(self._segments()))
+
+        # should return the same record until commit
+        self.assertEqual(payloads[0], spool.peek())
+        self.assertEqual(payloads[0], spool.peek())
+        self.assertEqual(payloads, self._drain(spool))
+        self.assertTrue(spool.is_empty())
+        # should remove consumed segments
+        self.assertEqual([], self._segments())
+        self.assertEqual(0, len(spool))
+
+        self.assertTrue(spool.append(b'next'))
+        self.assertEqual([b'next'], self._drain(spool))
+
+    def test_max_bytes(self):
+        spool = Spool(self.directory, max_bytes=20, segment_bytes=10)
+        self.assertTrue(spool.append(b'12345'))
+        self.assertTrue(spool.append(b'12345'))
+        self.assertFalse(spool.append(b'12345'))
+        self.assertEqual(18, len(spool))
+        self.assertEqual(b'12345', spool.peek())
+        spool.commit()
+        # a segment is freed once all of its records are consumed
+        self.assertTrue(spool.append(b'12345'))
+
+    def test_reopen(self):
+        spool = Spool(self.directory, segment_bytes=20)
+        for payload in [b'a', b'b', b'c', b'd']:
+            spool.append(payload)
+        self.assertEqual(b'a', spool.peek())
+        spool.commit()
+        self.assertEqual(b'b', spool.peek())
+        spool.close()
+
+        # should not read committed records again
+        spool = Spool(self.directory, segment_bytes=20)
+        spool.append(b'e')
+        self.assertEqual([b'b', b'c', b'd', b'e'], self._drain(spool))
+
+    def test_truncated_record(self):
+        spool = Spool(self.directory)
+        spool.append(b'a')
+        spool.append(b'b')
+        spool.close()
+        path = os.path.join(self.directory, self._segments()[0])
+        with open(path, 'r+b') as f:
+            f.truncate(os.path.getsize(path) - 1)
+
+        spool = Spool(self.directory)
+        self.assertEqual([b'a'], self._drain(spool))
+        self.assertEqual([], self._segments())
+
+    @unittest.skipUnless(hasattr(os, 'fork'), 'requires fork')
+    def test_claim_spool_directory(self):
+        first = claim_spool_directory(self.directory)
+        second = claim_spool_directory(self.directory)
+        self.assertNotEqual(first, second)
+        self.assertEqual(self.directory, os.path.dirname(first))
+
+        # should reuse a directory whose claim is released
+        from .. import spool
+        fd = spool._claimed.pop()
+        os.close(fd)
+        self.assertEqual(second, claim_spool_directory(self.directory))
+
+    def test_claim_spool_directory_without_fcntl(self):
+        with mock.patch('skygear_event_tracking.spool.fcntl', None):
+            first = claim_spool_directory(self.directory)
+            second = claim_spool_directory(self.directory)
+        # should never reuse a directory that might be in use
+        self.assertNotEqual(first, second)
+        self.assertTrue(os.path.isdir(first))
+        self.assertTrue(os.path.isdir(second))
+
+    def test_compute_backoff(self):
+        self.assertEqual(1, compute_backoff(0, 1, 60, rand=lambda: 1))
+        self.assertEqual(8, compute_backoff(3, 1, 60, rand=lambda: 1))
+        self.assertEqual(60, compute_backoff(100, 1, 60, rand=lambda: 1))
+        self.assertEqual(4, compute_backoff(3, 1, 60, rand=lambda: 0.5))
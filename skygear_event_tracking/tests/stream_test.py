@@ -0,0 +1,120 @@
+import gzip
+import io
+import json
+import unittest
+import zlib
+
+from ..stream import (
+    BodyTooLargeError,
+    DecompressingReader,
+    MalformedBodyError,
+    iter_json_events,
+)
+
+
+class StreamTest(unittest.TestCase):
+    def _parse(self, body, read_size=3):
+        stream = io.BytesIO(body.encode('utf-8'))
+        return list(iter_json_events(stream, read_size=read_size))
+
+    def test_iter_json_events(self):
+        events = [
+            {'_event_raw': 'Event A', 'some_float': 1.5},
+            {'_event_raw': '事件', 'some_int': 12345},
+            {'_event_raw': 'Event C', 'nested': {'$date': 'x'}},
+        ]
+        body = json.dumps({'other': [1, {'a': 2}], 'events': events})
+        # should parse values split across reads
+        self.assertEqual(events, self._parse(body))
+        self.assertEqual(events, self._parse(body, read_size=1024))
+
+        body = ' { "events" : [ 123 , 4.5e1, -0.25 ] , "last" : 678 } \n'
+        for read_size in range(1, len(body) + 1):
+            self.assertEqual(
+                [123, 45.0, -0.25],
+                self._parse(body, read_size=read_size),
+            )
+
+        self.assertEqual([], self._parse('{}'))
+        self.assertEqual([], self._parse('{"events": []}'))
+
+    def test_iter_json_events_malformed(self):
+        cases = [
+            '',
+            '[]',
+            '{"events": {}}',
+            '{"events": [{"_event_raw": "Event A"}',
+            '{"events": [{"_event_raw": "Event A"},]}',
+            '{"events": [1 2]}',
+            '{"events": []} []',
+        ]
+        for body in cases:
+            with self.assertRaises(MalformedBodyError):
+                self._parse(body)
+
+    def test_iter_json_events_max_value_size(self):
+        body = json.dumps({'events': [{'some': 'x' * 100}]})
+        stream = io.BytesIO(body.encode('utf-8'))
+        with self.assertRaises(BodyTooLargeError):
+            list(iter_json_events(stream, read_size=16, max_value_size=50))
+        stream = io.BytesIO(body.encode('utf-8'))
+        self.assertEqual(1, len(list(iter_json_events(
+            stream,
+            read_size=16,
+            max_value_size=200,
+        ))))
+
+    def test_iter_json_events_invalid_utf8(self):
+        stream = io.BytesIO(b'{"events": ["\xff"]}')
+        with self.assertRaises(MalformedBodyError):
+            list(iter_json_events(stream))
+
+    def test_iter_json_events_lazily(self):
+        stream = io.BytesIO(b'{"events": [1, 2, 3')
+        iterator = iter_json_events(stream, read_size=1)
+        self.assertEqual(1, next(iterator))
+        self.assertEqual(2, next(iterator))
+        self.assertEqual(3, next(iterator))
+        with self.assertRaises(MalformedBodyError):
+            next(iterator)
+
+    def _decompress(self, data, content_encoding, max_size=1024, size=7):
+        reader = DecompressingReader(
+            io.BytesIO(data),
+            content_encoding,
+            max_size,
+            read_size=5,
+        )
+        output = []
+        while True:
+            chunk = reader.read(size)
+            if not chunk:
+                return b''.join(output)
+            self.assertTrue(len(chunk) <= size)
+            output.append(chunk)
+
+    def test_decompressing_reader(self):
+        body = json.dumps({
+            'events': [{'_event_raw': 'a'}] * 20,
+        }).encode('utf-8')
+        self.assertEqual(body, self._decompress(gzip.compress(body), 'gzip'))
+        self.assertEqual(
+            body,
+            self._decompress(zlib.compress(body), 'deflate'),
+        )
+        # should read every member of a multi-member gzip stream
+        data = gzip.compress(body[:10]) + gzip.compress(body[10:])
+        self.assertEqual(body, self._decompress(data, 'gzip'))
+
+    def test_decompressing_reader_malformed(self):
+        body = b'{"events": []}'
+        with self.assertRaises(MalformedBodyError):
+            self._decompress(gzip.compress(body)[:-4], 'gzip')
+        with self.assertRaises(MalformedBodyError):
+            self._decompress(body, 'gzip')
+
+    def test_decompressing_reader_too_large(self):
+        data = gzip.compress(b' ' * 1000000)
+        self.assertTrue(len(data) < 10000)
+        with self.assertRaises(BodyTooLargeError):
+            self._decompress(data, 'gzip', max_size=100000, size=65536)
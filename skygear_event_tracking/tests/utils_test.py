@@ -1,9 +1,14 @@
 import unittest
 import datetime
+from ..stream import MalformedBodyError
 from ..utils import (
+    EventShapeCache,
     EventTrackingRequest,
     SingleEvent,
+    coerce_value,
+    get_client_event_id,
     parse_datetime_from_dict,
+    parse_epoch_millis,
     parse_rfc3339,
     sanitize_for_db,
     compare_column_name,
@@ -51,6 +56,64 @@ class UtilsTest(unittest.TestCase):
         self.assertEqual(6789, actual.microsecond)
         self.assertEqual(None, actual.tzinfo)
 
+        cases = [
+            (
+                '2017-01-23T01:23:45Z',
+                datetime.datetime(2017, 1, 23, 1, 23, 45),
+            ),
+            (
+                '2017-01-23T01:23:45.006Z',
+                datetime.datetime(2017, 1, 23, 1, 23, 45, 6000),
+            ),
+            (
+                '2017-01-23T01:23:45.1z',
+                datetime.datetime(2017, 1, 23, 1, 23, 45, 100000),
+            ),
+            (
+                '2017-01-23t01:23:45.123456789Z',
+                datetime.datetime(2017, 1, 23, 1, 23, 45, 123456),
+            ),
+            (
+                '2017-01-23T09:23:45+08:00',
+                datetime.datetime(2017, 1, 23, 1, 23, 45),
+            ),
+            (
+                '2017-01-22T21:53:45.5-03:30',
+                datetime.datetime(2017, 1, 23, 1, 23, 45, 500000),
+            ),
+            (
+                '2017-01-23 01:23:45-00:00',
+                datetime.datetime(2017, 1, 23, 1, 23, 45),
+            ),
+        ]
+        for input_, expected in cases:
+            self.assertEqual(expected, parse_rfc3339(input_))
+
+        for input_ in [
+            '',
+            '2017-01-23',
+            '2017-01-23T01:23:45',
+            '2017-13-23T01:23:45Z',
+            '2017-01-23T01:23:45.Z',
+            '2017-01-23T01:23:45+0800',
+            '2017-01-23T01:23:45.00aZ',
+            '2017-01-23T 1:23:45Z',
+            '2017-01-23T01:2_:45.006Z',
+            '2017-01-23T01:23:4\u0665Z',
+            '2017-01-23T01:23:45.00\u0665+08:00',
+            '2017-05-08T00:01:02Z\n',
+            '2017-05-08T00:01:02.123+08:00\n',
+        ]:
+            with self.assertRaises(ValueError):
+                parse_rfc3339(input_)
+
+    def test_parse_epoch_millis(self):
+        self.assertEqual(
+            datetime.datetime(2017, 1, 23, 1, 23, 45, 6000),
+            parse_epoch_millis(1485134625006),
+        )
+        self.assertEqual(datetime.datetime(1970, 1, 1), parse_epoch_millis(0))
+
     def test_parse_datetime_from_dict(self):
         input_ = {
             '$type': 'date',
@@ -70,6 +133,53 @@ class UtilsTest(unittest.TestCase):
         actual = parse_datetime_from_dict(input_)
         self.assertEqual(None, actual)
 
+        input_ = {'$type': 'date', '$date': 1485134625006}
+        actual = parse_datetime_from_dict(input_)
+        self.assertEqual(
+            datetime.datetime(2017, 1, 23, 1, 23, 45, 6000),
+            actual,
+        )
+
+        input_ = {'$type': 'date', '$date': True}
+        self.assertEqual(None, parse_datetime_from_dict(input_))
+
+        input_ = {'$type': 'date', '$date': 'not a date'}
+        self.assertEqual(None, parse_datetime_from_dict(input_))
+
+    def test_coerce_value(self):
+        class SubStr(str):
+            pass
+
+        self.assertEqual('a', coerce_value('a'))
+        self.assertEqual('a', coerce_value(SubStr('a')))
+        self.assertTrue(isinstance(coerce_value(1), float))
+        self.assertTrue(coerce_value(True) is True)
+        self.assertEqual(None, coerce_value(None))
+        self.assertEqual(None, coerce_value([1]))
+        self.assertEqual(None, coerce_value({'some': 'dict'}))
+
+    def test_event_shape_cache(self):
+        cache = EventShapeCache(maxsize=2)
+        shape_a = cache.get('Event A', {'_event_raw': 1, 'Some Key': 1})
+        self.assertEqual('event_a', shape_a.event_norm)
+        self.assertEqual(
+            {('_event_raw', '_event_raw'), ('Some Key', 'some_key')},
+            set(shape_a.fields),
+        )
+        # should reuse the shape of the same name and set of keys
+        self.assertTrue(
+            shape_a is cache.get('Event A', {'Some Key': 2, '_event_raw': 2})
+        )
+        shape_b = cache.get('Event B', {'_event_raw': 1})
+        cache.get('Event A', {'_event_raw': 1, 'Some Key': 1})
+        cache.get('Event C', {'_event_raw': 1})
+        # should evict the least recently used shape
+        self.assertTrue(shape_a is cache.get(
+            'Event A',
+            {'_event_raw': 1, 'Some Key': 1},
+        ))
+        self.assertFalse(shape_b is cache.get('Event B', {'_event_raw': 1}))
+
     def test_single_event_constructor(self):
         event_id = 'abc'
         received_at = datetime.datetime.utcnow()
@@ -116,6 +226,41 @@ class UtilsTest(unittest.TestCase):
             datetime.datetime
         ))
 
+    def test_get_client_event_id(self):
+        self.assertEqual('abc', get_client_event_id({'_id': 'abc'}))
+        self.assertEqual(None, get_client_event_id({}))
+        self.assertEqual(None, get_client_event_id({'_id': ''}))
+        self.assertEqual(None, get_client_event_id({'_id': 1}))
+        self.assertEqual(None, get_client_event_id({'_id': 'x' * 129}))
+        self.assertEqual(None, get_client_event_id(['_id']))
+
+    def test_event_tracking_request_keeps_client_event_id(self):
+        actual = EventTrackingRequest(
+            http_header_ips=None,
+            json_events=[
+                {'_event_raw': 'Event A', '_id': 'client-id'},
+                {'_event_raw': 'Event A', '_id': 1},
+            ],
+        )
+        event_ids = [e.attributes['_id'] for e in actual.events]
+        self.assertEqual('client-id', event_ids[0])
+        self.assertTrue(isinstance(event_ids[1], str))
+        self.assertNotEqual('client-id', event_ids[1])
+
+    def test_event_tracking_request_malformed_event(self):
+        for json_event in [
+            [],
+            {},
+            {'_event_raw': ''},
+            {'_event_raw': 1},
+        ]:
+            actual = EventTrackingRequest(
+                http_header_ips=None,
+                json_events=[{'_event_raw': 'Event A'}, json_event],
+            )
+            with self.assertRaises(MalformedBodyError):
+                list(actual.events)
+
     def test_event_tracking_request_constructor(self):
         json_events = [
             {
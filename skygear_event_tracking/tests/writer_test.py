@@ -1,5 +1,6 @@
 import datetime
 import unittest
+from unittest import mock
 from sqlalchemy import (
     Column,
     MetaData,
@@ -8,8 +9,24 @@ from sqlalchemy import (
 from sqlalchemy.dialects.postgresql import (
     DOUBLE_PRECISION,
     TEXT,
+    TIMESTAMP,
+)
+from ..partition import PartitionScheme
+from ..utils import SingleEvent
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.exc import DBAPIError
+from ..writer import (
+    ColumnBudget,
+    compute_advisory_lock_key,
+    compute_columns_to_add,
+    compute_columns_to_add_for_events,
+    group_events,
+    group_events_by_table,
+    is_concurrent_ddl_error,
+    make_add_columns_statement,
+    make_insert_statement,
+    Writer,
 )
-from ..writer import compute_columns_to_add, Writer
 
 
 class WriterTest(unittest.TestCase):
@@ -39,12 +56,415 @@ class WriterTest(unittest.TestCase):
             actual,
         )
 
+    def test_compute_columns_to_add_for_events(self):
+        input_table = self._make_table(
+            'some_table',
+            Column('some_str', TEXT),
+            Column('some_float', DOUBLE_PRECISION),
+        )
+        events = [
+            self._make_event('Event A', some_str='a', some_bool=True),
+            # conflicts with the table
+            self._make_event('Event A', some_str=1.5, other_bool=True),
+            self._make_event('Event A', some_str='b', some_float=1),
+            # conflicts with an earlier event in the batch
+            self._make_event('Event A', some_bool='true'),
+        ]
+        columns, rejected = compute_columns_to_add_for_events(
+            input_table,
+            events,
+        )
+        self._assert_columns(
+            ['_event_raw', '_event_norm', '_id', '_received_at', 'some_bool'],
+            columns,
+        )
+        self.assertEqual({1, 3}, rejected)
+
+        # should return all columns if table is None
+        columns, rejected = compute_columns_to_add_for_events(
+            None,
+            events[0:1],
+        )
+        self._assert_columns(
+            [
+                '_event_raw',
+                '_event_norm',
+                '_id',
+                '_received_at',
+                'some_str',
+                'some_bool',
+            ],
+            columns,
+        )
+        self.assertEqual(set(), rejected)
+
+    def test_compute_columns_to_add_for_events_memoizes_diff(self):
+        input_table = self._make_table(
+            'some_table',
+            Column('some_str', TEXT),
+        )
+        events = [
+            self._make_event('Event Memo', some_str='a'),
+            self._make_event('Event Memo', some_str='b'),
+        ]
+        self.assertTrue(events[0].shape is events[1].shape)
+        compute_columns_to_add_for_events(input_table, events[0:1])
+        signature = (
+            tuple(events[1].attributes),
+            tuple(map(type, events[1].attributes.values())),
+        )
+        diff = events[1].shape.lookup_column_diff(input_table, signature)
+        self.assertNotEqual(None, diff)
+        self.assertEqual(None, diff[0])
+
+    def test_make_add_columns_statement(self):
+        table = Table('et_some', MetaData(), schema='s')
+        columns = [
+            Column('some_str', TEXT),
+            Column('some_float', DOUBLE_PRECISION),
+        ]
+        actual = make_add_columns_statement(
+            postgresql.dialect(),
+            table,
+            columns,
+        )
+        self.assertEqual(
+            actual,
+            'ALTER TABLE s.et_some ADD COLUMN some_str TEXT, '
+            'ADD COLUMN some_float DOUBLE PRECISION',
+        )
+
+    def test_column_budget(self):
+        input_table = self._make_table(
+            'some_table',
+            Column('_id', TEXT),
+            Column('some_str', TEXT),
+        )
+        events = [
+            self._make_event('Event A', some_str='a', new_a='a', new_b=1),
+            self._make_event('Event A', new_b=2, new_c='c'),
+        ]
+        original = events
+        budget = ColumnBudget(max_columns=2)
+        events = budget.apply(input_table, original)
+
+        # new_a is the only new column within the budget
+        self.assertEqual('a', events[0].attributes['some_str'])
+        self.assertEqual('a', events[0].attributes['new_a'])
+        self.assertEqual({'new_b': 1.0}, events[0].attributes['_extra'])
+        self.assertEqual(
+            {'new_b': 2.0, 'new_c': 'c'},
+            events[1].attributes['_extra'],
+        )
+        # preserved columns are never moved
+        self.assertTrue('_event_norm' in events[0].attributes)
+        # should not change the events given
+        self.assertEqual('c', original[1].attributes['new_c'])
+        self.assertFalse('_extra' in original[0].attributes)
+        again = budget.apply(input_table, original)
+        self.assertEqual(
+            [e.attributes for e in events],
+            [e.attributes for e in again],
+        )
+
+        columns, rejected = compute_columns_to_add_for_events(
+            input_table,
+            events,
+        )
+        self._assert_columns(
+            ['_event_raw', '_event_norm', '_received_at', '_extra', 'new_a'],
+            columns,
+        )
+        self.assertEqual(set(), rejected)
+
+    def test_column_budget_allowlist(self):
+        sample_date = datetime.datetime(2017, 5, 8, 0, 1, 2, 3)
+        events = [
+            self._make_event('Event A', Allowed='a', other='b'),
+        ]
+        events[0].attributes['some_date'] = sample_date
+        budget = ColumnBudget(allowlist=['Allowed'])
+        events = budget.apply(None, events)
+        self.assertEqual('a', events[0].attributes['allowed'])
+        self.assertEqual({
+            'other': 'b',
+            'some_date': '2017-05-08T00:01:02.000003Z',
+        }, events[0].attributes['_extra'])
+
+    def test_column_budget_extra_not_object(self):
+        events = [self._make_event('Event A', other='b')]
+        events[0].attributes['_extra'] = 'sent by client'
+        budget = ColumnBudget(allowlist=[])
+        events = budget.apply(None, events)
+        self.assertEqual({
+            '_extra': 'sent by client',
+            'other': 'b',
+        }, events[0].attributes['_extra'])
+
+    def test_ensure_table_reapplies_column_budget(self):
+        stale = self._make_table('et_some', Column('_id', TEXT))
+        fresh = self._make_table(
+            'et_some',
+            Column('_id', TEXT),
+            Column('new_a', TEXT),
+        )
+
+        class RefreshingWriter(Writer):
+            def _lock_table(self, conn, event_norm):
+                pass
+
+            def _refresh_table_if_stale(self, conn, event_norm, table):
+                return fresh
+
+            def _add_columns(self, conn, table, event_norm, columns):
+                self.added = [c.name for c in columns]
+                return table
+
+        writer = RefreshingWriter(
+            engine=None,
+            schema='s',
+            table_prefix='et_',
+            column_budget=ColumnBudget(max_columns=1),
+        )
+        events = [self._make_event('Event A', new_b='b')]
+        table, actual = writer._ensure_table(None, None, 'some', stale, events)
+        # another process has used the last column of the budget
+        self.assertEqual({'new_b': 'b'}, actual[0].attributes['_extra'])
+        self.assertTrue('_extra' in writer.added)
+        self.assertFalse('new_b' in writer.added)
+
     def test_compute_quantified_table_name(self):
         input_ = 'posted_an_item_for_sale'
         writer = Writer(engine=None, schema='s', table_prefix='et_')
         actual = writer._compute_quantified_table_name(input_)
         self.assertEqual('s.et_posted_an_item_for_sale', actual)
 
+    def test_group_events(self):
+        events = [
+            self._make_event('Event A', some_str='a'),
+            self._make_event('Event B', some_str='b'),
+            self._make_event('Event A', some_str='c'),
+            self._make_event('Event A', some_float=1.5),
+        ]
+        actual = group_events(events)
+        self.assertEqual(3, len(actual))
+        self.assertEqual([events[0], events[2]], actual[0])
+        self.assertEqual([events[1]], actual[1])
+        self.assertEqual([events[3]], actual[2])
+
+        actual = group_events_by_table(events)
+        self.assertEqual(2, len(actual))
+        self.assertEqual([events[0], events[2], events[3]], actual[0])
+        self.assertEqual([events[1]], actual[1])
+
+    def test_process_one_table_falls_back_to_single_events(self):
+        class FailingWriter(Writer):
+            def __init__(self):
+                super().__init__(engine=None, schema='s', table_prefix='et_')
+                self.single_events = []
+
+            def _process_one_table_in_txn(self, events):
+                raise ValueError('bad row')
+
+            def _process_one_event_in_txn(self, event):
+                self.single_events.append(event)
+
+        writer = FailingWriter()
+        events = [
+            self._make_event('Event A', some_str='a'),
+            self._make_event('Event A', some_str='b'),
+        ]
+        writer._process_one_table(events)
+        self.assertEqual(events, writer.single_events)
+
+    def test_refresh_table_if_stale(self):
+        class ReflectingWriter(Writer):
+            def _reflect_table(self, conn, event_norm):
+                return 'fresh_table', (1, 3)
+
+        writer = ReflectingWriter(engine=None, schema='s', table_prefix='et_')
+        writer._schema_cache.put('s.et_some', 'cached_table', (1, 2))
+        path = 'skygear_event_tracking.writer.fetch_table_version'
+
+        # same version should keep the cached table
+        with mock.patch(path, return_value=(1, 2)):
+            actual = writer._refresh_table_if_stale(
+                None,
+                'some',
+                'cached_table',
+            )
+        self.assertEqual('cached_table', actual)
+
+        # changed version should evict and reflect again
+        with mock.patch(path, return_value=(1, 3)):
+            actual = writer._refresh_table_if_stale(
+                None,
+                'some',
+                'cached_table',
+            )
+        self.assertEqual('fresh_table', actual)
+        self.assertEqual(None, writer._schema_cache.get('s.et_some'))
+
+    def test_make_insert_statement(self):
+        table = self._make_table('et_some', Column('_id', TEXT))
+        rows = [{'_id': 'a'}, {'_id': 'b'}]
+        stmt = make_insert_statement(table, rows)
+        actual = str(stmt.compile(dialect=postgresql.dialect()))
+        self.assertFalse('ON CONFLICT' in actual)
+
+        stmt = make_insert_statement(table, rows, skip_conflicts=True)
+        actual = str(stmt.compile(dialect=postgresql.dialect()))
+        self.assertTrue(actual.endswith(
+            'ON CONFLICT DO NOTHING RETURNING et_some._id',
+        ))
+
+    def test_insert_events_skips_duplicates(self):
+        class FakeConn(object):
+            def execute(self, stmt):
+                self.stmt = stmt
+                return [('b',)]
+
+        writer = Writer(
+            engine=None,
+            schema='s',
+            table_prefix='et_',
+            bulk_load_threshold=1,
+        )
+        table = self._make_table('et_some', Column('_id', TEXT))
+        table.info['primary_key_on_id'] = True
+        events = [
+            self._make_event('Event A', event_id='a'),
+            self._make_event('Event A', event_id='b'),
+        ]
+        conn = FakeConn()
+        # should not COPY into a table with a primary key
+        actual = writer._insert_events(conn, table, events)
+        self.assertEqual([events[1]], actual)
+
+        # should not skip conflicts without a primary key
+        writer = Writer(engine=None, schema='s', table_prefix='et_')
+        table = self._make_table(
+            'et_some',
+            Column('_id', TEXT),
+            Column('_event_raw', TEXT),
+            Column('_event_norm', TEXT),
+            Column('_received_at', TIMESTAMP),
+        )
+        actual = writer._insert_events(conn, table, events)
+        self.assertEqual(events, actual)
+        actual = str(conn.stmt.compile(dialect=postgresql.dialect()))
+        self.assertFalse('ON CONFLICT' in actual)
+
+    def test_process_events_drops_recent_ids(self):
+        class RecordingWriter(Writer):
+            def __init__(self):
+                super().__init__(engine=None, schema='s', table_prefix='et_')
+                self.written = []
+
+            def _process_one_table(self, events):
+                self.written.append([e.attributes['_id'] for e in events])
+                self._recent_ids.add(events)
+
+        writer = RecordingWriter()
+        writer.process_events([
+            self._make_event('Event A', event_id='a'),
+            self._make_event('Event A', event_id='a'),
+        ])
+        writer.process_events([
+            self._make_event('Event A', event_id='a'),
+            self._make_event('Event A', event_id='b'),
+        ])
+        self.assertEqual([['a'], ['b']], writer.written)
+
+    def test_compute_advisory_lock_key(self):
+        actual = compute_advisory_lock_key('s.et_some')
+        self.assertEqual(actual, compute_advisory_lock_key('s.et_some'))
+        self.assertNotEqual(actual, compute_advisory_lock_key('s.et_other'))
+        self.assertTrue(-2 ** 63 <= actual < 2 ** 63)
+
+    def test_is_concurrent_ddl_error(self):
+        self.assertTrue(is_concurrent_ddl_error(self._make_db_error('42701')))
+        self.assertFalse(is_concurrent_ddl_error(self._make_db_error('23505')))
+        self.assertFalse(is_concurrent_ddl_error(ValueError()))
+
+    def test_process_one_table_retries_concurrent_ddl(self):
+        db_error = self._make_db_error('42P07')
+
+        class RacingWriter(Writer):
+            def __init__(self):
+                super().__init__(engine=None, schema='s', table_prefix='et_')
+                self.attempts = 0
+
+            def _process_one_table_in_txn(self, events):
+                self.attempts += 1
+                if self.attempts == 1:
+                    raise db_error
+
+        writer = RacingWriter()
+        writer._process_one_table_with_retry([self._make_event('Event A')])
+        self.assertEqual(2, writer.attempts)
+
+    def test_known_partitions_expire(self):
+        scheme = PartitionScheme(interval='month')
+        writer = Writer(
+            engine=None,
+            schema='s',
+            table_prefix='et_',
+            partition_scheme=scheme,
+            partitions_ttl=0,
+        )
+        table = self._make_table('et_some')
+        names = [['et_some__p201712', 'et_some__default'], []]
+        path = 'skygear_event_tracking.writer.list_partitions'
+        with mock.patch(path, side_effect=names) as list_partitions:
+            actual = writer._known_partitions(None, 'some', table)
+            self.assertEqual({datetime.datetime(2017, 12, 1)}, actual)
+            # should read the catalog again once the cache expires
+            actual = writer._known_partitions(None, 'some', table)
+            self.assertEqual(set(), actual)
+            self.assertEqual(2, list_partitions.call_count)
+
+    def test_create_partition_skips_default_rows(self):
+        db_error = self._make_db_error('23514')
+
+        class FakeConn(object):
+            dialect = postgresql.dialect()
+
+            def begin_nested(self):
+                return mock.Mock()
+
+            def execute(self, stmt):
+                raise db_error
+
+        writer = Writer(
+            engine=None,
+            schema='s',
+            table_prefix='et_',
+            partition_scheme=PartitionScheme(interval='month'),
+        )
+        table = Table('et_some', MetaData(), schema='s')
+        start = datetime.datetime(2017, 12, 1)
+        self.assertFalse(writer._create_partition(FakeConn(), table, start))
+        FakeConn.execute = mock.Mock(side_effect=self._make_db_error('42501'))
+        with self.assertRaises(DBAPIError):
+            writer._create_partition(FakeConn(), table, start)
+
+    def _make_db_error(self, pgcode):
+        class FakeOrig(Exception):
+            pass
+        orig = FakeOrig()
+        orig.pgcode = pgcode
+        return DBAPIError('SELECT 1', {}, orig)
+
+    def _make_event(self, event_raw, event_id='abc', **kwargs):
+        json_dict = {'_event_raw': event_raw}
+        json_dict.update(kwargs)
+        return SingleEvent(
+            event_id=event_id,
+            received_at=datetime.datetime.utcnow(),
+            json_dict=json_dict,
+        )
+
     def _make_table(self, table_name, *cols):
         metadata = MetaData()
         return Table(table_name, metadata, *cols)
@@ -1,7 +1,11 @@
 import re
 import datetime
+import hashlib
+import threading
 import uuid
+from collections import OrderedDict
 from functools import cmp_to_key
+from .stream import MalformedBodyError
 
 
 # The order of elements in this list is important.
@@ -16,6 +20,8 @@ _PREVERSED_COLUMNS = [
     '_sent_at',
     '_received_at',
     '_ips',
+    '_sample_rate',
+    '_extra',
 
     # web specific columns
     '_user_agent',
@@ -41,6 +47,35 @@ _PREVERSED_COLUMNS = [
     '_device_timezone',
 ]
 
+_PREVERSED_COLUMNS_SET = frozenset(_PREVERSED_COLUMNS)
+
+# The column that holds attributes which do not get their own column
+EXTRA_COLUMN = '_extra'
+
+
+def is_preserved_column(column_name):
+    return column_name in _PREVERSED_COLUMNS_SET
+
+
+# PostgreSQL truncates longer identifiers
+MAX_IDENTIFIER_LENGTH = 63
+
+
+def fit_identifier(name, suffix=''):
+    '''
+    Return name + suffix if it fits in MAX_IDENTIFIER_LENGTH bytes, or
+    else a prefix of name and a hash of name followed by suffix, so that
+    long names that share a prefix do not collide after truncation, and
+    suffix can still be parsed
+    '''
+    encoded = name.encode('utf-8')
+    max_length = MAX_IDENTIFIER_LENGTH - len(suffix.encode('utf-8'))
+    if len(encoded) <= max_length:
+        return name + suffix
+    digest = hashlib.sha1(encoded).hexdigest()[:8]
+    prefix = encoded[:max_length - len(digest) - 1]
+    return prefix.decode('utf-8', 'ignore') + '_' + digest + suffix
+
 
 def _list_index_of(list_, item):
     try:
@@ -101,39 +136,272 @@ def sanitize_for_db(some_str):
     return d
 
 
-def parse_rfc3339(some_str):
-    dt = datetime.datetime.strptime(some_str, '%Y-%m-%dT%H:%M:%S.%fZ')
+_EPOCH = datetime.datetime(1970, 1, 1)
+
+# re.ASCII, so that \d does not match other Unicode digits, and \Z
+# rather than $, which would match before a trailing newline
+_RFC3339_RE = re.compile(
+    r'(\d{4})-(\d{2})-(\d{2})[Tt ](\d{2}):(\d{2}):(\d{2})'
+    r'(?:\.(\d+))?(?:[Zz]|([+-])(\d{2}):(\d{2}))\Z',
+    re.ASCII,
+)
+
+# YYYY-MM-DDTHH:MM:SS[.fff[fff]]Z, the format sent by the SDKs
+_FAST_RFC3339_RE = re.compile(
+    r'\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}(?:\.\d{3}(?:\d{3})?)?Z\Z',
+    re.ASCII,
+)
+
+
+def _parse_rfc3339_slow(some_str):
+    match = _RFC3339_RE.match(some_str)
+    if match is None:
+        raise ValueError('invalid RFC 3339 timestamp: {}'.format(some_str))
+    (
+        year, month, day, hour, minute, second,
+        fraction, sign, offset_hour, offset_minute,
+    ) = match.groups()
+    microsecond = 0
+    if fraction is not None:
+        microsecond = int(fraction[:6].ljust(6, '0'))
+    dt = datetime.datetime(
+        int(year), int(month), int(day),
+        int(hour), int(minute), int(second),
+        microsecond,
+    )
+    if sign is not None:
+        offset = datetime.timedelta(
+            hours=int(offset_hour),
+            minutes=int(offset_minute),
+        )
+        if sign == '+':
+            dt -= offset
+        else:
+            dt += offset
     return dt
 
 
+def parse_rfc3339(some_str):
+    '''
+    Parse a RFC 3339 timestamp into a naive datetime in UTC.
+    Fractional seconds beyond microseconds are truncated.
+    Raise ValueError if some_str is not a RFC 3339 timestamp.
+    '''
+    if _FAST_RFC3339_RE.match(some_str) is None:
+        return _parse_rfc3339_slow(some_str)
+    microsecond = 0
+    if len(some_str) == 24:
+        microsecond = int(some_str[20:23]) * 1000
+    elif len(some_str) == 27:
+        microsecond = int(some_str[20:26])
+    return datetime.datetime(
+        int(some_str[0:4]),
+        int(some_str[5:7]),
+        int(some_str[8:10]),
+        int(some_str[11:13]),
+        int(some_str[14:16]),
+        int(some_str[17:19]),
+        microsecond,
+    )
+
+
+def parse_epoch_millis(millis):
+    '''
+    Parse milliseconds since the Unix epoch into a naive datetime in UTC
+    '''
+    return _EPOCH + datetime.timedelta(milliseconds=millis)
+
+
 def parse_datetime_from_dict(some_dict):
     try:
         type_ = some_dict['$type']
         if type_ != 'date':
             return None
-        date_str = some_dict['$date']
-        return parse_rfc3339(date_str)
+        date_value = some_dict['$date']
+        if isinstance(date_value, bool):
+            return None
+        if isinstance(date_value, (int, float)):
+            return parse_epoch_millis(date_value)
+        return parse_rfc3339(date_value)
     except Exception:
         return None
 
 
+def _coerce_identity(value):
+    return value
+
+
+def _coerce_slow(value):
+    '''
+    Coerce a value whose exact type is not in _COERCERS,
+    e.g. a subclass of str
+    '''
+    if isinstance(value, str):
+        return value
+    elif isinstance(value, bool):
+        return value
+    elif isinstance(value, int):
+        return float(value)
+    elif isinstance(value, float):
+        return value
+    elif isinstance(value, dict):
+        return parse_datetime_from_dict(value)
+    return None
+
+
+# Dispatch on the exact type of a json value. A coercer returns None if
+# the value should be dropped.
+_COERCERS = {
+    str: _coerce_identity,
+    bool: _coerce_identity,
+    int: float,
+    float: _coerce_identity,
+    dict: parse_datetime_from_dict,
+}
+
+
+def coerce_value(value):
+    coercer = _COERCERS.get(type(value), _coerce_slow)
+    return coercer(value)
+
+
+# The maximum number of column diffs memoized per shape
+_MAX_COLUMN_DIFFS = 16
+
+
+class EventShape(object):
+    '''
+    The compiled normalization of events that have the same name and
+    the same set of keys.
+    It also hosts a memo of column diffs against the table the events
+    are written to, which is maintained by the writer.
+    '''
+    __slots__ = ('event_norm', 'fields', '_column_diffs')
+
+    def __init__(self, event_raw, keys):
+        self.event_norm = sanitize_for_db(event_raw)
+        self.fields = tuple((key, sanitize_for_db(key)) for key in keys)
+        self._column_diffs = None
+
+    def lookup_column_diff(self, table, signature):
+        column_diffs = self._column_diffs
+        if column_diffs is None or column_diffs[0] is not table:
+            return None
+        return column_diffs[1].get(signature)
+
+    def store_column_diff(self, table, signature, diff):
+        column_diffs = self._column_diffs
+        if column_diffs is None or column_diffs[0] is not table:
+            column_diffs = (table, {})
+            self._column_diffs = column_diffs
+        if len(column_diffs[1]) < _MAX_COLUMN_DIFFS:
+            column_diffs[1][signature] = diff
+
+
+class EventShapeCache(object):
+    '''
+    Bounded LRU of event shapes keyed on event name and set of keys
+    '''
+    def __init__(self, maxsize=1024):
+        self._maxsize = maxsize
+        self._lock = threading.Lock()
+        self._shapes = OrderedDict()
+
+    def get(self, event_raw, json_dict):
+        key = (event_raw, frozenset(json_dict))
+        with self._lock:
+            shape = self._shapes.get(key)
+            if shape is not None:
+                self._shapes.move_to_end(key)
+                return shape
+        shape = EventShape(event_raw, json_dict)
+        with self._lock:
+            self._shapes[key] = shape
+            if len(self._shapes) > self._maxsize:
+                self._shapes.popitem(last=False)
+        return shape
+
+
+_event_shapes = EventShapeCache()
+
+
+# The maximum length of an event ID assigned by a client
+MAX_EVENT_ID_LENGTH = 128
+
+
+def get_client_event_id(json_event):
+    '''
+    Return the _id assigned to an event by the client, or None if there
+    is none or it is not a non-empty string of at most
+    MAX_EVENT_ID_LENGTH characters
+    '''
+    try:
+        event_id = json_event.get('_id')
+    except AttributeError:
+        return None
+    if not isinstance(event_id, str):
+        return None
+    if not 0 < len(event_id) <= MAX_EVENT_ID_LENGTH:
+        return None
+    return event_id
+
+
+def check_json_event(json_event):
+    '''
+    Raise MalformedBodyError if json_event is not an object with a
+    non-empty string _event_raw, so that a bad event is rejected before
+    it reaches the writer
+    '''
+    if not isinstance(json_event, dict):
+        raise MalformedBodyError('event is not an object')
+    event_raw = json_event.get('_event_raw')
+    if not isinstance(event_raw, str) or not event_raw:
+        raise MalformedBodyError('event has no _event_raw')
+
+
 class EventTrackingRequest(object):
     '''
     Represent a request
     It is intended to be used by writer
+    json_events can be any iterable, e.g. a lazy parser of the request
+    body, and events are materialized as they are iterated, so a
+    request can only be iterated once.
+    An event keeps the _id assigned by the client, so that a retried
+    request can be deduplicated; otherwise a new one is generated.
+    MalformedBodyError is raised when a malformed event is reached.
     '''
-    def __init__(self, http_header_ips, json_events):
-        self.events = []
+    def __init__(self, http_header_ips, json_events, chunk_size=500):
+        self._ips = http_header_ips
+        self._json_events = json_events
+        self._chunk_size = chunk_size
         self.received_at = datetime.datetime.utcnow()
-        for json_event in json_events:
-            json_dict = json_event.copy()
-            if http_header_ips:
-                json_dict['_ips'] = http_header_ips
-            self.events.append(SingleEvent(
-                event_id=str(uuid.uuid4()),
+
+    @property
+    def events(self):
+        for json_event in self._json_events:
+            check_json_event(json_event)
+            event_id = get_client_event_id(json_event)
+            if event_id is None:
+                event_id = str(uuid.uuid4())
+            yield SingleEvent(
+                event_id=event_id,
                 received_at=self.received_at,
-                json_dict=json_dict,
-            ))
+                json_dict=json_event,
+                ips=self._ips,
+            )
+
+    def iter_chunks(self):
+        '''
+        Yield lists of at most chunk_size events
+        '''
+        chunk = []
+        for event in self.events:
+            chunk.append(event)
+            if len(chunk) >= self._chunk_size:
+                yield chunk
+                chunk = []
+        if len(chunk) > 0:
+            yield chunk
 
 
 class SingleEvent(object):
@@ -142,28 +410,22 @@ class SingleEvent(object):
     It is intended to be constructed by the web request handler
     and used by db writer
     '''
-    def __init__(self, event_id, received_at, json_dict):
+    __slots__ = ('_event_raw', 'shape', 'event_norm', 'attributes')
+
+    def __init__(self, event_id, received_at, json_dict, ips=None):
         self._event_raw = json_dict['_event_raw']
-        self.event_norm = sanitize_for_db(self._event_raw)
+        self.shape = _event_shapes.get(self._event_raw, json_dict)
+        self.event_norm = self.shape.event_norm
 
         self.attributes = {}
-        for key in json_dict:
-            sanitized_key = sanitize_for_db(key)
-            value = json_dict[key]
-            if value is None:
-                continue
-            if isinstance(value, str):
+        for key, sanitized_key in self.shape.fields:
+            value = coerce_value(json_dict[key])
+            if value is not None:
                 self.attributes[sanitized_key] = value
-            elif isinstance(value, bool):
-                self.attributes[sanitized_key] = value
-            elif isinstance(value, int):
-                self.attributes[sanitized_key] = float(value)
-            elif isinstance(value, float):
-                self.attributes[sanitized_key] = value
-            elif isinstance(value, dict):
-                maybe_datetime = parse_datetime_from_dict(value)
-                if maybe_datetime:
-                    self.attributes[sanitized_key] = maybe_datetime
+
+        # inject _ips
+        if ips:
+            self.attributes['_ips'] = ips
 
         # inject _event_norm
         self.attributes['_event_norm'] = self.event_norm
@@ -173,3 +435,14 @@ class SingleEvent(object):
 
         # inject _received_at
         self.attributes['_received_at'] = received_at
+
+    def with_attributes(self, attributes):
+        '''
+        Return a copy of the event with other attributes
+        '''
+        event = object.__new__(SingleEvent)
+        event._event_raw = self._event_raw
+        event.shape = self.shape
+        event.event_norm = self.event_norm
+        event.attributes = attributes
+        return event
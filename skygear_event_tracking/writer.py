@@ -1,24 +1,67 @@
 import datetime
+import hashlib
+import struct
+import time
+from collections import OrderedDict
 from sqlalchemy import (
     Column,
     MetaData,
     Table,
+    text,
 )
-from sqlalchemy.exc import NoSuchTableError
+from sqlalchemy.exc import DBAPIError
 from sqlalchemy.dialects.postgresql import (
     BOOLEAN,
     DOUBLE_PRECISION,
+    JSONB,
     TIMESTAMP,
     TEXT,
+    insert,
 )
 from alembic.migration import MigrationContext
 from alembic.operations import Operations
-import threading
 import logging
-from .utils import sort_columns
+import threading
+from .bulk import copy_rows
+from .dedup import RecentEventIds
+from .indexes import create_indexes
+from .partition import (
+    make_create_default_partition_statement,
+    make_create_partition_statement,
+    make_create_partitioned_table_statement,
+)
+from .rollup import ROLLUP_TABLE_SUFFIX, HourlyRollup
+from .schema_cache import (
+    SchemaCache,
+    fetch_table_version,
+    list_partitions,
+    reflect_table,
+)
+from .utils import (
+    EXTRA_COLUMN,
+    is_preserved_column,
+    sanitize_for_db,
+    sort_columns,
+)
 
 logger = logging.getLogger(__name__)
 
+# SQLSTATE codes raised when another process changes the schema
+# of a table between our reflection and our statement
+_CONCURRENT_DDL_PGCODES = frozenset([
+    '42P07',  # duplicate_table
+    '42701',  # duplicate_column
+    '42P01',  # undefined_table
+    '42703',  # undefined_column
+    '40P01',  # deadlock_detected
+])
+
+# SQLSTATE raised when a new partition would take rows that are already
+# in the default partition
+_CHECK_VIOLATION_PGCODE = '23514'
+
+_ADVISORY_LOCK_SQL = text('SELECT pg_advisory_xact_lock(:key)')
+
 
 def from_python_type_to_col_type(python_type):
     '''
@@ -32,6 +75,8 @@ def from_python_type_to_col_type(python_type):
         return DOUBLE_PRECISION
     elif python_type is datetime.datetime:
         return TIMESTAMP
+    elif python_type is dict:
+        return JSONB
     raise ValueError('unknown type: ' + str(python_type))
 
 
@@ -80,22 +125,298 @@ def compute_columns_to_add(table, attributes):
     return output
 
 
+def _get_col_types(table):
+    '''
+    Return a dict from column name to col_type of table.
+    It is memoized in table.info as cached tables are immutable.
+    '''
+    if table is None:
+        return {}
+    col_types = table.info.get('col_types')
+    if col_types is None:
+        col_types = {}
+        for col_name, col in table.columns.items():
+            col_types[col_name] = type(col.type)
+        table.info['col_types'] = col_types
+    return col_types
+
+
+def diff_attributes(db_cols, attributes):
+    '''
+    Return the name of the first attribute whose type is not equivalent
+    to db_cols or None, and a tuple of (col_name, col_type) of the
+    attributes not in db_cols
+    '''
+    new_items = []
+    for col_name, value in attributes.items():
+        col_type = from_python_type_to_col_type(type(value))
+        db_col_type = db_cols.get(col_name)
+        if db_col_type is None:
+            new_items.append((col_name, col_type))
+        elif db_col_type is not col_type:
+            return col_name, ()
+    return None, tuple(new_items)
+
+
+def _diff_event(table, db_cols, event):
+    '''
+    Return diff_attributes of the event, memoized in its shape.
+    Events of the same shape usually have the same value types, so
+    a repeated event costs a lookup.
+    '''
+    attributes = event.attributes
+    signature = (tuple(attributes), tuple(map(type, attributes.values())))
+    diff = event.shape.lookup_column_diff(table, signature)
+    if diff is None:
+        diff = diff_attributes(db_cols, attributes)
+        event.shape.store_column_diff(table, signature, diff)
+    return diff
+
+
+def _find_new_col_conflict(new_cols, new_items):
+    for col_name, col_type in new_items:
+        if new_cols.get(col_name, col_type) is not col_type:
+            return col_name
+    return None
+
+
+def compute_columns_to_add_for_events(table, events):
+    '''
+    Return the union of columns that should be added to the table for
+    every event in events, and a set of indexes of the events whose
+    attribute types conflict with the table or with an earlier event
+    of the batch
+    '''
+    db_cols = _get_col_types(table)
+    new_cols = OrderedDict()
+    rejected = set()
+    for i, event in enumerate(events):
+        col_name, new_items = _diff_event(table, db_cols, event)
+        if col_name is None:
+            col_name = _find_new_col_conflict(new_cols, new_items)
+        if col_name is not None:
+            logger.warning('"%s": type conflict in event %d', col_name, i)
+            rejected.add(i)
+            continue
+        for col_name, col_type in new_items:
+            new_cols.setdefault(col_name, col_type)
+
+    output = []
+    for col_name, col_type in new_cols.items():
+        output.append(Column(col_name, col_type))
+    return output, rejected
+
+
+def make_add_columns_statement(dialect, table, columns):
+    '''
+    Return a single ALTER TABLE statement that adds all columns
+    '''
+    preparer = dialect.identifier_preparer
+    clauses = []
+    for column in columns:
+        clauses.append('ADD COLUMN {} {}'.format(
+            preparer.quote(column.name),
+            column.type.compile(dialect=dialect),
+        ))
+    return 'ALTER TABLE {} {}'.format(
+        preparer.format_table(table),
+        ', '.join(clauses),
+    )
+
+
+def _to_json_value(value):
+    if isinstance(value, datetime.datetime):
+        return value.isoformat() + 'Z'
+    return value
+
+
+class ColumnBudget(object):
+    '''
+    Decide which attributes get their own column.
+    Attributes that are not in the allowlist, or that would make the
+    table have more than max_columns non-preserved columns, are moved into
+    the _extra JSONB column instead of adding a column.
+    Preserved columns always get a column.
+    '''
+    def __init__(self, max_columns=None, allowlist=None):
+        self._max_columns = max_columns
+        if allowlist is None:
+            self._allowlist = None
+        else:
+            self._allowlist = frozenset(sanitize_for_db(a) for a in allowlist)
+
+    def _is_allowed(self, col_name):
+        if self._allowlist is None:
+            return True
+        return col_name in self._allowlist
+
+    def _admit(self, col_name, db_cols, admitted, limit):
+        '''
+        Return True if col_name should be a column.
+        admitted holds the new columns admitted so far, and limit is the
+        number of new columns allowed, or None if it is unlimited.
+        '''
+        if col_name in db_cols or col_name in admitted:
+            return True
+        if is_preserved_column(col_name):
+            return True
+        if not self._is_allowed(col_name):
+            return False
+        if limit is not None and len(admitted) >= limit:
+            return False
+        admitted.add(col_name)
+        return True
+
+    def apply(self, table, events):
+        '''
+        Return the events with overflowing attributes moved into _extra.
+        Events are copied rather than changed, so the budget can be
+        applied again to the same events after the table is reflected
+        again or the transaction is retried.
+        New columns are admitted in the order they are first seen.
+        '''
+        db_cols = table.columns if table is not None else {}
+        limit = None
+        if self._max_columns is not None:
+            used = [c for c in db_cols.keys() if not is_preserved_column(c)]
+            limit = self._max_columns - len(used)
+        admitted = set()
+        output = []
+        for event in events:
+            attributes = {}
+            overflow = {}
+            for col_name, value in event.attributes.items():
+                if self._admit(col_name, db_cols, admitted, limit):
+                    attributes[col_name] = value
+                else:
+                    overflow[col_name] = _to_json_value(value)
+            if len(overflow) > 0:
+                attributes[EXTRA_COLUMN] = _merge_extra(
+                    attributes.get(EXTRA_COLUMN),
+                    overflow,
+                )
+                event = event.with_attributes(attributes)
+            output.append(event)
+        return output
+
+
+def _merge_extra(extra, overflow):
+    '''
+    Return a new _extra value with the overflowing attributes.
+    An _extra sent by the client that is not an object is kept under the
+    key _extra, so that neither it nor the overflow is lost.
+    '''
+    if extra is None:
+        return overflow
+    if not isinstance(extra, dict):
+        logger.warning('_extra is not an object, keeping it in _extra._extra')
+        extra = {EXTRA_COLUMN: extra}
+    merged = dict(extra)
+    merged.update(overflow)
+    return merged
+
+
+def make_insert_statement(table, rows, skip_conflicts=False):
+    '''
+    Return a multi-row INSERT. If skip_conflicts is True, it skips rows
+    conflicting with a unique index, e.g. the primary key on _id, and
+    returns the _id of the rows inserted.
+    '''
+    stmt = insert(table).values(rows)
+    if not skip_conflicts:
+        return stmt
+    return stmt.on_conflict_do_nothing().returning(table.c['_id'])
+
+
+def compute_advisory_lock_key(quantified_table_name):
+    '''
+    Return a stable signed 64-bit advisory lock key for a table name.
+    The key must be the same in every plugin process, so the builtin
+    hash() cannot be used.
+    '''
+    digest = hashlib.sha1(quantified_table_name.encode('utf-8')).digest()
+    return struct.unpack('>q', digest[:8])[0]
+
+
+def is_concurrent_ddl_error(exc):
+    '''
+    Return True if exc is caused by a concurrent schema change,
+    in which case the transaction can be retried
+    '''
+    if not isinstance(exc, DBAPIError):
+        return False
+    pgcode = getattr(exc.orig, 'pgcode', None)
+    return pgcode in _CONCURRENT_DDL_PGCODES
+
+
+def group_events_by_table(events):
+    '''
+    Group events by event_norm, preserving arrival order.
+    Events in the same group are written to the same table.
+    '''
+    groups = OrderedDict()
+    for event in events:
+        groups.setdefault(event.event_norm, []).append(event)
+    return list(groups.values())
+
+
+def group_events(events):
+    '''
+    Group events by event_norm and column set, preserving arrival order.
+    Events in the same group can be written with a single INSERT.
+    '''
+    groups = OrderedDict()
+    for event in events:
+        key = (event.event_norm, frozenset(event.attributes))
+        groups.setdefault(key, []).append(event)
+    return list(groups.values())
+
+
 class Writer(object):
-    def __init__(self, engine, schema, table_prefix):
+    def __init__(
+        self,
+        engine,
+        schema,
+        table_prefix,
+        bulk_load_threshold=None,
+        schema_cache=None,
+        ddl_retries=3,
+        partition_scheme=None,
+        hourly_rollup=False,
+        index_policies=(),
+        column_budget=None,
+        recent_ids_size=100000,
+        partitions_ttl=300,
+    ):
         self._engine = engine
         self._schema = schema
         self._table_prefix = table_prefix
-        self._cache = threading.local()
-
-    def _ensure_cache(self):
-        logger.debug('ensure cache')
-        if not hasattr(self._cache, 'metadata'):
-            self._evict_reflection_cache()
+        self._bulk_load_threshold = bulk_load_threshold
+        if schema_cache is None:
+            schema_cache = SchemaCache()
+        self._schema_cache = schema_cache
+        self._ddl_retries = ddl_retries
+        self._partition_scheme = partition_scheme
+        self._partitions_lock = threading.Lock()
+        self._partitions = {}
+        self._partitions_ttl = partitions_ttl
+        if hourly_rollup:
+            self._rollup = HourlyRollup(schema, table_prefix)
+        else:
+            self._rollup = None
+        self._rollup_ready = False
+        self._index_policies = index_policies
+        self._column_budget = column_budget
+        self._recent_ids = RecentEventIds(recent_ids_size or 0)
 
-    def _evict_reflection_cache(self):
-        logger.debug('evicting reflection cache')
-        self._cache.metadata = MetaData()
-        self._cache.tables = {}
+    def _evict_reflection_cache(self, event_norm):
+        quantified_table_name = self._compute_quantified_table_name(
+            event_norm,
+        )
+        logger.debug('evicting reflection cache: %s', quantified_table_name)
+        self._schema_cache.evict(quantified_table_name)
+        with self._partitions_lock:
+            self._partitions.pop(quantified_table_name, None)
 
     def _make_alembic_op(self, conn):
         '''
@@ -120,93 +441,389 @@ class Writer(object):
             event_norm
         )
         logger.debug('create table: %s', prefixed_table_name)
-        op.create_table(
+        if self._partition_scheme is None:
+            op.create_table(
+                prefixed_table_name,
+                *columns,
+                **{
+                    'schema': self._schema,
+                }
+            )
+        else:
+            self._create_partitioned_table(
+                conn,
+                prefixed_table_name,
+                columns,
+            )
+        self._evict_reflection_cache(event_norm)
+        table, _ = self._reflect_table(conn, event_norm)
+        partition_column = None
+        if self._partition_scheme is not None:
+            partition_column = self._partition_scheme.column
+        create_indexes(conn, table, self._index_policies, partition_column)
+        return table
+
+    def _create_partitioned_table(self, conn, prefixed_table_name, columns):
+        column_name = self._partition_scheme.column
+        if column_name not in [c.name for c in columns]:
+            columns = sort_columns(columns + [Column(column_name, TIMESTAMP)])
+        table = Table(
             prefixed_table_name,
+            MetaData(),
             *columns,
-            **{
-                'schema': self._schema,
-            }
+            schema=self._schema
         )
-        self._evict_reflection_cache()
-        table = self._get_cached_table(conn, event_norm)
-        return table
+        conn.execute(make_create_partitioned_table_statement(
+            conn.dialect,
+            table,
+            column_name,
+        ))
+        conn.execute(make_create_default_partition_statement(
+            conn.dialect,
+            table,
+        ))
 
-    def _add_columns(self, conn, op, event_norm, columns):
-        prefixed_table_name = self._compute_prefixed_table_name(
-            event_norm
+    def _ensure_partitions(self, conn, event_norm, table, events):
+        '''
+        Create the partitions needed by events and the partitions ahead
+        of now, skipping those known to exist.
+        Return the starts of the partitions created, which should be
+        remembered once the transaction commits.
+        '''
+        if table is None or not table.info.get('partitioned'):
+            return []
+        scheme = self._partition_scheme
+        values = [e.attributes.get(scheme.column) for e in events]
+        starts = scheme.compute_starts(values, datetime.datetime.utcnow())
+        known = self._known_partitions(conn, event_norm, table)
+        starts = sorted(starts - known)
+        if len(starts) == 0:
+            return []
+        self._lock_table(conn, event_norm)
+        return [
+            start for start in starts
+            if self._create_partition(conn, table, start)
+        ]
+
+    def _known_partitions(self, conn, event_norm, table):
+        '''
+        Return the starts of the partitions of table.
+        They are read from the catalog again after partitions_ttl
+        seconds, since the retention worker drops old partitions.
+        '''
+        quantified_table_name = self._compute_quantified_table_name(
+            event_norm,
         )
-        logger.debug('add columns in table: %s', prefixed_table_name)
-        for column in columns:
-            op.add_column(
-                prefixed_table_name,
-                column,
-                schema=self._schema,
+        with self._partitions_lock:
+            entry = self._partitions.get(quantified_table_name)
+        now = time.monotonic()
+        if entry is not None and now - entry[0] < self._partitions_ttl:
+            return set(entry[1])
+        scheme = self._partition_scheme
+        names = list_partitions(conn, self._schema, table.name)
+        known = set(
+            scheme.parse_partition_start(table.name, name)
+            for name in names
+        )
+        known.discard(None)
+        with self._partitions_lock:
+            self._partitions[quantified_table_name] = (now, known)
+        return set(known)
+
+    def _create_partition(self, conn, table, start):
+        '''
+        Create the partition of table starting at start in a savepoint.
+        Return False if the default partition already has rows in its
+        range; these rows stay in the default partition.
+        '''
+        logger.debug('create partition of %s: %s', table.name, start)
+        savepoint = conn.begin_nested()
+        try:
+            conn.execute(make_create_partition_statement(
+                conn.dialect,
+                table,
+                self._partition_scheme,
+                start,
+            ))
+        except DBAPIError as e:
+            savepoint.rollback()
+            pgcode = getattr(e.orig, 'pgcode', None)
+            if pgcode != _CHECK_VIOLATION_PGCODE:
+                raise
+            logger.warning(
+                'default partition of %s has rows from %s, '
+                'not creating the partition',
+                table.name,
+                start,
             )
-        self._evict_reflection_cache()
-        table = self._get_cached_table(conn, event_norm)
+            return False
+        savepoint.commit()
+        return True
+
+    def _remember_partitions(self, event_norm, starts):
+        if len(starts) == 0:
+            return
+        quantified_table_name = self._compute_quantified_table_name(
+            event_norm,
+        )
+        with self._partitions_lock:
+            entry = self._partitions.get(quantified_table_name)
+            if entry is not None:
+                entry[1].update(starts)
+
+    def _update_rollup(self, conn, events):
+        '''
+        Add the events to the hourly rollup in the current transaction.
+        Return True if the rollup table might have been created.
+        '''
+        if self._rollup is None or len(events) == 0:
+            return False
+        if self._rollup_ready:
+            self._rollup.update(conn, events)
+            return False
+        # the rollup table is named as if it were an event table
+        self._lock_table(conn, ROLLUP_TABLE_SUFFIX)
+        self._rollup.ensure_table(conn)
+        self._rollup.update(conn, events)
+        return True
+
+    def _add_columns(self, conn, table, event_norm, columns):
+        logger.debug('add columns in table: %s', table.name)
+        stmt = make_add_columns_statement(conn.dialect, table, columns)
+        conn.execute(stmt)
+        self._evict_reflection_cache(event_norm)
+        table, _ = self._reflect_table(conn, event_norm)
         return table
 
+    def _lock_table(self, conn, event_norm):
+        '''
+        Serialize DDL on a table across plugin processes.
+        The lock is released when the transaction ends.
+        '''
+        quantified_table_name = self._compute_quantified_table_name(
+            event_norm,
+        )
+        logger.debug('lock table: %s', quantified_table_name)
+        key = compute_advisory_lock_key(quantified_table_name)
+        conn.execute(_ADVISORY_LOCK_SQL, key=key)
+
+    def _reflect_table(self, conn, event_norm):
+        '''
+        Return the reflected table and its version stamp without
+        touching the cache. The table is None if it does not exist.
+        '''
+        prefixed_table_name = self._compute_prefixed_table_name(event_norm)
+        version = fetch_table_version(conn, self._schema, prefixed_table_name)
+        if version is None:
+            return None, None
+        table = reflect_table(
+            conn,
+            self._schema,
+            prefixed_table_name,
+            version,
+        )
+        return table, version
+
     def _get_cached_table(self, conn, event_norm):
+        '''
+        Return the table from the shared cache, reflecting it on cache miss.
+        It must be called before any DDL is emitted in the transaction
+        so that only committed schema is cached.
+        '''
         prefixed_table_name = self._compute_prefixed_table_name(event_norm)
         quantified_table_name = self._compute_quantified_table_name(
             event_norm,
         )
-        self._ensure_cache()
-        if quantified_table_name not in self._cache.tables:
+        entry = self._schema_cache.get(quantified_table_name)
+        if entry is None:
             logger.debug('cache miss table: %s', prefixed_table_name)
-            try:
-                table = Table(
-                    prefixed_table_name,
-                    self._cache.metadata,
-                    autoload=True,
-                    autoload_with=conn,
-                    schema=self._schema
-                )
-            except NoSuchTableError:
-                table = None
-            self._cache.tables[quantified_table_name] = table
+            table, version = self._reflect_table(conn, event_norm)
+            entry = self._schema_cache.put(
+                quantified_table_name,
+                table,
+                version,
+            )
         else:
             logger.debug('cache hit table: %s', prefixed_table_name)
-            table = self._cache.tables[quantified_table_name]
+        return entry.table
+
+    def _refresh_table_if_stale(self, conn, event_norm, table):
+        '''
+        Compare the version stamp of the cached table with the database.
+        If another process has changed the table, evict it and return
+        a fresh reflection; otherwise return table as is.
+        '''
+        prefixed_table_name = self._compute_prefixed_table_name(event_norm)
+        quantified_table_name = self._compute_quantified_table_name(
+            event_norm,
+        )
+        version = fetch_table_version(conn, self._schema, prefixed_table_name)
+        entry = self._schema_cache.get(quantified_table_name)
+        if entry is not None and entry.version == version:
+            return table
+        logger.debug('stale table: %s', prefixed_table_name)
+        self._evict_reflection_cache(event_norm)
+        table, _ = self._reflect_table(conn, event_norm)
         return table
 
-    def _insert_event(self, conn, table, event):
-        logger.debug('insert table: %s', table.name)
-        stmt = table.insert().values(**event.attributes)
-        conn.execute(stmt)
+    def _should_bulk_load(self, events):
+        if self._bulk_load_threshold is None:
+            return False
+        return len(events) >= self._bulk_load_threshold
+
+    def _insert_events(self, conn, table, events):
+        '''
+        Write events, skipping those whose _id is already in the table
+        if its primary key is exactly (_id). Return the events written.
+        COPY cannot skip conflicting rows, so it is only used on tables
+        without such a primary key. The primary key of a partitioned
+        table also has the partition column, so duplicates in it are
+        only dropped by the in-process recent IDs.
+        '''
+        rows = [event.attributes for event in events]
+        if not table.info.get('primary_key_on_id'):
+            if self._should_bulk_load(events):
+                copy_rows(conn, table, rows)
+                return events
+            logger.debug('insert table: %s, rows: %d', table.name, len(rows))
+            conn.execute(make_insert_statement(table, rows))
+            return events
+        logger.debug('insert table: %s, rows: %d', table.name, len(rows))
+        stmt = make_insert_statement(table, rows, skip_conflicts=True)
+        inserted = set(row[0] for row in conn.execute(stmt))
+        if len(inserted) == len(events):
+            return events
+        logger.info(
+            'skip %d duplicate events in table: %s',
+            len(events) - len(inserted),
+            table.name,
+        )
+        return [e for e in events if e.attributes['_id'] in inserted]
+
+    def _apply_column_budget(self, table, events):
+        if self._column_budget is None:
+            return events
+        return self._column_budget.apply(table, events)
+
+    def _ensure_table(self, conn, op, event_norm, table, events):
+        '''
+        Return the table of the events and the events that can be written,
+        creating the table or adding the union of new columns in a single
+        statement when necessary.
+        DDL is emitted while holding an advisory lock on the table, after
+        checking the table again, so that concurrent writers never create
+        the same table or column twice.
+        Events whose attribute types conflict are dropped.
+        '''
+        original = events
+        events = self._apply_column_budget(table, original)
+        columns, rejected = compute_columns_to_add_for_events(table, events)
+        if len(columns) > 0:
+            self._lock_table(conn, event_norm)
+            table = self._refresh_table_if_stale(conn, event_norm, table)
+            # the budget left may have changed with the table
+            events = self._apply_column_budget(table, original)
+            columns, rejected = compute_columns_to_add_for_events(
+                table,
+                events,
+            )
+        columns = sort_columns(columns)
+        if len(columns) > 0:
+            if table is None:
+                table = self._create_table(conn, op, event_norm, columns)
+            else:
+                table = self._add_columns(conn, table, event_norm, columns)
+        if len(rejected) > 0:
+            events = [e for i, e in enumerate(events) if i not in rejected]
+        return table, events
+
+    def _process_one_table_in_txn(self, events):
+        event_norm = events[0].event_norm
+        with self._engine.begin() as conn:
+            logger.debug('transaction begins')
+            op = self._make_alembic_op(conn)
+            table = self._get_cached_table(conn, event_norm)
+            table, events = self._ensure_table(
+                conn,
+                op,
+                event_norm,
+                table,
+                events,
+            )
+            starts = self._ensure_partitions(conn, event_norm, table, events)
+            inserted = []
+            for group in group_events(events):
+                inserted.extend(self._insert_events(conn, table, group))
+            rollup_created = self._update_rollup(conn, inserted)
+        self._remember_partitions(event_norm, starts)
+        self._recent_ids.add(events)
+        if rollup_created:
+            self._rollup_ready = True
+
+    def _process_one_table_with_retry(self, events):
+        '''
+        Write events of a table, retrying when the transaction fails
+        because another process changed the table concurrently
+        '''
+        event_norm = events[0].event_norm
+        attempt = 0
+        while True:
+            try:
+                self._process_one_table_in_txn(events)
+                return
+            except Exception as e:
+                self._evict_reflection_cache(event_norm)
+                if attempt >= self._ddl_retries:
+                    raise
+                if not is_concurrent_ddl_error(e):
+                    raise
+                attempt += 1
+                logger.info('retry after concurrent DDL: %s', event_norm)
 
     def _process_one_event_in_txn(self, event):
         try:
-            with self._engine.begin() as conn:
-                logger.debug('transaction begins')
-                op = self._make_alembic_op(conn)
-                table = self._get_cached_table(conn, event.event_norm)
-                columns = compute_columns_to_add(table, event.attributes)
-                columns = sort_columns(columns)
-                if len(columns) > 0:
-                    if table is None:
-                        table = self._create_table(
-                            conn,
-                            op,
-                            event.event_norm,
-                            columns,
-                        )
-                    else:
-                        table = self._add_columns(
-                            conn,
-                            op,
-                            event.event_norm,
-                            columns,
-                        )
-                self._insert_event(conn, table, event)
+            self._process_one_table_with_retry([event])
         except Exception:
-            self._evict_reflection_cache()
+            logger.exception('failed to write event: %s', event.event_norm)
+
+    def _process_one_table(self, events):
+        if len(events) == 1:
+            self._process_one_event_in_txn(events[0])
+            return
+        try:
+            self._process_one_table_with_retry(events)
+        except Exception:
+            logger.warning(
+                'batch insert of %d events failed, '
+                'falling back to per-event insert',
+                len(events),
+            )
+            for event in events:
+                self._process_one_event_in_txn(event)
 
     def process_request(self, event_tracking_request):
         '''
-        Process each event in separated transaction.
-        Cache reflection data in thread local metadata.
-        The cache will be evicted if DDL is emited or exception is caught.
+        Write the events of a request chunk by chunk, so that only
+        a chunk of events is materialized at a time
+        '''
+        for events in event_tracking_request.iter_chunks():
+            self.process_events(events)
+
+    def process_events(self, events):
+        '''
+        Write the events of each table in its own transaction.
+        Schema changes needed by the events of a table are applied
+        in a single statement, then events are grouped by column set
+        and each group is written with a single multi-row INSERT.
+        The hourly rollup, if enabled, is updated in the same transaction.
+        If a table fails, its events are retried one by one so that
+        a bad event does not lose the rest.
+        Cache reflection data in a process-wide schema cache.
+        A table is evicted from the cache if DDL is emited on it or
+        exception is caught while writing to it.
+        Events whose _id has been written recently by this process, or
+        repeats an _id in events, are dropped.
         '''
-        for event in event_tracking_request.events:
-            self._process_one_event_in_txn(event)
+        events = self._recent_ids.filter(events)
+        for table_events in group_events_by_table(events):
+            self._process_one_table(table_events)